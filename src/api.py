@@ -1,29 +1,90 @@
 import asyncio
 import dataclasses
+import datetime
 import logging
+import math
+import os
 import uuid
 from contextlib import asynccontextmanager
-from itertools import count
-from typing import List
+from itertools import count, islice
+from typing import List, Callable
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
 from pydantic.dataclasses import dataclass
 
 from cocktail_24.cocktail.cocktail_api import (
     CocktailApi,
-    CocktailBarStatePersistence,
     SqliteCocktailBarStatePersistence,
+    LoggedEvent,
+    HistoryUnavailableException,
+    BatchItemResult,
+    OrderRejectedException,
+    SnapshotConfig,
+)
+from cocktail_24.cocktail.admission_control import (
+    AdmissionConfig,
+    QueueFullException,
+)
+from cocktail_24.cocktail.async_persistence import (
+    ThreadOffloadedCocktailBarStatePersistence,
+)
+from cocktail_24.cocktail.group_commit import WriteBehindConfig
+from cocktail_24.cocktail.cocktail_bookkeeping import (
+    OrderId,
+    Order,
+    OrderStatus,
+    CLOSED_ORDER_STATUSES,
+    SlotStatus,
+    CocktailBarState,
+    UserId,
 )
-from cocktail_24.cocktail.cocktail_bookkeeping import OrderId, Order, SlotStatus
 from cocktail_24.cocktail.cocktail_recipes import CocktailRecipe, RecipeId
+from cocktail_24.cocktail.order_projections import OrderProjections, OrderTimeline
+from cocktail_24.cocktail.response_cache import VersionedResponseCache, etag_matches
 from cocktail_24.cocktail_management import CocktailManagement, FakeFulfillmentSystem
 from cocktail_24.cocktail_robot_interface import CocktailRobotState
 from cocktail_24.cocktail_runtime import async_cocktail_runtime
 from cocktail_24.cocktail_system import CocktailSystemStatus
+from cocktail_24.metrics import REGISTRY
+from cocktail_24.planning.eta import EtaEngine, TaskCostModel
 from cocktail_24.pump_interface.pump_interface import PumpStatus
-from configure import configure_system, configure_management, configure_system_config
+from cocktail_24.status_broadcast import StatusBroadcaster
+from configure import (
+    configure_system,
+    configure_management,
+    configure_system_config,
+    configure_planning,
+)
 
 FAKE_SYSTEM = True
+# overridable, e.g. for load tests against a fresh database
+DB_PATH = os.environ.get("COCKTAIL_DB", "/tmp/cocktails_2.db")
+
+# orders closed longer ago than this are moved out of the live state
+ORDER_RETENTION = datetime.timedelta(days=2)
+# how far back /events and /debug/state reach (older events are dropped by the
+#   compaction)
+EVENT_HISTORY = datetime.timedelta(days=14)
+COMPACTION_INTERVAL_IN_S = 3600
+# upper bound of the events returned by one /events call
+EVENT_PAGE_LIMIT = 1000
+ORDER_PAGE_LIMIT = 500
+
+# keeps a rush from building an hours long backlog
+ADMISSION = AdmissionConfig(
+    max_pending_orders=40,
+    max_open_orders_per_user=3,
+    max_wait_in_s=45 * 60,
+    service_time_in_s=90,
+)
+
+ORDER_WAIT_TIMEOUT_IN_S = 30.0
+MAX_ORDER_WAIT_TIMEOUT_IN_S = 120.0
+
+# upper bound for pushes to the status stream
+STATUS_STREAM_MAX_RATE_IN_HZ = 10
 
 logging.basicConfig(
     format="%(asctime)s.%(msecs)03d %(levelname)-8s %(message)s",
@@ -34,9 +95,10 @@ logging.basicConfig(
 
 @dataclasses.dataclass
 class Cocktail:
-    persistence: CocktailBarStatePersistence
+    persistence: SqliteCocktailBarStatePersistence
     api: CocktailApi
     management: CocktailManagement
+    eta: EtaEngine
 
 
 def get_management(persistence, fake_system: bool = False):
@@ -55,16 +117,46 @@ async def update_fake_management():
         await asyncio.sleep(0.0001)
 
 
+async def compact_periodically():
+    while True:
+        await asyncio.sleep(COMPACTION_INTERVAL_IN_S)
+        archived = await asyncio.to_thread(
+            COCKTAIL.persistence.compact, ORDER_RETENTION, history=EVENT_HISTORY
+        )
+        logging.warning(f"compaction archived {archived} orders")
+
+
 def get_cocktail(fake_system: bool = False):
     # persistence = InMemoryCocktailBarStatePersistence(
     #     initial_state=configure_initial_state()
     # )
-    persistence = SqliteCocktailBarStatePersistence("/tmp/cocktails_2.db")
-    cock_api = CocktailApi(state_persistence=persistence)
+    # all snapshots within EVENT_HISTORY are kept (older ones are dropped by the
+    #   compaction), so /debug/state replays at most one snapshot interval
+    # management persists from the robot loop without waiting for the commit:
+    #   write behind applies the events right away and commits on its own
+    #   thread (api handlers still await the commit)
+    persistence = SqliteCocktailBarStatePersistence(
+        DB_PATH, SnapshotConfig(retention=None), write_behind=WriteBehindConfig()
+    )
+    # handlers must not block the event loop shared with the robot runtime
+    cock_api = CocktailApi(
+        state_persistence=ThreadOffloadedCocktailBarStatePersistence(persistence),
+        admission=ADMISSION,
+    )
+    system_config = configure_system_config()
+    eta = EtaEngine(
+        planning=configure_planning(system_config),
+        get_state=persistence.get_current_state,
+        cost_model=TaskCostModel(
+            single_shake_in_s=system_config.single_shake_duration_in_s
+        ),
+    )
+    persistence.order_watch.add_listener(eta.orders_changed)
     return Cocktail(
         persistence=persistence,
         api=cock_api,
         management=get_management(persistence, fake_system=fake_system),
+        eta=eta,
     )
 
 
@@ -92,6 +184,11 @@ def gen_run_robo():
 
 COCKTAIL = get_cocktail(fake_system=FAKE_SYSTEM)
 
+# read when scraped
+REGISTRY.gauge("cocktail_order_queue_length", "orders in the queue").set_function(
+    lambda: len(COCKTAIL.persistence.get_current_state().order_queue)
+)
+
 
 @asynccontextmanager
 async def lifespan(_app: FastAPI):
@@ -114,34 +211,264 @@ async def lifespan(_app: FastAPI):
     else:
         t = asyncio.create_task(log_exceptions(update_fake_management()))
         logging.warning("not starting runtime. faking!")
+    compaction = asyncio.create_task(log_exceptions(compact_periodically()))
+    status_stream = asyncio.create_task(log_exceptions(STATUS_BROADCASTER.run()))
     yield
     t.cancel()
+    compaction.cancel()
+    status_stream.cancel()
+    # commits the events written behind
+    COCKTAIL.persistence.close()
 
 
 app = FastAPI(lifespan=lifespan)
 
 
+# an order with the estimated seconds until it is ready (None unless queued or
+#   executing)
+@dataclass(frozen=True)
+class OrderDetails(Order):
+    estimated_ready_in_s: float | None = None
+
+
 @app.get("/order/{order_id}")
-async def get_order_details(order_id: OrderId) -> Order:
+async def get_order_details(order_id: OrderId) -> OrderDetails | Order:
     cs = COCKTAIL.persistence.get_current_state()
-    return cs.orders[order_id]
+    if order_id in cs.orders:
+        order = cs.orders[order_id]
+        return OrderDetails(
+            **{
+                field.name: getattr(order, field.name)
+                for field in dataclasses.fields(Order)
+            },
+            estimated_ready_in_s=COCKTAIL.eta.estimate(order_id, cs),
+        )
+    archived = COCKTAIL.persistence.get_archived_order(order_id)
+    if archived is None:
+        raise HTTPException(status_code=404, detail="order not found")
+    return archived
+
+
+# long poll: parks until the order reaches until (or any other status, if
+#   omitted) or is closed, and returns the order as of then. on timeout the
+#   unchanged order is returned
+@app.get("/order/{order_id}/wait")
+async def wait_for_order(
+    order_id: OrderId,
+    until: OrderStatus | None = None,
+    timeout: float = ORDER_WAIT_TIMEOUT_IN_S,
+) -> Order:
+    persistence = COCKTAIL.persistence
+
+    def current() -> Order | None:
+        return persistence.get_current_state().orders.get(order_id)
+
+    order = current()
+    if order is None:
+        return await get_order_details(order_id)
+    initial_status = order.status
+
+    def reached(changed: Order) -> bool:
+        if until is None:
+            return changed.status != initial_status
+        return changed.status == until or changed.status in CLOSED_ORDER_STATUSES
+
+    changed = await persistence.order_watch.wait_for(
+        order_id,
+        reached,
+        current,
+        max(0.0, min(timeout, MAX_ORDER_WAIT_TIMEOUT_IN_S)),
+    )
+    return changed if changed is not None else current() or order
+
+
+# polled several times per second by the displays: bodies are serialized once
+#   per state version and clients with a current etag get a 304
+RESPONSE_CACHE = VersionedResponseCache()
+
+
+def cached_json_response(
+    request: Request, key, to_json: Callable[[CocktailBarState], bytes]
+) -> Response:
+    cs = COCKTAIL.persistence.get_current_state()
+    cached = RESPONSE_CACHE.get(key, cs, to_json)
+    headers = {"ETag": cached.etag}
+    if etag_matches(request.headers.get("if-none-match"), cached.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(cached.body, media_type="application/json", headers=headers)
+
+
+ORDER_IDS_ADAPTER = TypeAdapter(List[OrderId])
+
+
+# filters are served from the order projections, without scanning all orders
+def filter_orders(
+    cs: CocktailBarState,
+    status: OrderStatus | None,
+    user_id: UserId | None,
+    recipe_id: RecipeId | None,
+) -> List[OrderId]:
+    filters = [
+        (cs.projections[name], key)
+        for name, key in (
+            ("by_status", status),
+            ("by_user", user_id),
+            ("by_recipe", recipe_id),
+        )
+        if key is not None
+    ]
+    # in order of placement, like the orders were listed before the indexes
+    if not filters:
+        return [order_id for _time, order_id in cs.projections["timeline"].orders()]
+    # walk the smallest matching index, check the others per order
+    filters.sort(key=lambda index_and_key: index_and_key[0].count(index_and_key[1]))
+    (index, key), *others = filters
+    order_ids = [
+        order_id
+        for order_id in index.order_ids(key)
+        if all(other.contains(other_key, order_id) for other, other_key in others)
+    ]
+    order_ids.sort(key=lambda order_id: (cs.orders[order_id].time_of_order, order_id))
+    return order_ids
+
+
+@app.get("/orders", response_model=List[OrderId])
+async def get_orders(
+    request: Request,
+    status: OrderStatus | None = None,
+    user_id: UserId | None = None,
+    recipe_id: RecipeId | None = None,
+) -> Response:
+    return cached_json_response(
+        request,
+        ("orders", status, user_id, recipe_id),
+        lambda cs: ORDER_IDS_ADAPTER.dump_json(
+            filter_orders(cs, status, user_id, recipe_id)
+        ),
+    )
+
+
+@dataclass
+class OrderListItem:
+    order_id: OrderId
+    time_of_order: datetime.datetime
+    # only with embed=true
+    order: Order | None = None
+    # seconds until the order is ready, for queued and executing orders
+    estimated_ready_in_s: float | None = None
+
+
+@dataclass
+class OrderPage:
+    items: List[OrderListItem]
+    # pass as after to get the next page, None after the last page
+    next_cursor: str | None
+
+
+def encode_order_cursor(time_of_order: datetime.datetime, order_id: OrderId) -> str:
+    return f"{time_of_order.isoformat()}_{order_id}"
+
+
+def decode_order_cursor(cursor: str) -> tuple[datetime.datetime, OrderId]:
+    try:
+        time_of_order, order_id = cursor.split("_")
+        # cursors with an utc offset compare against naive local times
+        time_of_order = to_local_time(datetime.datetime.fromisoformat(time_of_order))
+        return time_of_order, OrderId(uuid.UUID(order_id))
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"invalid cursor {cursor}")
+
+
+# orders are timestamped in naive local time
+def to_local_time(timestamp: datetime.datetime | None) -> datetime.datetime | None:
+    if timestamp is None or timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone().replace(tzinfo=None)
+
+
+# keyset paginated listing by time of order, served from the order timelines
+@app.get("/orders/page")
+async def get_order_page(
+    status: OrderStatus | None = None,
+    user_id: UserId | None = None,
+    since: datetime.datetime | None = None,
+    until: datetime.datetime | None = None,
+    after: str | None = None,
+    limit: int = 100,
+    embed: bool = False,
+    descending: bool = False,
+) -> OrderPage:
+    limit = max(1, min(limit, ORDER_PAGE_LIMIT))
+    cs = COCKTAIL.persistence.get_current_state()
+    range_args = dict(
+        since=to_local_time(since),
+        until=to_local_time(until),
+        after=decode_order_cursor(after) if after is not None else None,
+        descending=descending,
+    )
+    if user_id is not None:
+        # a user has few orders: sort them instead of keeping another timeline
+        user_timeline = OrderProjections.build(
+            {"timeline": OrderTimeline},
+            (
+                cs.orders[order_id]
+                for order_id in cs.projections["by_user"].order_ids(user_id)
+            ),
+        )["timeline"]
+        keys = (
+            key
+            for key in user_timeline.orders(**range_args)
+            if status is None or cs.orders[key[1]].status == status
+        )
+    elif status is not None:
+        keys = cs.projections["timeline_by_status"].orders(
+            (status.value,), **range_args
+        )
+    else:
+        keys = cs.projections["timeline"].orders(**range_args)
+    # one more to know whether there is a next page
+    page = [*islice(keys, limit + 1)]
+    next_cursor = encode_order_cursor(*page[limit - 1]) if len(page) > limit else None
+    return OrderPage(
+        items=[
+            OrderListItem(
+                order_id=order_id,
+                time_of_order=time_of_order,
+                order=cs.orders[order_id] if embed else None,
+                estimated_ready_in_s=COCKTAIL.eta.estimate(order_id, cs),
+            )
+            for time_of_order, order_id in page[:limit]
+        ],
+        next_cursor=next_cursor,
+    )
 
 
-@app.get("/orders")
-async def get_orders() -> List[OrderId]:
+@app.get("/stats/popular_recipes")
+async def get_popular_recipes(limit: int = 10) -> List[tuple[RecipeId, int]]:
     cs = COCKTAIL.persistence.get_current_state()
-    return [order.order_id for order in cs.orders.values()]
+    counts = cs.projections["by_recipe"].counts()
+    return sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit]
 
 
-@app.get("/slots")
-async def get_slots() -> List[SlotStatus]:
+@app.get("/stats/orders_per_hour")
+async def get_orders_per_hour() -> dict[datetime.datetime, int]:
     cs = COCKTAIL.persistence.get_current_state()
-    return [*cs.slots]
+    return cs.projections["per_hour"].counts()
+
+
+SLOTS_ADAPTER = TypeAdapter(List[SlotStatus])
+
+
+@app.get("/slots", response_model=List[SlotStatus])
+async def get_slots(request: Request) -> Response:
+    return cached_json_response(
+        request, "slots", lambda cs: SLOTS_ADAPTER.dump_json([*cs.slots])
+    )
 
 
 @app.post("/slot_refill")
 async def slot_refill(slot: SlotStatus):
-    COCKTAIL.api.refill_slot(slot)
+    await COCKTAIL.api.refill_slot(slot)
 
 
 @app.get("/recipe/{recipe_id}")
@@ -150,30 +477,106 @@ async def get_recipe_details(recipe_id: RecipeId) -> CocktailRecipe:
     return cs.recipes[recipe_id]
 
 
-@app.get("/recipes")
-async def get_recipes() -> List[RecipeId]:
-    cs = COCKTAIL.persistence.get_current_state()
-    return [*cs.recipes.keys()]
+RECIPE_IDS_ADAPTER = TypeAdapter(List[RecipeId])
+
+
+@app.get("/recipes", response_model=List[RecipeId])
+async def get_recipes(request: Request) -> Response:
+    return cached_json_response(
+        request, "recipes", lambda cs: RECIPE_IDS_ADAPTER.dump_json([*cs.recipes])
+    )
 
 
 @app.post("/create_recipe")
 async def create_recipe(recipe: CocktailRecipe):
-    COCKTAIL.api.create_recipe(recipe)
+    await COCKTAIL.api.create_recipe(recipe)
+
+
+# 429 with Retry-After (in s), when the queue is full
+def queue_full_response(e: QueueFullException) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=f"{e}, retry after {e.retry_after_in_s:.0f}s",
+        headers={"Retry-After": str(max(1, math.ceil(e.retry_after_in_s)))},
+    )
 
 
 @app.post("/place_order")
-async def place_order(recipe_id: RecipeId):
-    COCKTAIL.api.place_order(recipe_id)
+async def place_order(recipe_id: RecipeId, user_id: UserId | None = None) -> OrderId:
+    try:
+        return await COCKTAIL.api.place_order(recipe_id, user_id=user_id)
+    except QueueFullException as e:
+        raise queue_full_response(e)
 
 
 @app.post("/enqueue_order")
 async def enqueue_order(order_id: OrderId):
-    COCKTAIL.api.enqueue_order(order_id)
+    try:
+        await COCKTAIL.api.enqueue_order(order_id)
+    except OrderRejectedException as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except QueueFullException as e:
+        raise queue_full_response(e)
+
+
+# batch variants for the staff tablet: one state read and one commit per request,
+#   results are per item (in request order)
+@app.post("/place_orders")
+async def place_orders(
+    recipe_ids: List[RecipeId], enqueue: bool = False, user_id: UserId | None = None
+) -> List[BatchItemResult]:
+    return await COCKTAIL.api.place_orders(recipe_ids, enqueue=enqueue, user_id=user_id)
+
+
+@app.post("/enqueue_orders")
+async def enqueue_orders(order_ids: List[OrderId]) -> List[BatchItemResult]:
+    return await COCKTAIL.api.enqueue_orders(order_ids)
+
+
+@app.post("/slot_refills")
+async def slot_refills(slots: List[SlotStatus]) -> List[BatchItemResult]:
+    return await COCKTAIL.api.refill_slots(slots)
 
 
 @app.post("/cancel_order")
 async def cancel_order(order_id: OrderId):
-    COCKTAIL.api.cancel_order(order_id)
+    await COCKTAIL.api.cancel_order(order_id)
+
+
+@dataclass
+class EventPage:
+    events: List[LoggedEvent]
+    # pass as after to get the next page
+    next_cursor: int
+
+
+# change feed. consumers keep next_cursor and poll with it
+@app.get("/events")
+async def get_events(
+    after: int = 0, until: int | None = None, limit: int = EVENT_PAGE_LIMIT
+) -> EventPage:
+    limit = max(0, min(limit, EVENT_PAGE_LIMIT))
+    try:
+        events = COCKTAIL.persistence.read_events(after, until_seq=until, limit=limit)
+    except HistoryUnavailableException as e:
+        # the cursor is older than the kept history, the consumer has to resync
+        raise HTTPException(status_code=410, detail=str(e))
+    return EventPage(events=events, next_cursor=events[-1].seq if events else after)
+
+
+# bar state as of an event seq or a point in time, for incident analysis
+@app.get("/debug/state")
+async def get_state_at(
+    seq: int | None = None, at: datetime.datetime | None = None
+) -> CocktailBarState:
+    if (seq is None) == (at is None):
+        raise HTTPException(status_code=422, detail="pass exactly one of seq and at")
+    try:
+        return await asyncio.to_thread(
+            COCKTAIL.persistence.get_state_at, seq=seq, timestamp=to_local_time(at)
+        )
+    except HistoryUnavailableException as e:
+        raise HTTPException(status_code=404, detail=str(e))
 
 
 @dataclass
@@ -191,13 +594,12 @@ class CocktailSystemState:
     pump_status: PumpStatus
 
 
-@app.get("/system/status")
-async def get_system_status() -> CocktailSystemState:
+def system_state() -> CocktailSystemState:
     state = COCKTAIL.management.get_system().get_state()
     return CocktailSystemState(
         plan_progress=(
             PlanProgress(
-                plan_id=(state.plan_progress.plan.plan_id),
+                plan_id=(state.plan_progress.plan.plan_uuid),
                 queued_step_pos=state.plan_progress.queued_step_pos,
                 finished_step_pos=state.plan_progress.finished_step_pos,
             )
@@ -210,6 +612,34 @@ async def get_system_status() -> CocktailSystemState:
     )
 
 
+@app.get("/system/status")
+async def get_system_status() -> CocktailSystemState:
+    return system_state()
+
+
+SYSTEM_STATE_ADAPTER = TypeAdapter(CocktailSystemState)
+
+STATUS_BROADCASTER = StatusBroadcaster(
+    lambda: SYSTEM_STATE_ADAPTER.dump_python(system_state(), mode="json"),
+    max_rate_in_hz=STATUS_STREAM_MAX_RATE_IN_HZ,
+)
+
+
+# server sent events: the full system state, then the changed fields whenever
+#   status, plan progress, robot state or pump status change
+@app.get("/system/status/stream")
+async def stream_system_status() -> StreamingResponse:
+    return StreamingResponse(
+        STATUS_BROADCASTER.subscribe(), media_type="text/event-stream"
+    )
+
+
+# prometheus text exposition format
+@app.get("/metrics")
+async def get_metrics() -> Response:
+    return Response(content=REGISTRY.expose(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/system/abort")
 async def get_abort():
     COCKTAIL.management.get_system()._robot_.signal_stop()
@@ -0,0 +1,80 @@
+from pydantic.dataclasses import dataclass
+
+from cocktail_24.cocktail.cocktail_bookkeeping import (
+    CocktailBarState,
+    OrderStatus,
+    UserId,
+    CLOSED_ORDER_STATUSES,
+)
+
+OPEN_ORDER_STATUSES = frozenset(OrderStatus) - CLOSED_ORDER_STATUSES
+
+
+# limits for new orders. None disables a limit
+@dataclass(frozen=True)
+class AdmissionConfig:
+    # pending (queued or executing) orders in total
+    max_pending_orders: int | None = None
+    # open (not yet closed) orders per user
+    max_open_orders_per_user: int | None = None
+    # estimated wait for a new order: pending orders * service_time_in_s
+    max_wait_in_s: float | None = None
+    # estimated robot time per drink
+    service_time_in_s: float = 120.0
+
+
+class QueueFullException(Exception):
+
+    def __init__(self, reason: str, retry_after_in_s: float):
+        super().__init__(reason)
+        self.retry_after_in_s = retry_after_in_s
+
+
+# the robot's backlog. orders that were placed but never enqueued (or left
+#   behind by a queue purge) are not waited for, so they do not count
+def count_pending_orders(state: CocktailBarState) -> int:
+    executing = state.projections["by_status"].count(OrderStatus.executing)
+    return len(state.order_queue) + executing
+
+
+def count_open_orders_of(state: CocktailBarState, user_id: UserId) -> int:
+    return sum(
+        state.orders[order_id].status in OPEN_ORDER_STATUSES
+        for order_id in state.projections["by_user"].order_ids(user_id)
+    )
+
+
+# raises QueueFullException if one more order must not be placed. the counts
+#   are taken from the state plus the orders admitted since (within a batch).
+#   retry_after_in_s estimates when the limit is no longer exceeded, assuming one
+#   drink per service_time_in_s
+def check_admission(
+    config: AdmissionConfig,
+    n_pending_orders: int,
+    n_open_orders_of_user: int = 0,
+) -> None:
+    service_time_in_s = config.service_time_in_s
+    if (
+        config.max_pending_orders is not None
+        and n_pending_orders >= config.max_pending_orders
+    ):
+        n_too_many = n_pending_orders - config.max_pending_orders + 1
+        raise QueueFullException(
+            f"queue full ({n_pending_orders} pending orders)",
+            n_too_many * service_time_in_s,
+        )
+    if (
+        config.max_open_orders_per_user is not None
+        and n_open_orders_of_user >= config.max_open_orders_per_user
+    ):
+        n_too_many = n_open_orders_of_user - config.max_open_orders_per_user + 1
+        raise QueueFullException(
+            f"too many open orders of user ({n_open_orders_of_user})",
+            n_too_many * service_time_in_s,
+        )
+    estimated_wait_in_s = (n_pending_orders + 1) * service_time_in_s
+    if config.max_wait_in_s is not None and estimated_wait_in_s > config.max_wait_in_s:
+        raise QueueFullException(
+            f"estimated wait of {estimated_wait_in_s:.0f}s",
+            estimated_wait_in_s - config.max_wait_in_s,
+        )
@@ -0,0 +1,43 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+
+from cocktail_24.cocktail.cocktail_api import (
+    AsyncCocktailBarStatePersistence,
+    CocktailBarStatePersistence,
+    EventOccurrence,
+)
+from cocktail_24.cocktail.cocktail_bookkeeping import CocktailBarState
+from cocktail_24.cocktail.order_watch import OrderWatch
+
+
+# runs the blocking persist_events (commit, fsync) of a thread safe persistence on
+#   a worker thread, so the event loop (and with it the robot runtime) keeps going
+class ThreadOffloadedCocktailBarStatePersistence(AsyncCocktailBarStatePersistence):
+
+    def __init__(self, persistence: CocktailBarStatePersistence):
+        self._persistence_ = persistence
+        # a single thread keeps the order of submissions
+        self._executor_ = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="persistence"
+        )
+
+    async def persist_events(self, occurences: Iterable[EventOccurrence]) -> int | None:
+        occurences = [*occurences]
+        durable = await asyncio.get_running_loop().run_in_executor(
+            self._executor_, self._persistence_.persist_events, occurences
+        )
+        if durable is None:
+            return None
+        # write behind backends resolve once the group commit went through
+        return await asyncio.wrap_future(durable)
+
+    def get_current_state(self) -> CocktailBarState:
+        return self._persistence_.get_current_state()
+
+    @property
+    def order_watch(self) -> OrderWatch:
+        return self._persistence_.order_watch
+
+    def close(self) -> None:
+        self._executor_.shutdown()
@@ -1,12 +1,19 @@
 import datetime
 import json
+import logging
 import pickle
 import sqlite3
+import threading
+import time
 import uuid
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 
 # from dataclasses import dataclass
 from pydantic.dataclasses import dataclass
-from typing import Protocol, Iterable
+from typing import Protocol, Iterable, Sequence, get_args, Any
+
+from pydantic import TypeAdapter, ValidationError
 
 from cocktail_24.cocktail.cocktail_bookkeeping import (
     CocktailBarEvent,
@@ -20,14 +27,51 @@ from cocktail_24.cocktail.cocktail_bookkeeping import (
     OrderEnqueuedEvent,
     SlotStatus,
     SlotRefilledEvent,
+    SlotPath,
+    AmountPouredEvent,
+    OrderAbortedEvent,
+    OrderDequeuedEvent,
+    OrderFulfilledEvent,
+    OrderExecutingEvent,
+    Order,
+    OrderStatus,
+    CLOSED_ORDER_STATUSES,
+)
+from cocktail_24.cocktail.admission_control import (
+    AdmissionConfig,
+    QueueFullException,
+    check_admission,
+    count_open_orders_of,
+    count_pending_orders,
 )
 from cocktail_24.cocktail.cocktail_recipes import CocktailRecipe, RecipeId
+from cocktail_24.cocktail.event_codec import encode_event, decode_event
+from cocktail_24.cocktail.order_watch import OrderWatch
+from cocktail_24.metrics import REGISTRY, SIZE_BUCKETS
+from cocktail_24.cocktail.group_commit import (
+    WriteBehindConfig,
+    SqliteGroupCommitWriter,
+    SqliteWrites,
+    execute_writes,
+)
 from util import (
     check_pydantic_json_roundtrip,
     pydantic_dataclass_to_json,
     pydantic_dataclass_from_json,
 )
 
+PERSIST_SECONDS = REGISTRY.histogram(
+    "cocktail_persist_events_seconds",
+    "time to persist and apply a batch of events",
+    ("backend",),
+)
+PERSIST_BATCH_SIZE = REGISTRY.histogram(
+    "cocktail_persist_events_batch_size",
+    "events per persisted batch",
+    ("backend",),
+    buckets=SIZE_BUCKETS,
+)
+
 
 @dataclass(frozen=True)
 class EventOccurrence:
@@ -35,17 +79,62 @@ class EventOccurrence:
     timestamp: datetime.datetime
 
 
+# event_type tells events with the same fields apart, e.g. for json consumers
+@dataclass(frozen=True)
+class LoggedEvent:
+    seq: int
+    event_type: str
+    event: CocktailBarEvent
+    timestamp: datetime.datetime
+
+    @staticmethod
+    def from_event(
+        seq: int, timestamp: datetime.datetime, event: CocktailBarEvent
+    ) -> "LoggedEvent":
+        return LoggedEvent(
+            seq=seq,
+            event_type=type(event).__name__,
+            event=event,
+            timestamp=timestamp,
+        )
+
+
 class CocktailBarStatePersistence(Protocol):
 
-    def persist_events(self, occurences: Iterable[EventOccurrence]) -> None: ...
+    # backends that write behind return a future, that resolves once durable
+    def persist_events(
+        self, occurences: Iterable[EventOccurrence]
+    ) -> Future[int] | None: ...
 
     def get_current_state(self) -> CocktailBarState: ...
 
+    # notified with the orders changed by persisted events
+    order_watch: OrderWatch
+
+    # change feed: events with after_seq < seq <= until_seq, oldest first
+    def read_events(
+        self, after_seq: int, until_seq: int | None = None, limit: int | None = None
+    ) -> list[LoggedEvent]: ...
+
     # TODO
     # def snapshot(self):
     #     ...
 
 
+# for event loop callers: persisting must not block the loop
+class AsyncCocktailBarStatePersistence(Protocol):
+
+    # returns once the events are durable (with the last seq, if the backend
+    #   tracks them)
+    async def persist_events(
+        self, occurences: Iterable[EventOccurrence]
+    ) -> int | None: ...
+
+    def get_current_state(self) -> CocktailBarState: ...
+
+    order_watch: OrderWatch
+
+
 class InMemoryCocktailBarStatePersistence(CocktailBarStatePersistence):
 
     def __init__(self, initial_state: CocktailBarState | None = None):
@@ -53,60 +142,733 @@ class InMemoryCocktailBarStatePersistence(CocktailBarStatePersistence):
         self._state_ = CocktailBarState.apply_events([], initial_state)
         print(f"in mem initialized {self._state_}")
         self._events_ = []
+        self._lock_ = threading.Lock()
+        self.order_watch = OrderWatch()
+        self._persist_seconds_ = PERSIST_SECONDS.labels("memory")
+        self._persist_batch_size_ = PERSIST_BATCH_SIZE.labels("memory")
 
     def persist_events(self, occurences: Iterable[EventOccurrence]) -> None:
+        started = time.perf_counter()
         new_events = [(occ.timestamp, occ.event) for occ in occurences]
-        self._events_ += new_events
-        self._state_ = CocktailBarState.apply_events(new_events, self._state_)
+        changed_orders = []
+        with self._lock_:
+            self._events_ += new_events
+            self._state_ = CocktailBarState.apply_events(
+                new_events, self._state_, changed_orders.append
+            )
+        self.order_watch.notify(changed_orders)
+        self._persist_seconds_.observe(time.perf_counter() - started)
+        self._persist_batch_size_.observe(len(new_events))
         # print(f"in mem persisted {self._state_}")
 
     def get_current_state(self):
-        # DANGER RETURNING MUTABLE REFERENCE. DO NOT TOUCH MUTATE
+        # immutable version, safe to hold on to
         return self._state_
 
+    def read_events(
+        self, after_seq: int, until_seq: int | None = None, limit: int | None = None
+    ) -> list[LoggedEvent]:
+        # seq is the position in the list (starting at 1)
+        after_seq = max(after_seq, 0)
+        end = len(self._events_) if until_seq is None else until_seq
+        if limit is not None:
+            end = min(end, after_seq + limit)
+        return [
+            LoggedEvent.from_event(seq, timestamp, event)
+            for seq, (timestamp, event) in enumerate(
+                self._events_[after_seq:end], start=after_seq + 1
+            )
+        ]
+
+
+class HistoryUnavailableException(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class SnapshotConfig:
+    # snapshot after this many new events (0 disables periodic snapshots)
+    interval_in_events: int = 1000
+    # number of most recent snapshots to keep. None keeps all of them, so that
+    #   get_state_at never replays more than one interval. with a small number,
+    #   get_state_at for older seqs replays from the first event, or fails once
+    #   compact dropped the first events. compact drops the snapshots before its
+    #   history window anyway, so None keeps about history / interval of them
+    retention: int | None = 3
+
+
+_EVENT_TYPES_: dict[str, type] = {
+    event_type.__name__: event_type for event_type in get_args(CocktailBarEvent)
+}
+
+# only used to read payloads stored before the binary event codec
+_EVENT_ADAPTERS_: dict[str, TypeAdapter] = {
+    name: TypeAdapter(event_type) for name, event_type in _EVENT_TYPES_.items()
+}
+
+# largest sqlite integer
+_MAX_SEQ_ = 2**63 - 1
+
+_INSERT_EVENT_ = "INSERT INTO event_log VALUES(?, ?, ?, ?, ?, ?, ?, ?)"
+
+_EVENT_LOG_SCHEMA_ = (
+    """CREATE TABLE IF NOT EXISTS event_log (
+        seq INTEGER PRIMARY KEY,
+        event_type TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        order_id BLOB,
+        recipe_id BLOB,
+        station_id TEXT,
+        slot_id INTEGER,
+        payload BLOB NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS event_log_timestamp ON event_log (timestamp)",
+    "CREATE INDEX IF NOT EXISTS event_log_type ON event_log (event_type, timestamp)",
+    "CREATE INDEX IF NOT EXISTS event_log_order ON event_log (order_id)"
+    " WHERE order_id IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS event_log_recipe ON event_log (recipe_id)"
+    " WHERE recipe_id IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS event_log_slot ON event_log (station_id, slot_id)"
+    " WHERE station_id IS NOT NULL",
+)
+
+
+# (order_id, recipe_id, station_id, slot_id) columns of an event
+EventKeys = tuple[bytes | None, bytes | None, str | None, int | None]
+
+
+def _event_keys_(event: CocktailBarEvent) -> EventKeys:
+    match event:
+        case OrderPlacedEvent(order_id=order_id, recipe_id=recipe_id):
+            return order_id.bytes, recipe_id.bytes, None, None
+        case (
+            OrderCancelledEvent(order_id=order_id)
+            | OrderAbortedEvent(order_id=order_id)
+            | OrderEnqueuedEvent(order_id=order_id)
+            | OrderDequeuedEvent(order_id=order_id)
+            | OrderFulfilledEvent(order_id=order_id)
+            | OrderExecutingEvent(order_id=order_id)
+        ):
+            return order_id.bytes, None, None, None
+        case RecipeCreatedEvent(recipe=recipe):
+            return None, recipe.recipe_id.bytes, None, None
+        case AmountPouredEvent(slot_path=slot_path) | SlotRefilledEvent(
+            new_status=SlotStatus(slot_path=slot_path)
+        ):
+            return None, None, slot_path.station_id, slot_path.slot_id
+        case _:
+            return None, None, None, None
+
+
+def _encode_timestamp_(timestamp: datetime.datetime) -> str:
+    # fixed width, so that timestamps compare correctly as strings
+    return timestamp.isoformat(timespec="microseconds")
+
+
+def _encode_event_row_(
+    seq: int, timestamp: datetime.datetime, event: CocktailBarEvent
+) -> tuple:
+    return (
+        seq,
+        event.__class__.__name__,
+        _encode_timestamp_(timestamp),
+        *_event_keys_(event),
+        encode_event(event),
+    )
+
+
+def _decode_event_row_(
+    timestamp: str, event_type: str, payload: bytes
+) -> tuple[datetime.datetime, CocktailBarEvent]:
+    if payload[:1] == b"{":
+        event = _EVENT_ADAPTERS_[event_type].validate_json(payload)
+    else:
+        event = decode_event(payload)
+    return datetime.datetime.fromisoformat(timestamp), event
+
+
+# connection of a parallel replay worker process
+_replay_worker_con_: sqlite3.Connection | None = None
+
+
+def _init_replay_worker_(sqlite_file: str) -> None:
+    global _replay_worker_con_
+    _replay_worker_con_ = sqlite3.connect(sqlite_file)
+
+
+def _decode_seq_range_(
+    first_seq: int, end_seq: int
+) -> list[tuple[datetime.datetime, CocktailBarEvent]]:
+    rows = _replay_worker_con_.execute(
+        "SELECT timestamp, event_type, payload FROM event_log"
+        " WHERE seq >= ? AND seq < ? ORDER BY seq",
+        (first_seq, end_seq),
+    )
+    return [_decode_event_row_(*row) for row in rows]
+
+
+# drops the events up to the last snapshot before history_start, and the
+#   snapshots before that one
+def _drop_history_before_(
+    con: sqlite3.Connection, history_start: datetime.datetime
+) -> None:
+    (last_old_seq,) = con.execute(
+        "SELECT max(seq) FROM event_log WHERE timestamp < ?",
+        (_encode_timestamp_(history_start),),
+    ).fetchone()
+    if last_old_seq is None:
+        return
+    (boundary,) = con.execute(
+        "SELECT max(event_offset) FROM snapshots WHERE event_offset <= ?",
+        (last_old_seq,),
+    ).fetchone()
+    if boundary is None:
+        return
+    con.execute("DELETE FROM snapshots WHERE event_offset < ?", (boundary,))
+    con.execute("DELETE FROM event_log WHERE seq <= ?", (boundary,))
+
 
 # TODO this class is a quite generic event recorder and not cocktail related
 class SqliteCocktailBarStatePersistence(CocktailBarStatePersistence):
 
-    def __init__(self, sqlite_file: str):
-        # pass through to fill None
-        self._con_ = sqlite3.connect(sqlite_file)
-        self._con_.execute("CREATE TABLE IF NOT EXISTS events (data BLOB)")
+    def __init__(
+        self,
+        sqlite_file: str,
+        snapshot_config: SnapshotConfig = SnapshotConfig(),
+        write_behind: WriteBehindConfig | None = None,
+        replay_chunk_size: int = 10000,
+        replay_workers: int = 1,
+    ):
+        assert snapshot_config.retention is None or snapshot_config.retention >= 1
+        self._snapshot_config_ = snapshot_config
+        self._sqlite_file_ = sqlite_file
+        self._replay_chunk_size_ = replay_chunk_size
+        # a full replay (no usable snapshot) decodes in this many processes
+        self._replay_workers_ = replay_workers
+        self.order_watch = OrderWatch()
+        self._persist_seconds_ = PERSIST_SECONDS.labels("sqlite")
+        self._persist_batch_size_ = PERSIST_BATCH_SIZE.labels("sqlite")
+        # the connection of the writes without write behind (under the lock).
+        #   the group commit writer and the compaction write over their own
+        self._con_ = sqlite3.connect(sqlite_file, check_same_thread=False)
+        # readers run on many threads (api handlers, to_thread workers), each
+        #   reads over its own connection, so no read shares a connection (and
+        #   its open transaction) with a writer or another reader
+        self._readers_ = threading.local()
+        self._reader_cons_: list[sqlite3.Connection] = []
+        self._reader_cons_lock_ = threading.Lock()
+        for statement in _EVENT_LOG_SCHEMA_:
+            self._con_.execute(statement)
+        # event_offset: seq of the last event contained in the snapshot
+        self._con_.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots"
+            " (event_offset INTEGER PRIMARY KEY, created_at TEXT, data TEXT)"
+        )
+        self._con_.execute(
+            "CREATE TABLE IF NOT EXISTS archived_orders ("
+            " order_id BLOB PRIMARY KEY,"
+            " status TEXT NOT NULL,"
+            " ordered_by BLOB NOT NULL,"
+            " recipe_id BLOB NOT NULL,"
+            " time_of_order TEXT NOT NULL,"
+            " archived_at TEXT NOT NULL)"
+        )
+        self._migrate_pickled_events_()
+
+        self._state_, self._event_offset_, self._snapshot_offset_ = self._load_events_()
+
+        # serializes writers. readers do not lock
+        self._lock_ = threading.Lock()
+        self._writer_ = (
+            SqliteGroupCommitWriter(sqlite_file, write_behind)
+            if write_behind is not None
+            else None
+        )
+
+    def _migrate_pickled_events_(self) -> None:
+        # older databases stored pickled (timestamp, event) tuples in "events"
+        has_pickled_events = self._con_.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'events'"
+        ).fetchone()
+        if not has_pickled_events:
+            return
+        # keep rowids as seq, so that existing snapshot offsets stay valid
+        rows = self._con_.execute("SELECT rowid, data FROM events ORDER BY rowid")
+        with self._con_:
+            self._con_.executemany(
+                _INSERT_EVENT_,
+                (
+                    _encode_event_row_(rowid, *pickle.loads(data))
+                    for rowid, data in rows
+                ),
+            )
+            self._con_.execute("DROP TABLE events")
+        logging.warning("migrated pickled events to event_log")
 
-        self._state_ = self._load_events_()
+    def _load_latest_snapshot_(self) -> tuple[CocktailBarState | None, int]:
+        row = self._con_.execute(
+            "SELECT event_offset, data FROM snapshots"
+            " ORDER BY event_offset DESC LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None, 0
+        event_offset, data = row
+        try:
+            return (
+                CocktailBarState.load_snapshot(data).with_version(event_offset),
+                event_offset,
+            )
+        except ValidationError:
+            # e.g. the state schema changed since the snapshot was taken
+            (first_seq,) = self._con_.execute(
+                "SELECT min(seq) FROM event_log"
+            ).fetchone()
+            if event_offset > 0 and first_seq != 1:
+                # compacted log, the events before the snapshot are gone
+                raise
+            logging.warning(
+                f"snapshot at {event_offset} does not validate, replaying all events"
+            )
+            return None, 0
 
-    def _load_events_(self) -> CocktailBarState:
-        events = [
-            pickle.loads(row[0])
-            for row in self._con_.execute("SELECT * FROM events").fetchall()
+    def _replay_(
+        self,
+        con: sqlite3.Connection,
+        state: CocktailBarState | None,
+        after_seq: int,
+        until_seq: int | None = None,
+    ) -> tuple[CocktailBarState, int, int]:
+        # stream over the cursor, so only one chunk of events is in memory at a time
+        cursor = con.execute(
+            "SELECT seq, timestamp, event_type, payload FROM event_log"
+            " WHERE seq > ? AND seq <= ? ORDER BY seq",
+            (after_seq, until_seq if until_seq is not None else _MAX_SEQ_),
+        )
+        event_offset, n_events = after_seq, 0
+        while rows := cursor.fetchmany(self._replay_chunk_size_):
+            state = CocktailBarState.apply_events(
+                (_decode_event_row_(*row[1:]) for row in rows), state
+            )
+            event_offset = rows[-1][0]
+            n_events += len(rows)
+        return CocktailBarState.apply_events([], state), event_offset, n_events
+
+    def _replay_parallel_(self, after_seq: int) -> tuple[CocktailBarState, int, int]:
+        # decoding dominates a full replay, so decode seq ranges in worker
+        #   processes and apply them in order here
+        (last_seq,) = self._con_.execute("SELECT max(seq) FROM event_log").fetchone()
+        if last_seq is None:
+            return CocktailBarState.apply_events([]), after_seq, 0
+        state, n_events = None, 0
+        # bound the decoded but not yet applied ranges
+        max_pending = 2 * self._replay_workers_
+        pending = deque()
+        with ProcessPoolExecutor(
+            max_workers=self._replay_workers_,
+            initializer=_init_replay_worker_,
+            initargs=(self._sqlite_file_,),
+        ) as executor:
+            for first_seq in range(
+                after_seq + 1, last_seq + 1, self._replay_chunk_size_
+            ):
+                end_seq = min(first_seq + self._replay_chunk_size_, last_seq + 1)
+                pending.append(executor.submit(_decode_seq_range_, first_seq, end_seq))
+                if len(pending) >= max_pending:
+                    events = pending.popleft().result()
+                    state = CocktailBarState.apply_events(events, state)
+                    n_events += len(events)
+            while pending:
+                events = pending.popleft().result()
+                state = CocktailBarState.apply_events(events, state)
+                n_events += len(events)
+        return CocktailBarState.apply_events([], state), last_seq, n_events
+
+    def _load_events_(self) -> tuple[CocktailBarState, int, int]:
+        state, snapshot_offset = self._load_latest_snapshot_()
+        if state is None and self._replay_workers_ > 1:
+            state, event_offset, n_events = self._replay_parallel_(snapshot_offset)
+        else:
+            state, event_offset, n_events = self._replay_(
+                self._con_, state, snapshot_offset
+            )
+        logging.info(
+            f"loaded snapshot at {snapshot_offset} and replayed {n_events} events"
+        )
+        return state, event_offset, snapshot_offset
+
+    # the calling thread's read connection. closed by close(), so it may be
+    #   closed from another thread
+    def _reader_(self) -> sqlite3.Connection:
+        con = getattr(self._readers_, "con", None)
+        if con is None:
+            con = sqlite3.connect(self._sqlite_file_, check_same_thread=False)
+            with self._reader_cons_lock_:
+                self._reader_cons_.append(con)
+            self._readers_.con = con
+        return con
+
+    def _write_(self, writes: SqliteWrites, result: Any = None) -> Future:
+        if self._writer_ is not None:
+            return self._writer_.submit(writes, result)
+        with self._con_:
+            execute_writes(self._con_, writes)
+        future = Future()
+        future.set_result(result)
+        return future
+
+    def _store_events_(
+        self, events: list[tuple[datetime.datetime, CocktailBarEvent]]
+    ) -> Future[int]:
+        data = [
+            _encode_event_row_(self._event_offset_ + i, timestamp, event)
+            for i, (timestamp, event) in enumerate(events, start=1)
+        ]
+        durable = self._write_(
+            [(_INSERT_EVENT_, data)], self._event_offset_ + len(data)
+        )
+        self._event_offset_ += len(data)
+        return durable
+
+    def query_events(
+        self,
+        order_id: OrderId | None = None,
+        recipe_id: RecipeId | None = None,
+        slot_path: SlotPath | None = None,
+        event_type: type | None = None,
+        since: datetime.datetime | None = None,
+        until: datetime.datetime | None = None,
+    ) -> list[EventOccurrence]:
+        conditions, params = [], []
+        if order_id is not None:
+            conditions.append("order_id = ?")
+            params.append(order_id.bytes)
+        if recipe_id is not None:
+            conditions.append("recipe_id = ?")
+            params.append(recipe_id.bytes)
+        if slot_path is not None:
+            conditions.append("station_id = ? AND slot_id = ?")
+            params += [slot_path.station_id, slot_path.slot_id]
+        if event_type is not None:
+            conditions.append("event_type = ?")
+            params.append(event_type.__name__)
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            params.append(_encode_timestamp_(since))
+        if until is not None:
+            conditions.append("timestamp < ?")
+            params.append(_encode_timestamp_(until))
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._reader_().execute(
+            f"SELECT timestamp, event_type, payload FROM event_log{where} ORDER BY seq",
+            params,
+        )
+        return [
+            EventOccurrence(event=event, timestamp=timestamp)
+            for timestamp, event in (_decode_event_row_(*row) for row in rows)
         ]
-        return CocktailBarState.apply_events(events, None)
 
-    def _store_events_(self, events: list[EventOccurrence]) -> None:
-        data = [[pickle.dumps(event)] for event in events]
-        self._con_.executemany("INSERT INTO events VALUES(?)", data)
-        self._con_.commit()
+    # seq is the primary key, so this is a range scan on the rowid. only
+    #   durable events are returned (pending write behind batches are not)
+    def read_events(
+        self, after_seq: int, until_seq: int | None = None, limit: int | None = None
+    ) -> list[LoggedEvent]:
+        after_seq = max(after_seq, 0)
+        con = self._reader_()
+        rows = con.execute(
+            "SELECT seq, timestamp, event_type, payload FROM event_log"
+            " WHERE seq > ? AND seq <= ? ORDER BY seq LIMIT ?",
+            (
+                after_seq,
+                until_seq if until_seq is not None else self._event_offset_,
+                limit if limit is not None else -1,
+            ),
+        ).fetchall()
+        # compaction dropped the events before the first kept one, a cursor
+        #   before them would silently skip them. checked against the page read,
+        #   so a compaction between two queries cannot open a gap
+        if rows:
+            first_seq = rows[0][0]
+        else:
+            (first_seq,) = con.execute("SELECT min(seq) FROM event_log").fetchone()
+            if first_seq is None:
+                first_seq = self._event_offset_ + 1
+        if after_seq < first_seq - 1:
+            raise HistoryUnavailableException(
+                f"events after {after_seq} were compacted, the log starts at {first_seq}"
+            )
+        return [
+            LoggedEvent.from_event(seq, *_decode_event_row_(*row)) for seq, *row in rows
+        ]
 
-    def persist_events(self, occurences: Iterable[EventOccurrence]) -> None:
+    # state after the event seq, or after the last event at or before timestamp.
+    #   starts from the closest snapshot, so with all snapshots retained at most
+    #   one snapshot interval is replayed. history before the last compaction is
+    #   gone
+    def get_state_at(
+        self,
+        seq: int | None = None,
+        timestamp: datetime.datetime | None = None,
+    ) -> CocktailBarState:
+        assert (seq is None) != (timestamp is None)
+        con = self._reader_()
+        if timestamp is not None:
+            row = con.execute(
+                "SELECT seq FROM event_log WHERE timestamp <= ?"
+                " ORDER BY timestamp DESC, seq DESC LIMIT 1",
+                (_encode_timestamp_(timestamp),),
+            ).fetchone()
+            seq = row[0] if row is not None else 0
+        seq = min(seq, self._event_offset_)
+        row = con.execute(
+            "SELECT event_offset, data FROM snapshots WHERE event_offset <= ?"
+            " ORDER BY event_offset DESC LIMIT 1",
+            (seq,),
+        ).fetchone()
+        if row is not None:
+            snapshot_offset, data = row
+            state = CocktailBarState.load_snapshot(data).with_version(snapshot_offset)
+        else:
+            (first_seq,) = con.execute("SELECT min(seq) FROM event_log").fetchone()
+            if seq > 0 and first_seq != 1:
+                raise HistoryUnavailableException(
+                    f"no snapshot at or before {seq} and the log starts at {first_seq}"
+                )
+            snapshot_offset, state = 0, None
+        state, _event_offset, _n_events = self._replay_(
+            con, state, snapshot_offset, seq
+        )
+        return state
+
+    @staticmethod
+    def _snapshot_row_(
+        event_offset: int, state: CocktailBarState
+    ) -> tuple[int, str, str]:
+        return (
+            event_offset,
+            datetime.datetime.now().isoformat(),
+            state.json_snapshot(),
+        )
+
+    # called under the lock. only the (immutable) state is taken here, with write
+    #   behind it is serialized on the writer thread, so persist_events does not
+    #   pay for the O(state) json every interval_in_events
+    def _write_snapshot_(self) -> Future:
+        event_offset, state = self._event_offset_, self._state_
+        durable = self._write_(
+            [
+                (
+                    "INSERT OR REPLACE INTO snapshots VALUES(?, ?, ?)",
+                    lambda: [self._snapshot_row_(event_offset, state)],
+                ),
+                (
+                    "DELETE FROM snapshots WHERE event_offset NOT IN"
+                    " (SELECT event_offset FROM snapshots"
+                    " ORDER BY event_offset DESC LIMIT ?)",
+                    # LIMIT -1 is no limit
+                    [(self._snapshot_config_.retention or -1,)],
+                ),
+            ],
+        )
+        self._snapshot_offset_ = self._event_offset_
+        return durable
+
+    def snapshot(self) -> None:
+        with self._lock_:
+            durable = self._write_snapshot_()
+        durable.result()
+
+    def _check_snapshot_(self) -> None:
+        interval = self._snapshot_config_.interval_in_events
+        if interval > 0 and self._event_offset_ - self._snapshot_offset_ >= interval:
+            self._write_snapshot_()
+
+    # with write behind, the state is updated right away and the returned future
+    #   resolves to the last seq once the events are committed
+    def persist_events(self, occurences: Iterable[EventOccurrence]) -> Future[int]:
+        started = time.perf_counter()
         occurences = [*occurences]
         new_events = [(occ.timestamp, occ.event) for occ in occurences]
-        self._store_events_(new_events)
-        self._state_ = CocktailBarState.apply_events(new_events, self._state_)
+        changed_orders = []
+        with self._lock_:
+            durable = self._store_events_(new_events)
+            self._state_ = CocktailBarState.apply_events(
+                new_events, self._state_, changed_orders.append
+            )
+            self._check_snapshot_()
+        # with write behind before the commit, like the new state
+        self.order_watch.notify(changed_orders)
+        self._persist_seconds_.observe(time.perf_counter() - started)
+        self._persist_batch_size_.observe(len(new_events))
+        return durable
+
+    # moves orders that closed more than retention ago to archived_orders (the
+    #   new live state is snapshotted), and drops the events and snapshots older
+    #   than history (at least retention). the change feed and get_state_at keep
+    #   reaching back over history: events are only dropped up to a snapshot, so
+    #   every later seq can still be reconstructed. older snapshots keep the
+    #   archived orders, as they were at their seq. the management persists
+    #   from the robot loop under the lock, so the lock is only taken to read
+    #   and to swap the state: the rest works on the state as of event_offset
+    #   on its own connection (closed orders do not change anymore)
+    def compact(
+        self,
+        retention: datetime.timedelta,
+        now: datetime.datetime | None = None,
+        history: datetime.timedelta | None = None,
+    ) -> int:
+        now = now if now is not None else datetime.datetime.now()
+        history = max(history, retention) if history is not None else retention
+        closed_before = now - retention
+        with self._lock_:
+            state, event_offset = self._state_, self._event_offset_
+        # so that the events up to event_offset are committed
+        self.flush()
+        con = sqlite3.connect(self._sqlite_file_)
+        try:
+            # orders with events since closed_before closed later (if at all).
+            #   orders without events closed before the kept history
+            recently_changed = {
+                uuid.UUID(bytes=order_id)
+                for (order_id,) in con.execute(
+                    "SELECT order_id FROM event_log"
+                    " WHERE timestamp >= ? AND order_id IS NOT NULL"
+                    " GROUP BY order_id",
+                    (_encode_timestamp_(closed_before),),
+                )
+            }
+            to_archive = [
+                order
+                for order in state.orders.values()
+                # closing comes after ordering, so the time of order prefilters
+                if order.status in CLOSED_ORDER_STATUSES
+                and order.time_of_order < closed_before
+                and order.order_id not in recently_changed
+            ]
+            if to_archive:
+                state = state.remove_orders(order.order_id for order in to_archive)
+            with con:
+                if to_archive:
+                    con.executemany(
+                        "INSERT OR REPLACE INTO archived_orders"
+                        " VALUES(?, ?, ?, ?, ?, ?)",
+                        [
+                            (
+                                order.order_id.bytes,
+                                order.status.value,
+                                order.ordered_by.bytes,
+                                order.recipe_id.bytes,
+                                _encode_timestamp_(order.time_of_order),
+                                now.isoformat(),
+                            )
+                            for order in to_archive
+                        ],
+                    )
+                    con.execute(
+                        "INSERT OR REPLACE INTO snapshots VALUES(?, ?, ?)",
+                        self._snapshot_row_(event_offset, state),
+                    )
+                _drop_history_before_(con, now - history)
+        finally:
+            con.close()
+        # only once committed, so state and database do not diverge
+        if to_archive:
+            with self._lock_:
+                if self._event_offset_ != event_offset:
+                    state = self._state_.remove_orders(
+                        order.order_id for order in to_archive
+                    )
+                self._state_ = state
+                if self._snapshot_offset_ > event_offset:
+                    # taken meanwhile, with the archived orders still in it
+                    self._write_snapshot_()
+                else:
+                    self._snapshot_offset_ = event_offset
+        logging.info(f"archived {len(to_archive)} orders")
+        return len(to_archive)
+
+    # slow path for orders, that were compacted out of the live state
+    def get_archived_order(self, order_id: OrderId) -> Order | None:
+        row = (
+            self._reader_()
+            .execute(
+                "SELECT status, ordered_by, recipe_id, time_of_order"
+                " FROM archived_orders WHERE order_id = ?",
+                (order_id.bytes,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        status, ordered_by, recipe_id, time_of_order = row
+        return Order(
+            order_id=order_id,
+            status=OrderStatus(status),
+            ordered_by=uuid.UUID(bytes=ordered_by),
+            recipe_id=uuid.UUID(bytes=recipe_id),
+            time_of_order=datetime.datetime.fromisoformat(time_of_order),
+        )
+
+    # wait until everything persisted so far is durable
+    def flush(self) -> None:
+        if self._writer_ is not None:
+            self._writer_.flush()
+
+    def close(self) -> None:
+        if self._writer_ is not None:
+            self._writer_.close()
+        self._con_.close()
+        with self._reader_cons_lock_:
+            for con in self._reader_cons_:
+                con.close()
+            self._reader_cons_.clear()
 
     def get_current_state(self):
-        # DANGER RETURNING MUTABLE REFERENCE. DO NOT TOUCH MUTATE
+        # immutable version, safe to hold on to
         return self._state_
 
 
+# raised when an order cannot be enqueued (unknown, closed, executing or
+#   already queued)
+class OrderRejectedException(Exception):
+    pass
+
+
+# why order_id cannot be enqueued in state, None if it can
+def _enqueue_error_(state: CocktailBarState, order_id: OrderId) -> str | None:
+    order = state.orders.get(order_id)
+    if order is None:
+        return f"unknown order {order_id}"
+    if order.status in CLOSED_ORDER_STATUSES or order.status == OrderStatus.executing:
+        return f"order {order_id} is {order.status.value}"
+    if order_id in state.order_queue:
+        return f"order {order_id} is already enqueued"
+    return None
+
+
+# outcome of one item of a batch request
+@dataclass(frozen=True)
+class BatchItemResult:
+    # why the item was rejected, None if it was accepted
+    error: str | None = None
+    order_id: OrderId | None = None
+    # set if the order was rejected by admission control
+    retry_after_in_s: float | None = None
+
+
 class CocktailApi:
 
-    def __init__(self, state_persistence: CocktailBarStatePersistence):
+    def __init__(
+        self,
+        state_persistence: AsyncCocktailBarStatePersistence,
+        admission: AdmissionConfig = AdmissionConfig(),
+    ):
         self._state_persistence_ = state_persistence
+        self._admission_ = admission
 
     def _get_current_time_(self):
         return datetime.datetime.now()
 
-    def create_recipe(
+    async def create_recipe(
         self,
         recipe: CocktailRecipe,
     ):
@@ -114,32 +876,43 @@ class CocktailApi:
         user_id = UserId(uuid.uuid4())
         assert recipe.recipe_id not in current_state.recipes
         created_event = RecipeCreatedEvent(recipe=recipe, creator_user_id=user_id)
-        self._state_persistence_.persist_events(
+        await self._state_persistence_.persist_events(
             [EventOccurrence(event=created_event, timestamp=self._get_current_time_())]
         )
 
-    def place_order(self, recipe_id: RecipeId) -> OrderId:
+    # raises QueueFullException when admission control rejects the order. orders
+    #   without user_id only count towards the global limits
+    async def place_order(
+        self, recipe_id: RecipeId, user_id: UserId | None = None
+    ) -> OrderId:
         current_state = self._state_persistence_.get_current_state()
-        user_id = UserId(uuid.uuid4())
         assert recipe_id in current_state.recipes
+        check_admission(
+            self._admission_,
+            count_pending_orders(current_state),
+            count_open_orders_of(current_state, user_id) if user_id is not None else 0,
+        )
+        if user_id is None:
+            user_id = UserId(uuid.uuid4())
         order_id = OrderId(uuid.uuid4())
         order_placed_event = OrderPlacedEvent(
             order_id=order_id, recipe_id=recipe_id, user_id=user_id
         )
-        self._state_persistence_.persist_events(
+        await self._state_persistence_.persist_events(
             [
                 EventOccurrence(
                     event=order_placed_event, timestamp=self._get_current_time_()
                 )
             ]
         )
+        return order_id
 
-    def cancel_order(self, order_id: OrderId):
+    async def cancel_order(self, order_id: OrderId):
         current_state = self._state_persistence_.get_current_state()
 
         assert order_id in current_state.orders
         order_cancelled_event = OrderCancelledEvent(order_id=order_id)
-        self._state_persistence_.persist_events(
+        await self._state_persistence_.persist_events(
             [
                 EventOccurrence(
                     event=order_cancelled_event, timestamp=self._get_current_time_()
@@ -147,8 +920,8 @@ class CocktailApi:
             ]
         )
 
-    def purge_queue(self):
-        self._state_persistence_.persist_events(
+    async def purge_queue(self):
+        await self._state_persistence_.persist_events(
             [
                 EventOccurrence(
                     event=QueuePurgedEvent(), timestamp=self._get_current_time_()
@@ -156,8 +929,17 @@ class CocktailApi:
             ]
         )
 
-    def enqueue_order(self, order_id: OrderId):
-        self._state_persistence_.persist_events(
+    # raises OrderRejectedException if the order cannot be enqueued, and
+    #   QueueFullException when admission control rejects it. enqueueing is what
+    #   makes an order pending, so the global limits bound the queue here (also
+    #   for orders placed without user_id, which escape the per user limit)
+    async def enqueue_order(self, order_id: OrderId):
+        current_state = self._state_persistence_.get_current_state()
+        error = _enqueue_error_(current_state, order_id)
+        if error is not None:
+            raise OrderRejectedException(error)
+        check_admission(self._admission_, count_pending_orders(current_state))
+        await self._state_persistence_.persist_events(
             [
                 EventOccurrence(
                     event=OrderEnqueuedEvent(order_id=order_id),
@@ -166,8 +948,8 @@ class CocktailApi:
             ]
         )
 
-    def refill_slot(self, status: SlotStatus):
-        self._state_persistence_.persist_events(
+    async def refill_slot(self, status: SlotStatus):
+        await self._state_persistence_.persist_events(
             [
                 EventOccurrence(
                     event=SlotRefilledEvent(new_status=status),
@@ -175,3 +957,106 @@ class CocktailApi:
                 )
             ]
         )
+
+    # batch variants: validated against one state read, accepted items are
+    #   persisted as one event batch (one commit)
+
+    async def _persist_batch_(self, events: list[CocktailBarEvent]) -> None:
+        if not events:
+            return
+        timestamp = self._get_current_time_()
+        await self._state_persistence_.persist_events(
+            [EventOccurrence(event=event, timestamp=timestamp) for event in events]
+        )
+
+    async def place_orders(
+        self,
+        recipe_ids: Sequence[RecipeId],
+        enqueue: bool = False,
+        user_id: UserId | None = None,
+    ) -> list[BatchItemResult]:
+        current_state = self._state_persistence_.get_current_state()
+        n_pending_orders = count_pending_orders(current_state)
+        n_open_orders_of_user = (
+            count_open_orders_of(current_state, user_id) if user_id is not None else 0
+        )
+        events, results = [], []
+        for recipe_id in recipe_ids:
+            if recipe_id not in current_state.recipes:
+                results.append(BatchItemResult(error=f"unknown recipe {recipe_id}"))
+                continue
+            try:
+                check_admission(
+                    self._admission_, n_pending_orders, n_open_orders_of_user
+                )
+            except QueueFullException as e:
+                results.append(
+                    BatchItemResult(error=str(e), retry_after_in_s=e.retry_after_in_s)
+                )
+                continue
+            if user_id is not None:
+                n_open_orders_of_user += 1
+            order_id = OrderId(uuid.uuid4())
+            events.append(
+                OrderPlacedEvent(
+                    order_id=order_id,
+                    recipe_id=recipe_id,
+                    user_id=user_id if user_id is not None else UserId(uuid.uuid4()),
+                )
+            )
+            if enqueue:
+                events.append(OrderEnqueuedEvent(order_id=order_id))
+                n_pending_orders += 1
+            results.append(BatchItemResult(order_id=order_id))
+        await self._persist_batch_(events)
+        return results
+
+    async def enqueue_orders(
+        self, order_ids: Sequence[OrderId]
+    ) -> list[BatchItemResult]:
+        current_state = self._state_persistence_.get_current_state()
+        n_pending_orders = count_pending_orders(current_state)
+        events, results = [], []
+        enqueued = set()
+        for order_id in order_ids:
+            if order_id in enqueued:
+                error = f"order {order_id} is already enqueued"
+            else:
+                error = _enqueue_error_(current_state, order_id)
+            if error is not None:
+                results.append(BatchItemResult(error=error, order_id=order_id))
+                continue
+            try:
+                check_admission(self._admission_, n_pending_orders)
+            except QueueFullException as e:
+                results.append(
+                    BatchItemResult(
+                        error=str(e),
+                        order_id=order_id,
+                        retry_after_in_s=e.retry_after_in_s,
+                    )
+                )
+                continue
+            n_pending_orders += 1
+            enqueued.add(order_id)
+            events.append(OrderEnqueuedEvent(order_id=order_id))
+            results.append(BatchItemResult(order_id=order_id))
+        await self._persist_batch_(events)
+        return results
+
+    async def refill_slots(
+        self, statuses: Sequence[SlotStatus]
+    ) -> list[BatchItemResult]:
+        events, results = [], []
+        refilled = set()
+        for status in statuses:
+            if status.slot_path in refilled:
+                results.append(
+                    BatchItemResult(error=f"slot {status.slot_path} refilled twice")
+                )
+                continue
+            refilled.add(status.slot_path)
+            events.append(SlotRefilledEvent(new_status=status))
+            results.append(BatchItemResult())
+        await self._persist_batch_(events)
+        return results
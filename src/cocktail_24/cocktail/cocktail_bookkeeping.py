@@ -1,17 +1,43 @@
+import dataclasses
 import datetime
 import logging
+import time
 import uuid
 from enum import Enum
-from typing import NewType, Iterable
+from itertools import islice
+from typing import NewType, Iterable, Iterator, Any, Mapping, Callable
 
-from pydantic import RootModel
+from pydantic import RootModel, GetCoreSchemaHandler
+from pydantic_core import core_schema
 
 # from dataclasses import dataclass
 from pydantic.dataclasses import dataclass
 
-from cocktail_24.cocktail.cocktail_recipes import IngredientId, CocktailRecipe, RecipeId
+from cocktail_24.cocktail.cocktail_recipes import (
+    IngredientId,
+    CocktailRecipe,
+    RecipeId,
+    IngredientAmount,
+)
+from cocktail_24.cocktail.order_projections import (
+    OrderProjection,
+    OrderProjections,
+    OrderIndex,
+    OrderCountByTime,
+    OrderTimeline,
+)
+from cocktail_24.cocktail.persistent_map import PersistentMap
+from cocktail_24.cocktail.persistent_sorted_set import PersistentSortedSet
+from cocktail_24.metrics import REGISTRY
 from cocktail_24.recipe_samples import TypicalIngredients, SampleRecipes
 
+# rate(applied events) is the apply throughput
+APPLIED_EVENTS = REGISTRY.counter(
+    "cocktail_applied_events_total", "events applied to the bar state"
+)
+APPLY_SECONDS = REGISTRY.histogram(
+    "cocktail_apply_events_seconds", "time to apply a batch of events"
+)
 
 OrderId = NewType("OrderId", uuid.UUID)
 UserId = NewType("UserId", uuid.UUID)
@@ -48,6 +74,125 @@ class SlotStatus:
         )
 
 
+# station_id -> slot_id -> what is left in the slot
+SlotLookup = Mapping[str, Mapping[int, IngredientAmount]]
+
+
+# immutable: updates return a new inventory sharing the untouched parts. slots
+#   are keyed by path, with a per station lookup of the amounts kept up to date
+#   on every change. iterates (and serializes as a plain list of slot status)
+#   in the order of the first refill of each slot
+class SlotInventory:
+    __slots__ = ("_slots_", "_station_amounts_", "_order_")
+
+    def __init__(
+        self,
+        slots: Iterable[SlotStatus] = (),
+        *,
+        _slots_: PersistentMap[SlotPath, SlotStatus] | None = None,
+        _station_amounts_: (
+            PersistentMap[str, PersistentMap[int, IngredientAmount]] | None
+        ) = None,
+        _order_: PersistentSortedSet | None = None,
+    ):
+        self._slots_ = _slots_ if _slots_ is not None else PersistentMap()
+        self._station_amounts_ = (
+            _station_amounts_ if _station_amounts_ is not None else PersistentMap()
+        )
+        # (position, slot_path). slots are never removed, so the number of slots
+        #   at the first refill is a unique position and paths are never compared
+        self._order_ = _order_ if _order_ is not None else PersistentSortedSet()
+        if slots:
+            updated = self.mutate()
+            for status in slots:
+                updated = updated.update(status)
+            updated = updated.finish()
+            self._slots_, self._station_amounts_, self._order_ = (
+                updated._slots_,
+                updated._station_amounts_,
+                updated._order_,
+            )
+
+    def update(self, status: SlotStatus) -> "SlotInventory":
+        slot_path = status.slot_path
+        station_amounts = self._station_amounts_.get(
+            slot_path.station_id, PersistentMap()
+        ).set(
+            slot_path.slot_id,
+            IngredientAmount(
+                ingredient=status.ingredient_id,
+                amount_in_ml=status.available_amount_in_ml,
+            ),
+        )
+        order = self._order_
+        if slot_path not in self._slots_:
+            order = order.add((len(self._slots_), slot_path))
+        return SlotInventory(
+            _slots_=self._slots_.set(slot_path, status),
+            _station_amounts_=self._station_amounts_.set(
+                slot_path.station_id, station_amounts
+            ),
+            _order_=order,
+        )
+
+    # for batches of updates (see MapMutation)
+    def mutate(self) -> "SlotInventory":
+        return SlotInventory(
+            _slots_=self._slots_.mutate(),
+            _station_amounts_=self._station_amounts_.mutate(),
+            _order_=self._order_.mutate(),
+        )
+
+    def finish(self) -> "SlotInventory":
+        return SlotInventory(
+            _slots_=self._slots_.finish(),
+            _station_amounts_=self._station_amounts_.finish(),
+            _order_=self._order_.finish(),
+        )
+
+    def get(self, slot_path: SlotPath) -> SlotStatus | None:
+        return self._slots_.get(slot_path)
+
+    # immutable, so planners can use it as is
+    def station_amounts(self) -> SlotLookup:
+        return self._station_amounts_
+
+    def __contains__(self, slot_path: SlotPath) -> bool:
+        return slot_path in self._slots_
+
+    def __iter__(self) -> Iterator[SlotStatus]:
+        return (self._slots_[slot_path] for _position, slot_path in self._order_)
+
+    def __len__(self) -> int:
+        return len(self._slots_)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, SlotInventory):
+            return NotImplemented
+        return self._slots_ == other._slots_
+
+    def __repr__(self) -> str:
+        return f"SlotInventory({[*self]})"
+
+    @classmethod
+    def __get_pydantic_core_schema__(
+        cls, source: Any, handler: GetCoreSchemaHandler
+    ) -> core_schema.CoreSchema:
+        slots_schema = handler.generate_schema(list[SlotStatus])
+        from_slots_schema = core_schema.no_info_after_validator_function(
+            cls, slots_schema
+        )
+        return core_schema.json_or_python_schema(
+            json_schema=from_slots_schema,
+            python_schema=core_schema.union_schema(
+                [core_schema.is_instance_schema(cls), from_slots_schema]
+            ),
+            serialization=core_schema.plain_serializer_function_ser_schema(
+                list, return_schema=slots_schema
+            ),
+        )
+
+
 @dataclass(frozen=True)
 class SlotRefilledEvent:
     new_status: SlotStatus
@@ -136,6 +281,12 @@ class OrderStatus(Enum):
     dequeued = "dequeued"
 
 
+# orders in these states do not change anymore
+CLOSED_ORDER_STATUSES = frozenset(
+    (OrderStatus.fulfilled, OrderStatus.cancelled, OrderStatus.aborted)
+)
+
+
 @dataclass(frozen=True)
 class Order:
     order_id: OrderId
@@ -156,118 +307,241 @@ class Order:
         )
 
 
-@dataclass
-class CocktailBarState:
-    order_queue: tuple[OrderId, ...]
-    slots: list[SlotStatus]
+# immutable fifo of order ids. every queued id gets an increasing ticket and the
+#   (ticket, id) pairs are kept sorted, so append, remove by id and peek at
+#   either end are O(log n) and iterating needs no sort. reads like a tuple and
+#   serializes as a plain list of ids
+class OrderQueue:
+    __slots__ = ("_tickets_", "_queued_", "_next_ticket_")
+
+    def __init__(
+        self,
+        order_ids: Iterable[OrderId] = (),
+        *,
+        _tickets_: PersistentMap[OrderId, int] | None = None,
+        _queued_: PersistentSortedSet | None = None,
+        _next_ticket_: int = 0,
+    ):
+        self._tickets_ = _tickets_ if _tickets_ is not None else PersistentMap()
+        # (ticket, order_id), tickets are unique so ids are never compared
+        self._queued_ = _queued_ if _queued_ is not None else PersistentSortedSet()
+        self._next_ticket_ = _next_ticket_
+        if order_ids:
+            queue = self.mutate()
+            for order_id in order_ids:
+                queue = queue.append(order_id)
+            queue = queue.finish()
+            self._tickets_, self._queued_ = queue._tickets_, queue._queued_
+            self._next_ticket_ = queue._next_ticket_
+
+    def _replace_(
+        self,
+        tickets: PersistentMap[OrderId, int],
+        queued: PersistentSortedSet,
+        next_ticket: int,
+    ) -> "OrderQueue":
+        return OrderQueue(_tickets_=tickets, _queued_=queued, _next_ticket_=next_ticket)
+
+    def append(self, order_id: OrderId) -> "OrderQueue":
+        # an order is queued at most once, at its first position
+        if order_id in self._tickets_:
+            return self
+        return self._replace_(
+            self._tickets_.set(order_id, self._next_ticket_),
+            self._queued_.add((self._next_ticket_, order_id)),
+            self._next_ticket_ + 1,
+        )
 
-    orders: dict[OrderId, Order]
+    def remove(self, order_id: OrderId) -> "OrderQueue":
+        ticket = self._tickets_.get(order_id)
+        if ticket is None:
+            return self
+        return self._replace_(
+            self._tickets_.delete(order_id),
+            self._queued_.discard((ticket, order_id)),
+            self._next_ticket_,
+        )
 
-    recipes: dict[RecipeId, CocktailRecipe]
+    def clear(self) -> "OrderQueue":
+        return self._replace_(
+            PersistentMap(), PersistentSortedSet(), self._next_ticket_
+        )
 
-    def handle_refilled(self, refilled: SlotRefilledEvent):
-        location = next(
-            (
-                i
-                for i, status in enumerate(self.slots)
-                if status.slot_path == refilled.new_status.slot_path
-            ),
-            None,
+    # for batches of updates (see MapMutation)
+    def mutate(self) -> "OrderQueue":
+        return self._replace_(
+            self._tickets_.mutate(), self._queued_.mutate(), self._next_ticket_
         )
-        if location is None:
-            self.slots += [refilled.new_status]
+
+    def finish(self) -> "OrderQueue":
+        return self._replace_(
+            self._tickets_.finish(), self._queued_.finish(), self._next_ticket_
+        )
+
+    def peek(self) -> OrderId | None:
+        head = self._queued_.first()
+        return head[1] if head is not None else None
+
+    # tickets follow the enqueue order and are never reused, so an order queued
+    #   again after a purge gets a new one
+    def ticket(self, order_id: OrderId) -> int | None:
+        return self._tickets_.get(order_id)
+
+    # O(log n) at either end, O(index) in between
+    def __getitem__(self, index: int) -> OrderId:
+        if not -len(self) <= index < len(self):
+            raise IndexError("order queue index out of range")
+        if index == 0:
+            return self.peek()
+        if index == -1:
+            return self._queued_.last()[1]
+        if index < 0:
+            entries = islice(self._queued_.range(reverse=True), -index - 1, None)
         else:
-            self.slots[location] = refilled.new_status
+            entries = islice(self._queued_, index, None)
+        return next(entries)[1]
 
-    def handle_poured(self, poured: AmountPouredEvent):
-        location = next(
-            (
-                i
-                for i, status in enumerate(self.slots)
-                if status.slot_path == poured.slot_path
+    def __contains__(self, order_id: OrderId) -> bool:
+        return order_id in self._tickets_
+
+    def __iter__(self) -> Iterator[OrderId]:
+        return (order_id for _ticket, order_id in self._queued_)
+
+    def __len__(self) -> int:
+        return len(self._tickets_)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, OrderQueue):
+            return NotImplemented
+        return [*self] == [*other]
+
+    def __repr__(self) -> str:
+        return f"OrderQueue({[*self]})"
+
+    @classmethod
+    def __get_pydantic_core_schema__(
+        cls, source: Any, handler: GetCoreSchemaHandler
+    ) -> core_schema.CoreSchema:
+        order_ids_schema = handler.generate_schema(list[OrderId])
+        from_order_ids_schema = core_schema.no_info_after_validator_function(
+            cls, order_ids_schema
+        )
+        return core_schema.json_or_python_schema(
+            json_schema=from_order_ids_schema,
+            python_schema=core_schema.union_schema(
+                [core_schema.is_instance_schema(cls), from_order_ids_schema]
+            ),
+            serialization=core_schema.plain_serializer_function_ser_schema(
+                list, return_schema=order_ids_schema
             ),
-            None,
         )
-        if location is None:
-            logging.error(f"registered pour for non-existent slot {poured}")
-        else:
-            self.slots[location] = self.slots[location].pour(
-                poured.amount_in_ml
-            )  # .available_amount_in_ml -= poured.amount_in_ml
 
-    def handle_order_placed(
-        self, order_placed: OrderPlacedEvent, time_of_event: datetime.datetime
-    ):
-        if order_placed.order_id not in self.orders:
-            # noinspection PyTypeChecker
-            self.orders[order_placed.order_id] = Order(
-                order_id=order_placed.order_id,
-                status=OrderStatus.ordered,
-                ordered_by=order_placed.user_id,
-                recipe_id=order_placed.recipe_id,
-                time_of_order=time_of_event,
-            )
-        else:
-            logging.error((f"tried to readd existing order {order_placed}"))
 
-    def handle_order_status_change(self, order_id, new_state: OrderStatus):
-        if order_id in self.orders:
-            self.orders[order_id] = self.orders[order_id].update_status(new_state)
-        else:
-            logging.warning(
-                (f"tried to mark nonexisting order {order_id=} {new_state=}")
-            )
-        self.order_queue = tuple(id_ for id_ in self.order_queue if id_ != order_id)
+# read models maintained for every state version, see OrderProjections. add a
+#   factory here to maintain another one
+ORDER_PROJECTIONS: dict[str, Callable[[], OrderProjection]] = {
+    "by_status": lambda: OrderIndex(lambda order: order.status),
+    "by_user": lambda: OrderIndex(lambda order: order.ordered_by),
+    "by_recipe": lambda: OrderIndex(lambda order: order.recipe_id),
+    "per_hour": lambda: OrderCountByTime(datetime.timedelta(hours=1)),
+    "timeline": lambda: OrderTimeline(),
+    "timeline_by_status": lambda: OrderTimeline(lambda order: (order.status.value,)),
+}
 
-    def handle_order_enqueued(self, order_id):
-        if order_id in self.orders:
-            self.orders[order_id] = self.orders[order_id].update_status(
-                OrderStatus.enqueued
+
+# immutable and structurally shared: applying events creates a new version, so
+#   readers can hold on to a state without locks or copies
+@dataclass(frozen=True)
+class CocktailBarState:
+    order_queue: OrderQueue
+    slots: SlotInventory
+
+    orders: PersistentMap[OrderId, Order]
+
+    recipes: PersistentMap[RecipeId, CocktailRecipe]
+
+    # number of applied events, i.e. the seq of the last one
+    version: int = 0
+
+    # derived from the orders: not part of snapshots and ignored by ==
+    projections: OrderProjections | None = dataclasses.field(
+        default=None, compare=False, repr=False, metadata=dict(exclude=True)
+    )
+
+    def __post_init__(self):
+        if self.projections is None:
+            object.__setattr__(
+                self,
+                "projections",
+                OrderProjections.build(ORDER_PROJECTIONS, self.orders.values()),
             )
-        else:
-            logging.warning((f"tried to mark nonexisting order {order_id=} enqueued"))
-        self.order_queue = self.order_queue + (order_id,)
+
+    def remove_orders(self, order_ids: Iterable[OrderId]) -> "CocktailBarState":
+        # only used for archival of closed orders
+        orders = self.orders.mutate()
+        projections = self.projections.mutate()
+        for order_id in order_ids:
+            order = orders.get(order_id)
+            if order is not None:
+                orders.delete(order_id)
+                projections = projections.order_changed(order, None)
+        return dataclasses.replace(
+            self, orders=orders.finish(), projections=projections.finish()
+        )
+
+    def with_version(self, version: int) -> "CocktailBarState":
+        return dataclasses.replace(self, version=version)
 
     @staticmethod
     def apply_events(
         events: Iterable[tuple[datetime.datetime, CocktailBarEvent]],
         initial_state: "CocktailBarState | None" = None,
+        # called with every new or changed order version (live events only)
+        on_order_changed: Callable[[Order], None] | None = None,
     ) -> "CocktailBarState":
+        started = time.perf_counter()
         if initial_state is None:
             initial_state = CocktailBarState(
-                order_queue=[], slots=[], orders={}, recipes={}
+                order_queue=OrderQueue(),
+                slots=SlotInventory(),
+                orders=PersistentMap(),
+                recipes=PersistentMap(),
             )
-        state = initial_state
+        update = _BarStateUpdate_(initial_state, on_order_changed)
         for time_of_event, event in events:
             # print(f"applying event {event}")  # TODO remove. this will spam
             match event:
                 case SlotRefilledEvent():
-                    state.handle_refilled(event)
+                    update.handle_refilled(event)
                 case AmountPouredEvent():
-                    state.handle_poured(event)
+                    update.handle_poured(event)
                 case OrderPlacedEvent():
-                    state.handle_order_placed(event, time_of_event)
+                    update.handle_order_placed(event, time_of_event)
                 case OrderEnqueuedEvent(order_id=order_id):
-                    # state.handle_order_status_change(order_id, OrderStatus.enqueued)
-                    state.handle_order_enqueued(order_id)
+                    # update.handle_order_status_change(order_id, OrderStatus.enqueued)
+                    update.handle_order_enqueued(order_id)
                 case OrderFulfilledEvent(order_id=order_id):
-                    state.handle_order_status_change(order_id, OrderStatus.fulfilled)
+                    update.handle_order_status_change(order_id, OrderStatus.fulfilled)
                 case OrderExecutingEvent(order_id=order_id):
-                    state.handle_order_status_change(order_id, OrderStatus.executing)
+                    update.handle_order_status_change(order_id, OrderStatus.executing)
                 case OrderCancelledEvent(order_id=order_id):
-                    state.handle_order_status_change(order_id, OrderStatus.cancelled)
+                    update.handle_order_status_change(order_id, OrderStatus.cancelled)
                 case OrderDequeuedEvent(order_id=order_id):
-                    state.handle_order_status_change(order_id, OrderStatus.dequeued)
+                    update.handle_order_status_change(order_id, OrderStatus.dequeued)
                 case OrderAbortedEvent(order_id=order_id):
-                    state.handle_order_status_change(order_id, OrderStatus.aborted)
+                    update.handle_order_status_change(order_id, OrderStatus.aborted)
                 case RecipeCreatedEvent(recipe=recipe, creator_user_id=_user_id):
-                    state.recipes[recipe.recipe_id] = recipe
+                    update.recipes.set(recipe.recipe_id, recipe)
                 case QueuePurgedEvent():
-                    state.order_queue = []
+                    update.order_queue = update.order_queue.clear().mutate()
                 case _:
                     logging.error(f"unhandled event {event}")
-            # print(f"new slots: {state.slots}")
-            # print(f"new queue: {state.order_queue}")
+            update.version += 1
+            # print(f"new slots: {update.slots}")
+            # print(f"new queue: {update.order_queue}")
+        state = update.finish()
+        APPLIED_EVENTS.inc(state.version - initial_state.version)
+        APPLY_SECONDS.observe(time.perf_counter() - started)
         return state
 
     def json_snapshot(self) -> any:
@@ -275,7 +549,105 @@ class CocktailBarState:
 
     @staticmethod
     def load_snapshot(json_data: str) -> "CocktailBarState":
-        return RootModel[CocktailBarState].model_validate_json(json_data)
+        return RootModel[CocktailBarState].model_validate_json(json_data).root
+
+
+# in place (transient) versions of the state parts while a batch of events is
+#   applied. the initial state is not touched
+class _BarStateUpdate_:
+
+    def __init__(
+        self,
+        state: CocktailBarState,
+        on_order_changed: Callable[[Order], None] | None = None,
+    ):
+        self._on_order_changed_ = on_order_changed
+        self.order_queue = state.order_queue.mutate()
+        self.slots = state.slots.mutate()
+        self.orders = state.orders.mutate()
+        self.recipes = state.recipes.mutate()
+        self.projections = state.projections
+        # changed order -> its version in the initial state (None if new). the
+        #   projections are brought up to date once per batch, so an order
+        #   placed, enqueued and fulfilled within a batch (like in a replay)
+        #   costs one projection update instead of three
+        self._touched_: dict[OrderId, Order | None] = {}
+        self.version = state.version
+
+    def _set_order_(self, order: Order):
+        orders = self.orders
+        self._touched_.setdefault(order.order_id, orders.get(order.order_id))
+        orders.set(order.order_id, order)
+        if self._on_order_changed_ is not None:
+            self._on_order_changed_(order)
+
+    def handle_refilled(self, refilled: SlotRefilledEvent):
+        self.slots = self.slots.update(refilled.new_status)
+
+    def handle_poured(self, poured: AmountPouredEvent):
+        status = self.slots.get(poured.slot_path)
+        if status is None:
+            logging.error(f"registered pour for non-existent slot {poured}")
+        else:
+            self.slots = self.slots.update(status.pour(poured.amount_in_ml))
+
+    def handle_order_placed(
+        self, order_placed: OrderPlacedEvent, time_of_event: datetime.datetime
+    ):
+        if order_placed.order_id not in self.orders:
+            # noinspection PyTypeChecker
+            self._set_order_(
+                Order(
+                    order_id=order_placed.order_id,
+                    status=OrderStatus.ordered,
+                    ordered_by=order_placed.user_id,
+                    recipe_id=order_placed.recipe_id,
+                    time_of_order=time_of_event,
+                )
+            )
+        else:
+            logging.error((f"tried to readd existing order {order_placed}"))
+
+    def handle_order_status_change(self, order_id, new_state: OrderStatus):
+        if order_id in self.orders:
+            self._set_order_(self.orders[order_id].update_status(new_state))
+        else:
+            logging.warning(
+                (f"tried to mark nonexisting order {order_id=} {new_state=}")
+            )
+        self.order_queue = self.order_queue.remove(order_id)
+
+    def handle_order_enqueued(self, order_id):
+        if order_id in self.orders:
+            self._set_order_(self.orders[order_id].update_status(OrderStatus.enqueued))
+        else:
+            logging.warning((f"tried to mark nonexisting order {order_id=} enqueued"))
+        self.order_queue = self.order_queue.append(order_id)
+
+    # None to rebuild them from the orders
+    def _finish_projections_(self) -> OrderProjections | None:
+        touched = self._touched_
+        if not touched:
+            return self.projections
+        # a rebuild visits every order once, an update every changed one twice
+        #   (out of the old version, into the new one)
+        if 2 * len(touched) >= len(self.orders):
+            return None
+        projections = self.projections.mutate()
+        orders = self.orders
+        for order_id, old in touched.items():
+            projections = projections.order_changed(old, orders.get(order_id))
+        return projections.finish()
+
+    def finish(self) -> CocktailBarState:
+        return CocktailBarState(
+            order_queue=self.order_queue.finish(),
+            slots=self.slots.finish(),
+            orders=self.orders.finish(),
+            recipes=self.recipes.finish(),
+            version=self.version,
+            projections=self._finish_projections_(),
+        )
 
 
 def test_can_dump_bar_state():
@@ -0,0 +1,263 @@
+import struct
+import uuid
+from enum import Enum
+
+from cocktail_24.cocktail.cocktail_bookkeeping import (
+    CocktailBarEvent,
+    SlotRefilledEvent,
+    SlotStatus,
+    SlotPath,
+    AmountPouredEvent,
+    OrderPlacedEvent,
+    OrderCancelledEvent,
+    OrderAbortedEvent,
+    OrderEnqueuedEvent,
+    OrderDequeuedEvent,
+    OrderFulfilledEvent,
+    OrderExecutingEvent,
+    QueuePurgedEvent,
+    RecipeCreatedEvent,
+    Station,
+)
+from cocktail_24.cocktail.cocktail_recipes import (
+    CocktailRecipe,
+    CocktailRecipeStep,
+    CocktailRecipeShake,
+    CocktailRecipeAddIngredients,
+    IngredientAmounts,
+    IngredientAmount,
+)
+
+# record layout: version (u8) | event tag (u8) | event body
+# bump on incompatible layout changes
+CODEC_VERSION = 1
+
+
+class EventCodecTags(Enum):
+    slot_refilled = 1
+    amount_poured = 2
+    order_placed = 3
+    order_cancelled = 4
+    order_aborted = 5
+    order_enqueued = 6
+    order_dequeued = 7
+    order_fulfilled = 8
+    order_executing = 9
+    queue_purged = 10
+    recipe_created = 11
+
+
+class RecipeStepTags(Enum):
+    shake = 1
+    add_ingredients = 2
+
+
+# well known station ids are stored as index, others inline
+INTERNED_STATION_IDS = (Station.zapf, Station.pump)
+_INLINE_STATION_ID_ = 0xFFFF
+_STATION_CODES_ = {
+    station_id: code for code, station_id in enumerate(INTERNED_STATION_IDS)
+}
+
+_HEADER_ = struct.Struct("<BB")
+_UUID_ = struct.Struct("<16s")
+_ORDER_PLACED_ = struct.Struct("<16s16s16s")
+_SLOT_ = struct.Struct("<Hi")
+_AMOUNT_ = struct.Struct("<d")
+_STR_LEN_ = struct.Struct("<H")
+_PAYLOAD_LEN_ = struct.Struct("<I")
+_COUNT_ = struct.Struct("<H")
+_STEP_TAG_ = struct.Struct("<B")
+
+_SIMPLE_ORDER_EVENTS_ = {
+    OrderCancelledEvent: EventCodecTags.order_cancelled,
+    OrderAbortedEvent: EventCodecTags.order_aborted,
+    OrderEnqueuedEvent: EventCodecTags.order_enqueued,
+    OrderDequeuedEvent: EventCodecTags.order_dequeued,
+    OrderFulfilledEvent: EventCodecTags.order_fulfilled,
+    OrderExecutingEvent: EventCodecTags.order_executing,
+}
+_SIMPLE_ORDER_EVENT_TYPES_ = {
+    tag.value: event_type for event_type, tag in _SIMPLE_ORDER_EVENTS_.items()
+}
+
+
+class EventCodecException(Exception):
+    pass
+
+
+def _header_(tag: EventCodecTags) -> bytes:
+    return _HEADER_.pack(CODEC_VERSION, tag.value)
+
+
+def _encode_str_(value: str) -> bytes:
+    encoded = value.encode("utf-8")
+    return _STR_LEN_.pack(len(encoded)) + encoded
+
+
+def _decode_str_(data, offset: int) -> tuple[str, int]:
+    (length,) = _STR_LEN_.unpack_from(data, offset)
+    offset += _STR_LEN_.size
+    return str(data[offset : offset + length], "utf-8"), offset + length
+
+
+def _encode_slot_path_(slot_path: SlotPath) -> bytes:
+    code = _STATION_CODES_.get(slot_path.station_id)
+    if code is None:
+        return _SLOT_.pack(_INLINE_STATION_ID_, slot_path.slot_id) + _encode_str_(
+            slot_path.station_id
+        )
+    return _SLOT_.pack(code, slot_path.slot_id)
+
+
+def _decode_slot_path_(data, offset: int) -> tuple[SlotPath, int]:
+    code, slot_id = _SLOT_.unpack_from(data, offset)
+    offset += _SLOT_.size
+    if code == _INLINE_STATION_ID_:
+        station_id, offset = _decode_str_(data, offset)
+    else:
+        station_id = INTERNED_STATION_IDS[code]
+    return SlotPath(station_id=station_id, slot_id=slot_id), offset
+
+
+def _encode_recipe_(recipe: CocktailRecipe) -> bytes:
+    parts = [
+        _UUID_.pack(recipe.recipe_id.bytes),
+        _encode_str_(recipe.title),
+        _COUNT_.pack(len(recipe.steps)),
+    ]
+    for step in recipe.steps:
+        parts.append(_encode_str_(step.step_title))
+        match step.instruction:
+            case CocktailRecipeShake(shake_duration_in_s=duration_in_s):
+                parts.append(_STEP_TAG_.pack(RecipeStepTags.shake.value))
+                parts.append(_AMOUNT_.pack(duration_in_s))
+            case CocktailRecipeAddIngredients(to_add=to_add):
+                parts.append(_STEP_TAG_.pack(RecipeStepTags.add_ingredients.value))
+                parts.append(_COUNT_.pack(len(to_add.amounts)))
+                for amount in to_add.amounts:
+                    parts.append(_encode_str_(amount.ingredient))
+                    parts.append(_AMOUNT_.pack(amount.amount_in_ml))
+            case _:
+                raise EventCodecException(f"unknown instruction {step.instruction}")
+    return b"".join(parts)
+
+
+def _decode_recipe_(data, offset: int) -> CocktailRecipe:
+    (recipe_id,) = _UUID_.unpack_from(data, offset)
+    offset += _UUID_.size
+    title, offset = _decode_str_(data, offset)
+    (n_steps,) = _COUNT_.unpack_from(data, offset)
+    offset += _COUNT_.size
+    steps = []
+    for _ in range(n_steps):
+        step_title, offset = _decode_str_(data, offset)
+        (step_tag,) = _STEP_TAG_.unpack_from(data, offset)
+        offset += _STEP_TAG_.size
+        if step_tag == RecipeStepTags.shake.value:
+            (duration_in_s,) = _AMOUNT_.unpack_from(data, offset)
+            offset += _AMOUNT_.size
+            instruction = CocktailRecipeShake(shake_duration_in_s=duration_in_s)
+        elif step_tag == RecipeStepTags.add_ingredients.value:
+            (n_amounts,) = _COUNT_.unpack_from(data, offset)
+            offset += _COUNT_.size
+            amounts = []
+            for _ in range(n_amounts):
+                ingredient, offset = _decode_str_(data, offset)
+                (amount_in_ml,) = _AMOUNT_.unpack_from(data, offset)
+                offset += _AMOUNT_.size
+                amounts.append(
+                    IngredientAmount(ingredient=ingredient, amount_in_ml=amount_in_ml)
+                )
+            instruction = CocktailRecipeAddIngredients(
+                to_add=IngredientAmounts(amounts=tuple(amounts))
+            )
+        else:
+            raise EventCodecException(f"unknown recipe step tag {step_tag}")
+        steps.append(CocktailRecipeStep(step_title=step_title, instruction=instruction))
+    return CocktailRecipe(
+        recipe_id=uuid.UUID(bytes=recipe_id), title=title, steps=tuple(steps)
+    )
+
+
+def encode_event(event: CocktailBarEvent) -> bytes:
+    simple_order_tag = _SIMPLE_ORDER_EVENTS_.get(type(event))
+    if simple_order_tag is not None:
+        return _header_(simple_order_tag) + event.order_id.bytes
+    match event:
+        case AmountPouredEvent(slot_path=slot_path, amount_in_ml=amount_in_ml):
+            return (
+                _header_(EventCodecTags.amount_poured)
+                + _encode_slot_path_(slot_path)
+                + _AMOUNT_.pack(amount_in_ml)
+            )
+        case OrderPlacedEvent(order_id=order_id, recipe_id=recipe_id, user_id=user_id):
+            return _header_(EventCodecTags.order_placed) + _ORDER_PLACED_.pack(
+                order_id.bytes, recipe_id.bytes, user_id.bytes
+            )
+        case SlotRefilledEvent(new_status=status):
+            return (
+                _header_(EventCodecTags.slot_refilled)
+                + _encode_slot_path_(status.slot_path)
+                + _AMOUNT_.pack(status.available_amount_in_ml)
+                + _encode_str_(status.ingredient_id)
+            )
+        case QueuePurgedEvent():
+            return _header_(EventCodecTags.queue_purged)
+        case RecipeCreatedEvent(recipe=recipe, creator_user_id=creator_user_id):
+            recipe_payload = _encode_recipe_(recipe)
+            return (
+                _header_(EventCodecTags.recipe_created)
+                + _UUID_.pack(creator_user_id.bytes)
+                + _PAYLOAD_LEN_.pack(len(recipe_payload))
+                + recipe_payload
+            )
+        case _:
+            raise EventCodecException(f"cannot encode event {event}")
+
+
+# data may be bytes or a memoryview slice
+def decode_event(data) -> CocktailBarEvent:
+    version, tag = _HEADER_.unpack_from(data, 0)
+    if version != CODEC_VERSION:
+        raise EventCodecException(f"unsupported event codec version {version}")
+    offset = _HEADER_.size
+    simple_order_event_type = _SIMPLE_ORDER_EVENT_TYPES_.get(tag)
+    if simple_order_event_type is not None:
+        (order_id,) = _UUID_.unpack_from(data, offset)
+        return simple_order_event_type(order_id=uuid.UUID(bytes=order_id))
+    match tag:
+        case EventCodecTags.amount_poured.value:
+            slot_path, offset = _decode_slot_path_(data, offset)
+            (amount_in_ml,) = _AMOUNT_.unpack_from(data, offset)
+            return AmountPouredEvent(slot_path=slot_path, amount_in_ml=amount_in_ml)
+        case EventCodecTags.order_placed.value:
+            order_id, recipe_id, user_id = _ORDER_PLACED_.unpack_from(data, offset)
+            return OrderPlacedEvent(
+                order_id=uuid.UUID(bytes=order_id),
+                recipe_id=uuid.UUID(bytes=recipe_id),
+                user_id=uuid.UUID(bytes=user_id),
+            )
+        case EventCodecTags.slot_refilled.value:
+            slot_path, offset = _decode_slot_path_(data, offset)
+            (available_amount_in_ml,) = _AMOUNT_.unpack_from(data, offset)
+            offset += _AMOUNT_.size
+            ingredient_id, offset = _decode_str_(data, offset)
+            return SlotRefilledEvent(
+                new_status=SlotStatus(
+                    slot_path=slot_path,
+                    available_amount_in_ml=available_amount_in_ml,
+                    ingredient_id=ingredient_id,
+                )
+            )
+        case EventCodecTags.queue_purged.value:
+            return QueuePurgedEvent()
+        case EventCodecTags.recipe_created.value:
+            (creator_user_id,) = _UUID_.unpack_from(data, offset)
+            offset += _UUID_.size + _PAYLOAD_LEN_.size
+            return RecipeCreatedEvent(
+                recipe=_decode_recipe_(data, offset),
+                creator_user_id=uuid.UUID(bytes=creator_user_id),
+            )
+        case _:
+            raise EventCodecException(f"unknown event tag {tag}")
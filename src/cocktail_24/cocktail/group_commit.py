@@ -0,0 +1,108 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Sequence, Any, Callable
+
+from pydantic.dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class WriteBehindConfig:
+    # commit once this many rows are pending ...
+    max_batch_size: int = 1000
+    # ... or once the first pending write waited this long
+    max_delay_in_s: float = 0.002
+
+
+# (statement, rows) pairs that are run with executemany. rows may be a function,
+#   that is called right before (on the writer thread), e.g. to serialize a
+#   snapshot off the caller's thread
+SqliteRows = Sequence[tuple] | Callable[[], Sequence[tuple]]
+SqliteWrites = Sequence[tuple[str, SqliteRows]]
+
+
+def execute_writes(con: sqlite3.Connection, writes: SqliteWrites) -> None:
+    for statement, rows in writes:
+        con.executemany(statement, rows() if callable(rows) else rows)
+
+
+def _count_rows_(writes: SqliteWrites) -> int:
+    # a function counts as one row
+    return sum(1 if callable(rows) else len(rows) for _statement, rows in writes)
+
+
+# dedicated writer thread, that commits queued writes in batches (in order).
+#   every submission gets a future, that resolves to the given result once its
+#   batch is committed (or fails with the commit error)
+class SqliteGroupCommitWriter:
+
+    def __init__(self, sqlite_file: str, config: WriteBehindConfig):
+        self._config_ = config
+        self._queue_: queue.SimpleQueue = queue.SimpleQueue()
+        # connect here, so that setup errors surface in the caller
+        self._con_ = sqlite3.connect(sqlite_file, check_same_thread=False)
+        self._con_.execute("PRAGMA journal_mode=WAL")
+        # WAL + FULL syncs on every commit, so a resolved future means durable
+        self._con_.execute("PRAGMA synchronous=FULL")
+        self._thread_ = threading.Thread(
+            target=self._run_, name="sqlite-group-commit", daemon=True
+        )
+        self._thread_.start()
+
+    def submit(self, writes: SqliteWrites, result: Any = None) -> Future:
+        future = Future()
+        self._queue_.put((writes, result, future))
+        return future
+
+    def flush(self) -> None:
+        self.submit([]).result()
+
+    def close(self) -> None:
+        self._queue_.put(None)
+        self._thread_.join()
+        self._con_.close()
+
+    def _collect_batch_(self, first) -> tuple[list, bool]:
+        batch = [first]
+        n_rows = _count_rows_(first[0])
+        deadline = time.monotonic() + self._config_.max_delay_in_s
+        while n_rows < self._config_.max_batch_size:
+            try:
+                timeout = deadline - time.monotonic()
+                item = (
+                    self._queue_.get(timeout=timeout)
+                    if timeout > 0
+                    else self._queue_.get_nowait()
+                )
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+            n_rows += _count_rows_(item[0])
+        return batch, False
+
+    def _commit_batch_(self, batch: list) -> None:
+        try:
+            with self._con_:
+                for writes, _result, _future in batch:
+                    execute_writes(self._con_, writes)
+        except Exception as e:
+            logging.exception(f"group commit of {len(batch)} writes failed")
+            for _writes, _result, future in batch:
+                future.set_exception(e)
+        else:
+            for _writes, result, future in batch:
+                future.set_result(result)
+
+    def _run_(self):
+        stopped = False
+        while not stopped:
+            first = self._queue_.get()
+            if first is None:
+                break
+            batch, stopped = self._collect_batch_(first)
+            self._commit_batch_(batch)
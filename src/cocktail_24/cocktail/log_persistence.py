@@ -0,0 +1,269 @@
+import bisect
+import datetime
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+from typing import Iterable
+
+from cocktail_24.cocktail.cocktail_api import (
+    CocktailBarStatePersistence,
+    EventOccurrence,
+    LoggedEvent,
+    PERSIST_SECONDS,
+    PERSIST_BATCH_SIZE,
+)
+from cocktail_24.cocktail.cocktail_bookkeeping import (
+    CocktailBarState,
+    CocktailBarEvent,
+)
+from cocktail_24.cocktail.event_codec import encode_event, decode_event
+from cocktail_24.cocktail.order_watch import OrderWatch
+
+# frame layout: payload length (u32) | crc32 of the rest (u32) | timestamp in us (i64)
+#   | event codec record
+_FRAME_HEADER_ = struct.Struct("<IIq")
+_FRAME_PREFIX_ = struct.Struct("<II")
+_CRC_START_ = 8
+
+_EPOCH_ = datetime.datetime(1970, 1, 1)
+_MICROSECOND_ = datetime.timedelta(microseconds=1)
+
+SEGMENT_SUFFIX = ".log"
+
+
+class LogCorruptedException(Exception):
+    pass
+
+
+def _encode_frame_(timestamp: datetime.datetime, event: CocktailBarEvent) -> bytes:
+    payload = encode_event(event)
+    timestamp_and_payload = (
+        struct.pack("<q", (timestamp - _EPOCH_) // _MICROSECOND_) + payload
+    )
+    return (
+        struct.pack("<II", len(payload), zlib.crc32(timestamp_and_payload))
+        + timestamp_and_payload
+    )
+
+
+def _segment_name_(first_seq: int) -> str:
+    return f"{first_seq:020d}{SEGMENT_SUFFIX}"
+
+
+# yields (start offset, end offset) of the frames from offset on, stops at the
+#   first torn or corrupt frame
+def _iter_frames_(view: memoryview, offset: int):
+    while offset + _FRAME_HEADER_.size <= len(view):
+        length, crc = _FRAME_PREFIX_.unpack_from(view, offset)
+        end = offset + _FRAME_HEADER_.size + length
+        if end > len(view) or zlib.crc32(view[offset + _CRC_START_ : end]) != crc:
+            return
+        yield offset, end
+        offset = end
+
+
+def _decode_frame_(
+    view: memoryview, offset: int, end: int
+) -> tuple[datetime.datetime, CocktailBarEvent]:
+    _length, _crc, timestamp_us = _FRAME_HEADER_.unpack_from(view, offset)
+    timestamp = _EPOCH_ + timestamp_us * _MICROSECOND_
+    return timestamp, decode_event(view[offset + _FRAME_HEADER_.size : end])
+
+
+# append only event log in segment files. each segment is named after the seq of
+#   its first event. only implements CocktailBarStatePersistence: there is no
+#   compact, get_archived_order or get_state_at, so it cannot back api.py (which
+#   compacts periodically and serves archived orders and /debug/state)
+class AppendOnlyLogCocktailBarStatePersistence(CocktailBarStatePersistence):
+
+    def __init__(
+        self,
+        directory: str,
+        segment_size_in_bytes: int = 64 * 1024 * 1024,
+        replay_chunk_size: int = 10000,
+        index_interval_in_events: int = 1024,
+    ):
+        os.makedirs(directory, exist_ok=True)
+        self._directory_ = directory
+        self._segment_size_in_bytes_ = segment_size_in_bytes
+        self._replay_chunk_size_ = replay_chunk_size
+        self._index_interval_in_events_ = index_interval_in_events
+        self._lock_ = threading.Lock()
+        self.order_watch = OrderWatch()
+        self._persist_seconds_ = PERSIST_SECONDS.labels("log")
+        self._persist_batch_size_ = PERSIST_BATCH_SIZE.labels("log")
+
+        # sparse offset index: the frame of seq _index_seqs_[i] starts at
+        #   _index_positions_[i] = (segment number, byte offset). every segment
+        #   start and every index_interval_in_events-th event is indexed
+        self._segments_ = self._segment_paths_()
+        self._index_seqs_: list[int] = []
+        self._index_positions_: list[tuple[int, int]] = []
+
+        self._state_, self._event_offset_ = self._load_segments_()
+        self._segment_ = self._open_segment_(self._segments_[-1])
+
+    def _segment_paths_(self) -> list[str]:
+        names = sorted(
+            name
+            for name in os.listdir(self._directory_)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        if not names:
+            names = [_segment_name_(1)]
+        return [os.path.join(self._directory_, name) for name in names]
+
+    def _open_segment_(self, path: str):
+        segment = open(path, "ab")
+        # make sure a new segment file survives a crash
+        dir_fd = os.open(self._directory_, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        return segment
+
+    def _index_frame_(self, seq: int, segment_no: int, offset: int) -> None:
+        if offset == 0 or (seq - 1) % self._index_interval_in_events_ == 0:
+            self._index_seqs_.append(seq)
+            self._index_positions_.append((segment_no, offset))
+
+    def _replay_view_(
+        self,
+        view: memoryview,
+        state: CocktailBarState | None,
+        segment_no: int,
+        event_offset: int,
+    ) -> tuple[CocktailBarState | None, int, int]:
+        valid_size, n_events = 0, 0
+        events = []
+        for offset, valid_size in _iter_frames_(view, 0):
+            self._index_frame_(
+                event_offset + n_events + len(events) + 1, segment_no, offset
+            )
+            events.append(_decode_frame_(view, offset, valid_size))
+            if len(events) >= self._replay_chunk_size_:
+                state = CocktailBarState.apply_events(events, state)
+                n_events += len(events)
+                events = []
+        state = CocktailBarState.apply_events(events, state)
+        return state, n_events + len(events), valid_size
+
+    def _replay_segment_(
+        self, segment_no: int, state: CocktailBarState | None, event_offset: int
+    ) -> tuple[CocktailBarState | None, int, int]:
+        path = self._segments_[segment_no]
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size == 0:
+            return state, 0, 0
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    state, n_events, valid_size = self._replay_view_(
+                        view, state, segment_no, event_offset
+                    )
+        return state, n_events, size - valid_size
+
+    def _load_segments_(self) -> tuple[CocktailBarState, int]:
+        state, event_offset = None, 0
+        paths = self._segments_
+        for i, path in enumerate(paths):
+            state, n_events, torn_bytes = self._replay_segment_(i, state, event_offset)
+            event_offset += n_events
+            if torn_bytes > 0:
+                if i + 1 < len(paths):
+                    raise LogCorruptedException(
+                        f"invalid record in {path} followed by further segments"
+                    )
+                # partially written tail of the last append: drop it
+                logging.warning(f"truncating {torn_bytes} torn bytes from {path}")
+                with open(path, "r+b") as f:
+                    f.truncate(os.path.getsize(path) - torn_bytes)
+                    os.fsync(f.fileno())
+        logging.info(f"replayed {event_offset} events from {len(paths)} segments")
+        return CocktailBarState.apply_events([], state), event_offset
+
+    def persist_events(self, occurences: Iterable[EventOccurrence]) -> Future[int]:
+        started = time.perf_counter()
+        new_events = [(occ.timestamp, occ.event) for occ in occurences]
+        frames = [_encode_frame_(timestamp, event) for timestamp, event in new_events]
+        changed_orders = []
+        with self._lock_:
+            offset = self._segment_.tell()
+            self._segment_.write(b"".join(frames))
+            self._segment_.flush()
+            os.fsync(self._segment_.fileno())
+            for seq, frame in enumerate(frames, start=self._event_offset_ + 1):
+                self._index_frame_(seq, len(self._segments_) - 1, offset)
+                offset += len(frame)
+            self._event_offset_ += len(new_events)
+            last_seq = self._event_offset_
+            self._state_ = CocktailBarState.apply_events(
+                new_events, self._state_, changed_orders.append
+            )
+            if self._segment_.tell() >= self._segment_size_in_bytes_:
+                self._segment_.close()
+                path = os.path.join(
+                    self._directory_, _segment_name_(self._event_offset_ + 1)
+                )
+                self._segment_ = self._open_segment_(path)
+                self._segments_.append(path)
+        self.order_watch.notify(changed_orders)
+        self._persist_seconds_.observe(time.perf_counter() - started)
+        self._persist_batch_size_.observe(len(new_events))
+        durable = Future()
+        durable.set_result(last_seq)
+        return durable
+
+    def get_current_state(self):
+        # immutable version, safe to hold on to
+        return self._state_
+
+    def read_events(
+        self, after_seq: int, until_seq: int | None = None, limit: int | None = None
+    ) -> list[LoggedEvent]:
+        after_seq = max(after_seq, 0)
+        with self._lock_:
+            last_seq = self._event_offset_
+            if until_seq is not None:
+                last_seq = min(last_seq, until_seq)
+            if limit is not None:
+                last_seq = min(last_seq, after_seq + limit)
+            if last_seq <= after_seq:
+                return []
+            # closest indexed frame at or before the first requested one
+            i = bisect.bisect_right(self._index_seqs_, after_seq + 1) - 1
+            seq = self._index_seqs_[i]
+            segment_no, offset = self._index_positions_[i]
+            paths = self._segments_[segment_no:]
+        # frames up to last_seq are flushed, so reading needs no lock
+        events = []
+        for path in paths:
+            with open(path, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    with memoryview(mapped) as view:
+                        frames = _iter_frames_(view, offset)
+                        for start, end in frames:
+                            # only decode the requested frames
+                            if seq > after_seq:
+                                events.append(
+                                    LoggedEvent.from_event(
+                                        seq, *_decode_frame_(view, start, end)
+                                    )
+                                )
+                            seq += 1
+                            if seq > last_seq:
+                                break
+                        frames.close()
+            if seq > last_seq:
+                break
+            offset = 0
+        return events
+
+    def close(self) -> None:
+        self._segment_.close()
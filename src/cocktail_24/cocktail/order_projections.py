@@ -0,0 +1,267 @@
+import datetime
+from typing import (
+    Protocol,
+    Callable,
+    Hashable,
+    Iterable,
+    Iterator,
+    Mapping,
+    TYPE_CHECKING,
+)
+
+from pydantic_core import core_schema
+
+from cocktail_24.cocktail.persistent_map import PersistentMap, MapMutation
+from cocktail_24.cocktail.persistent_sorted_set import PersistentSortedSet
+
+if TYPE_CHECKING:
+    from cocktail_24.cocktail.cocktail_bookkeeping import Order, OrderId
+
+
+# read model over the orders of a bar state, kept up to date incrementally.
+#   immutable like the state: updates return a new projection (in place between
+#   mutate() and finish())
+class OrderProjection(Protocol):
+
+    # old/new are None when the order did not exist before/does not exist after
+    def order_changed(
+        self, old: "Order | None", new: "Order | None"
+    ) -> "OrderProjection": ...
+
+    def mutate(self) -> "OrderProjection": ...
+
+    def finish(self) -> "OrderProjection": ...
+
+
+# order ids grouped by key_of(order). while mutating, the id sets of the touched
+#   keys are transient as well and only written back on finish()
+class OrderIndex(OrderProjection):
+    __slots__ = ("_key_of_", "_index_", "_touched_")
+
+    def __init__(
+        self,
+        key_of: Callable[["Order"], Hashable],
+        _index_: PersistentMap[Hashable, PersistentMap["OrderId", None]] | None = None,
+        _touched_: dict[Hashable, MapMutation["OrderId", None]] | None = None,
+    ):
+        self._key_of_ = key_of
+        self._index_ = _index_ if _index_ is not None else PersistentMap()
+        self._touched_ = _touched_
+
+    def _order_ids_(self, key: Hashable) -> Mapping["OrderId", None]:
+        if self._touched_ and key in self._touched_:
+            return self._touched_[key]
+        return self._index_.get(key, _NO_ORDERS_)
+
+    def _touch_(self, key: Hashable) -> MapMutation["OrderId", None]:
+        order_ids = self._touched_.get(key)
+        if order_ids is None:
+            order_ids = self._index_.get(key, _NO_ORDERS_).mutate()
+            self._touched_[key] = order_ids
+        return order_ids
+
+    def order_changed(self, old: "Order | None", new: "Order | None") -> "OrderIndex":
+        if self._touched_ is None:
+            return self.mutate().order_changed(old, new).finish()
+        key_of = self._key_of_
+        if old is not None:
+            if new is not None and key_of(old) == key_of(new):
+                return self
+            self._touch_(key_of(old)).delete(old.order_id)
+        if new is not None:
+            self._touch_(key_of(new)).set(new.order_id, None)
+        return self
+
+    def mutate(self) -> "OrderIndex":
+        return OrderIndex(self._key_of_, self._index_, {})
+
+    def finish(self) -> "OrderIndex":
+        if not self._touched_:
+            return OrderIndex(self._key_of_, self._index_)
+        index = self._index_.mutate()
+        for key, order_ids in self._touched_.items():
+            if order_ids:
+                index.set(key, order_ids.finish())
+            else:
+                index.delete(key)
+        self._touched_ = None
+        return OrderIndex(self._key_of_, index.finish())
+
+    def order_ids(self, key: Hashable) -> Iterable["OrderId"]:
+        return iter(self._order_ids_(key))
+
+    def contains(self, key: Hashable, order_id: "OrderId") -> bool:
+        return order_id in self._order_ids_(key)
+
+    def count(self, key: Hashable) -> int:
+        return len(self._order_ids_(key))
+
+    def counts(self) -> dict[Hashable, int]:
+        keys = {*self._index_, *(self._touched_ or ())}
+        counts = {key: self.count(key) for key in keys}
+        return {key: count for key, count in counts.items() if count}
+
+
+_NO_ORDERS_: PersistentMap["OrderId", None] = PersistentMap()
+
+
+_EPOCH_ = datetime.datetime(1970, 1, 1)
+
+
+# number of orders per time_of_order bucket
+class OrderCountByTime(OrderProjection):
+    __slots__ = ("_bucket_", "_counts_")
+
+    def __init__(
+        self,
+        bucket: datetime.timedelta,
+        _counts_: PersistentMap[datetime.datetime, int] | None = None,
+    ):
+        self._bucket_ = bucket
+        self._counts_ = _counts_ if _counts_ is not None else PersistentMap()
+
+    def bucket_of(self, time_of_order: datetime.datetime) -> datetime.datetime:
+        return _EPOCH_ + (time_of_order - _EPOCH_) // self._bucket_ * self._bucket_
+
+    def order_changed(
+        self, old: "Order | None", new: "Order | None"
+    ) -> "OrderCountByTime":
+        # the time of order never changes, so only additions and removals count
+        if (old is None) == (new is None):
+            return self
+        order = new if new is not None else old
+        bucket = self.bucket_of(order.time_of_order)
+        count = self._counts_.get(bucket, 0) + (1 if new is not None else -1)
+        counts = (
+            self._counts_.set(bucket, count) if count else self._counts_.delete(bucket)
+        )
+        if counts is self._counts_:
+            # mutating in place
+            return self
+        return OrderCountByTime(self._bucket_, counts)
+
+    def mutate(self) -> "OrderCountByTime":
+        return OrderCountByTime(self._bucket_, self._counts_.mutate())
+
+    def finish(self) -> "OrderCountByTime":
+        return OrderCountByTime(self._bucket_, self._counts_.finish())
+
+    def counts(self) -> dict[datetime.datetime, int]:
+        return dict(sorted(self._counts_.items()))
+
+
+# (time of order, order id) of all orders, grouped by prefix_of(order) and
+#   sorted by time within each group. serves time ranges and keyset pages
+class OrderTimeline(OrderProjection):
+    __slots__ = ("_prefix_of_", "_keys_")
+
+    def __init__(
+        self,
+        prefix_of: Callable[["Order"], tuple] = lambda order: (),
+        _keys_: PersistentSortedSet | None = None,
+    ):
+        self._prefix_of_ = prefix_of
+        self._keys_ = _keys_ if _keys_ is not None else PersistentSortedSet()
+
+    def _key_(self, order: "Order") -> tuple:
+        return *self._prefix_of_(order), order.time_of_order, order.order_id
+
+    def order_changed(
+        self, old: "Order | None", new: "Order | None"
+    ) -> "OrderTimeline":
+        old_key = self._key_(old) if old is not None else None
+        new_key = self._key_(new) if new is not None else None
+        if old_key == new_key:
+            return self
+        keys = self._keys_
+        if old_key is not None:
+            keys = keys.discard(old_key)
+        if new_key is not None:
+            keys = keys.add(new_key)
+        if keys is self._keys_:
+            # mutating in place
+            return self
+        return OrderTimeline(self._prefix_of_, keys)
+
+    def mutate(self) -> "OrderTimeline":
+        return OrderTimeline(self._prefix_of_, self._keys_.mutate())
+
+    def finish(self) -> "OrderTimeline":
+        return OrderTimeline(self._prefix_of_, self._keys_.finish())
+
+    # (time of order, order id) of the orders with the given prefix, ordered in
+    #   [since, until). after is the keyset cursor: the last (time of order,
+    #   order id) of the previous page
+    def orders(
+        self,
+        prefix: tuple = (),
+        since: datetime.datetime | None = None,
+        until: datetime.datetime | None = None,
+        after: tuple[datetime.datetime, "OrderId"] | None = None,
+        descending: bool = False,
+    ) -> Iterator[tuple[datetime.datetime, "OrderId"]]:
+        # a bare prefix sorts before all its extensions
+        lo = (*prefix, since) if since is not None else prefix
+        hi = (*prefix, until if until is not None else datetime.datetime.max)
+        if after is not None:
+            if descending:
+                hi = min(hi, (*prefix, *after))
+            else:
+                lo = max(lo, (*prefix, *after))
+        n_prefix = len(prefix)
+        for key in self._keys_.range(lo, hi, reverse=descending):
+            if key != lo or after is None:
+                yield key[n_prefix:]
+
+
+# the projections of one bar state version, by name. derived data: not part of
+#   snapshots (rebuilt on load) and ignored when comparing states
+class OrderProjections:
+    __slots__ = ("_projections_", "_mutating_")
+
+    def __init__(
+        self, projections: Mapping[str, OrderProjection], _mutating_: bool = False
+    ):
+        self._projections_ = dict(projections)
+        self._mutating_ = _mutating_
+
+    @staticmethod
+    def build(
+        factories: Mapping[str, Callable[[], OrderProjection]],
+        orders: Iterable["Order"],
+    ) -> "OrderProjections":
+        projections = OrderProjections(
+            {name: factory() for name, factory in factories.items()}
+        ).mutate()
+        for order in orders:
+            projections = projections.order_changed(None, order)
+        return projections.finish()
+
+    def order_changed(
+        self, old: "Order | None", new: "Order | None"
+    ) -> "OrderProjections":
+        if not self._mutating_:
+            return self.mutate().order_changed(old, new).finish()
+        projections = self._projections_
+        for name, projection in projections.items():
+            projections[name] = projection.order_changed(old, new)
+        return self
+
+    def mutate(self) -> "OrderProjections":
+        return OrderProjections(
+            {name: p.mutate() for name, p in self._projections_.items()},
+            _mutating_=True,
+        )
+
+    def finish(self) -> "OrderProjections":
+        return OrderProjections(
+            {name: p.finish() for name, p in self._projections_.items()}
+        )
+
+    def __getitem__(self, name: str) -> OrderProjection:
+        return self._projections_[name]
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source, handler) -> core_schema.CoreSchema:
+        # never serialized, rebuilt from the orders instead
+        return core_schema.any_schema()
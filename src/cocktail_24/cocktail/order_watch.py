@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import threading
+from typing import Callable, Iterable
+
+from cocktail_24.cocktail.cocktail_bookkeeping import Order, OrderId
+
+
+class _Waiter_:
+    __slots__ = ("loop", "future", "predicate")
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        future: asyncio.Future,
+        predicate: Callable[[Order], bool],
+    ):
+        self.loop = loop
+        self.future = future
+        self.predicate = predicate
+
+
+def _resolve_(future: asyncio.Future, order: Order) -> None:
+    if not future.done():
+        future.set_result(order)
+
+
+# parks event loop callers until an order changes in a way they wait for. the
+#   persistence notifies with the orders changed by newly applied events (from
+#   any thread), waiters cost nothing in between. listeners get every batch of
+#   changed orders, on the notifying thread after the waiters were resolved.
+#   their errors are logged
+class OrderWatch:
+
+    def __init__(self):
+        self._lock_ = threading.Lock()
+        self._waiters_: dict[OrderId, set[_Waiter_]] = {}
+        self._listeners_: list[Callable[[list[Order]], None]] = []
+
+    def add_listener(self, listener: Callable[[list[Order]], None]) -> None:
+        self._listeners_.append(listener)
+
+    def notify(self, orders: Iterable[Order]) -> None:
+        orders = [*orders]
+        if self._waiters_:
+            self._resolve_waiters_(orders)
+        # the changes are persisted and published by now, a failing listener
+        #   must not fail the write or starve the other listeners
+        for listener in self._listeners_:
+            try:
+                listener(orders)
+            except Exception:
+                logging.exception(f"order listener {listener} failed")
+
+    def _resolve_waiters_(self, orders: list[Order]) -> None:
+        with self._lock_:
+            for order in orders:
+                waiters = self._waiters_.get(order.order_id)
+                if not waiters:
+                    continue
+                for waiter in [*waiters]:
+                    if waiter.predicate(order):
+                        waiters.discard(waiter)
+                        waiter.loop.call_soon_threadsafe(
+                            _resolve_, waiter.future, order
+                        )
+                if not waiters:
+                    del self._waiters_[order.order_id]
+
+    # order_id's next version that satisfies predicate, or None on timeout.
+    #   current is called after registering, so no change in between is missed
+    async def wait_for(
+        self,
+        order_id: OrderId,
+        predicate: Callable[[Order], bool],
+        current: Callable[[], Order | None],
+        timeout_in_s: float,
+    ) -> Order | None:
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter_(loop, loop.create_future(), predicate)
+        with self._lock_:
+            self._waiters_.setdefault(order_id, set()).add(waiter)
+        try:
+            order = current()
+            if order is not None and predicate(order):
+                return order
+            return await asyncio.wait_for(waiter.future, timeout_in_s)
+        except TimeoutError:
+            return None
+        finally:
+            with self._lock_:
+                waiters = self._waiters_.get(order_id)
+                if waiters is not None:
+                    waiters.discard(waiter)
+                    if not waiters:
+                        del self._waiters_[order_id]
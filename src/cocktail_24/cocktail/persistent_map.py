@@ -0,0 +1,314 @@
+from typing import Any, Iterator, Mapping, get_args
+
+from pydantic import GetCoreSchemaHandler
+from pydantic_core import core_schema
+
+# hash array mapped trie: every node consumes 5 bits of the (64 bit) key hash.
+#   updates copy the path to the changed leaf and share everything else, so old
+#   versions stay valid and cheap to keep around
+_BITS_ = 5
+_MASK_ = (1 << _BITS_) - 1
+_HASH_BITS_ = 64
+_HASH_MASK_ = (1 << _HASH_BITS_) - 1
+
+
+def _hash_(key) -> int:
+    return hash(key) & _HASH_MASK_
+
+
+def _bit_(h: int, shift: int) -> int:
+    return 1 << ((h >> shift) & _MASK_)
+
+
+def _index_(bitmap: int, bit: int) -> int:
+    return (bitmap & (bit - 1)).bit_count()
+
+
+# leaf entries are (hash, key, value) tuples, all other entries are nodes.
+#   nodes belonging to the owner of a MapMutation are updated in place
+class _Node_:
+    __slots__ = ("bitmap", "entries", "owner")
+
+    def __init__(self, bitmap: int, entries: list, owner: object | None):
+        self.bitmap = bitmap
+        self.entries = entries
+        self.owner = owner
+
+    def _editable_(self, owner: object | None) -> "_Node_":
+        if owner is not None and self.owner is owner:
+            return self
+        return _Node_(self.bitmap, [*self.entries], owner)
+
+    def find(self, shift: int, h: int, key, default):
+        # iterative and with inlined bit math, lookups are the hot path
+        node = self
+        while True:
+            bit = 1 << ((h >> shift) & _MASK_)
+            if not node.bitmap & bit:
+                return default
+            entry = node.entries[(node.bitmap & (bit - 1)).bit_count()]
+            if type(entry) is tuple:
+                if entry[0] == h and entry[1] == key:
+                    return entry[2]
+                return default
+            if type(entry) is _Collision_:
+                return entry.find(shift + _BITS_, h, key, default)
+            node = entry
+            shift += _BITS_
+
+    # returns (node, added)
+    def assoc(
+        self, shift: int, h: int, key, value, owner: object | None
+    ) -> tuple["_Node_", bool]:
+        bit = 1 << ((h >> shift) & _MASK_)
+        i = (self.bitmap & (bit - 1)).bit_count()
+        if not self.bitmap & bit:
+            node = self._editable_(owner)
+            node.entries.insert(i, (h, key, value))
+            node.bitmap |= bit
+            return node, True
+        entry = self.entries[i]
+        if type(entry) is tuple:
+            if entry[0] == h and entry[1] == key:
+                if entry[2] is value:
+                    return self, False
+                new_entry, added = (h, key, value), False
+            else:
+                new_entry, added = (
+                    _merge_(shift + _BITS_, entry, (h, key, value), owner),
+                    True,
+                )
+        else:
+            new_entry, added = entry.assoc(shift + _BITS_, h, key, value, owner)
+            if new_entry is entry:
+                return self, added
+        node = self._editable_(owner)
+        node.entries[i] = new_entry
+        return node, added
+
+    # returns the new entry for the parent (node, single leaf or None) and whether
+    #   the key was found
+    def dissoc(self, shift: int, h: int, key, owner: object | None):
+        bit = _bit_(h, shift)
+        if not self.bitmap & bit:
+            return self, False
+        i = _index_(self.bitmap, bit)
+        entry = self.entries[i]
+        if type(entry) is tuple:
+            if entry[0] != h or entry[1] != key:
+                return self, False
+            new_entry = None
+        else:
+            new_entry, removed = entry.dissoc(shift + _BITS_, h, key, owner)
+            if not removed:
+                return self, False
+        if new_entry is None:
+            if len(self.entries) == 1:
+                return None, True
+            if len(self.entries) == 2 and shift > 0:
+                # collapse into the remaining leaf
+                other = self.entries[1 - i]
+                if type(other) is tuple:
+                    return other, True
+            node = self._editable_(owner)
+            del node.entries[i]
+            node.bitmap &= ~bit
+            return node, True
+        if type(new_entry) is tuple and len(self.entries) == 1 and shift > 0:
+            return new_entry, True
+        node = self._editable_(owner)
+        node.entries[i] = new_entry
+        return node, True
+
+    def __iter__(self) -> Iterator[tuple]:
+        for entry in self.entries:
+            if type(entry) is tuple:
+                yield entry
+            else:
+                yield from entry
+
+
+# keys with the same full hash
+class _Collision_:
+    __slots__ = ("entries",)
+
+    def __init__(self, entries: list):
+        self.entries = entries
+
+    def find(self, shift: int, h: int, key, default):
+        for _h, entry_key, value in self.entries:
+            if entry_key == key:
+                return value
+        return default
+
+    def assoc(self, shift: int, h: int, key, value, owner: object | None):
+        for i, (_h, entry_key, _value) in enumerate(self.entries):
+            if entry_key == key:
+                entries = [*self.entries]
+                entries[i] = (h, key, value)
+                return _Collision_(entries), False
+        return _Collision_([*self.entries, (h, key, value)]), True
+
+    def dissoc(self, shift: int, h: int, key, owner: object | None):
+        entries = [entry for entry in self.entries if entry[1] != key]
+        if len(entries) == len(self.entries):
+            return self, False
+        if len(entries) == 1:
+            return entries[0], True
+        return _Collision_(entries), True
+
+    def __iter__(self) -> Iterator[tuple]:
+        return iter(self.entries)
+
+
+def _merge_(shift: int, first: tuple, second: tuple, owner: object | None):
+    if shift >= _HASH_BITS_:
+        return _Collision_([first, second])
+    first_bit, second_bit = _bit_(first[0], shift), _bit_(second[0], shift)
+    if first_bit == second_bit:
+        return _Node_(first_bit, [_merge_(shift + _BITS_, first, second, owner)], owner)
+    entries = [first, second] if first_bit < second_bit else [second, first]
+    return _Node_(first_bit | second_bit, entries, owner)
+
+
+_EMPTY_NODE_ = _Node_(0, [], None)
+_MISSING_ = object()
+
+
+# immutable mapping. set/delete return a new map sharing all untouched nodes.
+#   iterates in hash order (not in insertion order)
+class PersistentMap[K, V](Mapping[K, V]):
+    __slots__ = ("_root_", "_len_")
+
+    def __init__(self, items: Mapping[K, V] | None = None):
+        self._root_ = _EMPTY_NODE_
+        self._len_ = 0
+        if items:
+            mutation = MapMutation(self)
+            for key, value in items.items():
+                mutation.set(key, value)
+            self._root_, self._len_ = mutation._root_, len(mutation)
+
+    @staticmethod
+    def _from_root_(root: _Node_, length: int) -> "PersistentMap[K, V]":
+        new = PersistentMap.__new__(PersistentMap)
+        new._root_, new._len_ = root, length
+        return new
+
+    def set(self, key: K, value: V) -> "PersistentMap[K, V]":
+        root, added = self._root_.assoc(0, _hash_(key), key, value, None)
+        if root is self._root_:
+            return self
+        return PersistentMap._from_root_(root, self._len_ + added)
+
+    # missing keys are ignored
+    def delete(self, key: K) -> "PersistentMap[K, V]":
+        root, removed = self._root_.dissoc(0, _hash_(key), key, None)
+        if not removed:
+            return self
+        return PersistentMap._from_root_(root or _EMPTY_NODE_, self._len_ - 1)
+
+    # batch of in place updates, see MapMutation
+    def mutate(self) -> "MapMutation[K, V]":
+        return MapMutation(self)
+
+    def finish(self) -> "PersistentMap[K, V]":
+        return self
+
+    def __getitem__(self, key: K) -> V:
+        value = self._root_.find(0, _hash_(key), key, _MISSING_)
+        if value is _MISSING_:
+            raise KeyError(key)
+        return value
+
+    def get(self, key: K, default=None):
+        return self._root_.find(0, _hash_(key), key, default)
+
+    def __contains__(self, key) -> bool:
+        return self._root_.find(0, _hash_(key), key, _MISSING_) is not _MISSING_
+
+    def __iter__(self) -> Iterator[K]:
+        return (key for _h, key, _value in self._root_)
+
+    def items(self):
+        return [(key, value) for _h, key, value in self._root_]
+
+    def values(self):
+        return [value for _h, _key, value in self._root_]
+
+    def __len__(self) -> int:
+        return self._len_
+
+    def __repr__(self) -> str:
+        return f"PersistentMap({dict(self.items())})"
+
+    @classmethod
+    def __get_pydantic_core_schema__(
+        cls, source: Any, handler: GetCoreSchemaHandler
+    ) -> core_schema.CoreSchema:
+        key_type, value_type = get_args(source) or (Any, Any)
+        dict_schema = handler.generate_schema(dict[key_type, value_type])
+        from_dict_schema = core_schema.no_info_after_validator_function(
+            cls, dict_schema
+        )
+        return core_schema.json_or_python_schema(
+            json_schema=from_dict_schema,
+            python_schema=core_schema.union_schema(
+                [core_schema.is_instance_schema(cls), from_dict_schema]
+            ),
+            serialization=core_schema.plain_serializer_function_ser_schema(
+                lambda persistent_map: dict(persistent_map.items()),
+                return_schema=dict_schema,
+            ),
+        )
+
+
+# transient view of a PersistentMap for batches of updates: nodes copied once
+#   during the batch are updated in place afterwards. finish() hands out an
+#   immutable map and ends the batch
+class MapMutation[K, V](Mapping[K, V]):
+    __slots__ = ("_root_", "_len_", "_owner_")
+
+    def __init__(self, persistent_map: PersistentMap[K, V]):
+        self._root_ = persistent_map._root_
+        self._len_ = persistent_map._len_
+        self._owner_ = object()
+
+    def set(self, key: K, value: V) -> "MapMutation[K, V]":
+        assert self._owner_ is not None, "mutation already finished"
+        self._root_, added = self._root_.assoc(0, _hash_(key), key, value, self._owner_)
+        self._len_ += added
+        return self
+
+    def delete(self, key: K) -> "MapMutation[K, V]":
+        assert self._owner_ is not None, "mutation already finished"
+        root, removed = self._root_.dissoc(0, _hash_(key), key, self._owner_)
+        if removed:
+            self._root_ = root or _EMPTY_NODE_
+            self._len_ -= 1
+        return self
+
+    def mutate(self) -> "MapMutation[K, V]":
+        return self
+
+    def finish(self) -> PersistentMap[K, V]:
+        self._owner_ = None
+        return PersistentMap._from_root_(self._root_, self._len_)
+
+    def __getitem__(self, key: K) -> V:
+        value = self._root_.find(0, _hash_(key), key, _MISSING_)
+        if value is _MISSING_:
+            raise KeyError(key)
+        return value
+
+    def get(self, key: K, default=None):
+        return self._root_.find(0, _hash_(key), key, default)
+
+    def __contains__(self, key) -> bool:
+        return self._root_.find(0, _hash_(key), key, _MISSING_) is not _MISSING_
+
+    def __iter__(self) -> Iterator[K]:
+        return (key for _h, key, _value in self._root_)
+
+    def __len__(self) -> int:
+        return self._len_
@@ -0,0 +1,197 @@
+import bisect
+from typing import Iterator
+
+# persistent b+ tree: leaves hold up to _MAX_ sorted keys, inner nodes up to
+#   _MAX_ children. like the PersistentMap, updates copy the path to the changed
+#   leaf and share everything else, and nodes owned by a running mutation are
+#   updated in place. underfull nodes are not merged, empty ones are dropped
+_MAX_ = 64
+
+
+# keys[i] is a lower bound of the keys below children[i], and greater than all
+#   keys below children[i - 1]. leaves have no children
+class _SortedNode_:
+    __slots__ = ("keys", "children", "owner")
+
+    def __init__(self, keys: list, children: list | None, owner: object | None):
+        self.keys = keys
+        self.children = children
+        self.owner = owner
+
+    def _editable_(self, owner: object | None) -> "_SortedNode_":
+        if owner is not None and self.owner is owner:
+            return self
+        children = None if self.children is None else [*self.children]
+        return _SortedNode_([*self.keys], children, owner)
+
+    def _split_(self, owner: object | None) -> "_SortedNode_":
+        half = len(self.keys) // 2
+        children = None if self.children is None else self.children[half:]
+        right = _SortedNode_(self.keys[half:], children, owner)
+        del self.keys[half:]
+        if self.children is not None:
+            del self.children[half:]
+        return right
+
+    # returns (node, split off right sibling or None, added)
+    def add(self, key, owner: object | None) -> tuple["_SortedNode_", object, bool]:
+        if self.children is None:
+            i = bisect.bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                return self, None, False
+            node = self._editable_(owner)
+            node.keys.insert(i, key)
+        else:
+            i = max(bisect.bisect_right(self.keys, key) - 1, 0)
+            child, right, added = self.children[i].add(key, owner)
+            if not added:
+                return self, None, False
+            node = self._editable_(owner)
+            node.children[i] = child
+            if key < node.keys[i]:
+                node.keys[i] = key
+            if right is not None:
+                node.keys.insert(i + 1, right.keys[0])
+                node.children.insert(i + 1, right)
+        right = node._split_(owner) if len(node.keys) > _MAX_ else None
+        return node, right, True
+
+    # returns (node or None once empty, removed)
+    def discard(self, key, owner: object | None) -> tuple["_SortedNode_ | None", bool]:
+        if self.children is None:
+            i = bisect.bisect_left(self.keys, key)
+            if i == len(self.keys) or self.keys[i] != key:
+                return self, False
+            if len(self.keys) == 1:
+                return None, True
+            node = self._editable_(owner)
+            del node.keys[i]
+            return node, True
+        i = max(bisect.bisect_right(self.keys, key) - 1, 0)
+        child, removed = self.children[i].discard(key, owner)
+        if not removed:
+            return self, False
+        if child is None and len(self.children) == 1:
+            return None, True
+        node = self._editable_(owner)
+        if child is None:
+            del node.keys[i]
+            del node.children[i]
+        else:
+            node.children[i] = child
+        return node, True
+
+    # keys in [lo, hi), bounds of None are open
+    def range(self, lo, hi, reverse: bool) -> Iterator:
+        keys = self.keys
+        if self.children is None:
+            start = 0 if lo is None else bisect.bisect_left(keys, lo)
+            end = len(keys) if hi is None else bisect.bisect_left(keys, hi)
+            return reversed(keys[start:end]) if reverse else iter(keys[start:end])
+        start = 0 if lo is None else max(bisect.bisect_right(keys, lo) - 1, 0)
+        end = len(keys) if hi is None else max(bisect.bisect_left(keys, hi), 1)
+        children = self.children[start:end]
+        if reverse:
+            children.reverse()
+        return (key for child in children for key in child.range(lo, hi, reverse))
+
+    def __contains__(self, key) -> bool:
+        node = self
+        while node.children is not None:
+            node = node.children[max(bisect.bisect_right(node.keys, key) - 1, 0)]
+        i = bisect.bisect_left(node.keys, key)
+        return i < len(node.keys) and node.keys[i] == key
+
+
+_EMPTY_LEAF_ = _SortedNode_([], None, None)
+
+
+# immutable sorted set of mutually comparable keys with range scans. add/discard
+#   return a new set, unless called between mutate() and finish(), which update
+#   in place (like MapMutation, but as one class)
+class PersistentSortedSet:
+    __slots__ = ("_root_", "_len_", "_owner_")
+
+    def __init__(
+        self,
+        keys=(),
+        *,
+        _root_: _SortedNode_ = _EMPTY_LEAF_,
+        _len_: int = 0,
+        _owner_: object | None = None,
+    ):
+        self._root_ = _root_
+        self._len_ = _len_
+        self._owner_ = _owner_
+        if keys:
+            mutation = self.mutate()
+            for key in keys:
+                mutation.add(key)
+            self._root_, self._len_ = mutation._root_, mutation._len_
+
+    def _updated_(self, root: _SortedNode_, length: int) -> "PersistentSortedSet":
+        if self._owner_ is not None:
+            self._root_, self._len_ = root, length
+            return self
+        return PersistentSortedSet(_root_=root, _len_=length)
+
+    def add(self, key) -> "PersistentSortedSet":
+        root, right, added = self._root_.add(key, self._owner_)
+        if not added:
+            return self
+        if right is not None:
+            root = _SortedNode_(
+                [root.keys[0], right.keys[0]], [root, right], self._owner_
+            )
+        return self._updated_(root, self._len_ + 1)
+
+    # missing keys are ignored
+    def discard(self, key) -> "PersistentSortedSet":
+        root, removed = self._root_.discard(key, self._owner_)
+        if not removed:
+            return self
+        if root is None:
+            root = _EMPTY_LEAF_
+        elif root.children is not None and len(root.children) == 1:
+            root = root.children[0]
+        return self._updated_(root, self._len_ - 1)
+
+    def mutate(self) -> "PersistentSortedSet":
+        return PersistentSortedSet(
+            _root_=self._root_, _len_=self._len_, _owner_=object()
+        )
+
+    def finish(self) -> "PersistentSortedSet":
+        if self._owner_ is None:
+            return self
+        self._owner_ = None
+        return PersistentSortedSet(_root_=self._root_, _len_=self._len_)
+
+    # smallest key, None if empty (leaves are never empty, unless the root is)
+    def first(self):
+        node = self._root_
+        while node.children is not None:
+            node = node.children[0]
+        return node.keys[0] if node.keys else None
+
+    def last(self):
+        node = self._root_
+        while node.children is not None:
+            node = node.children[-1]
+        return node.keys[-1] if node.keys else None
+
+    # keys in [lo, hi) in ascending (or descending) order. None bounds are open
+    def range(self, lo=None, hi=None, reverse: bool = False) -> Iterator:
+        return self._root_.range(lo, hi, reverse)
+
+    def __iter__(self) -> Iterator:
+        return self._root_.range(None, None, False)
+
+    def __contains__(self, key) -> bool:
+        return key in self._root_
+
+    def __len__(self) -> int:
+        return self._len_
+
+    def __repr__(self) -> str:
+        return f"PersistentSortedSet({[*self]})"
@@ -0,0 +1,53 @@
+import hashlib
+from typing import Callable, Hashable
+
+from cocktail_24.cocktail.cocktail_bookkeeping import CocktailBarState
+
+
+class CachedBody:
+    __slots__ = ("state", "etag", "body")
+
+    def __init__(self, state: CocktailBarState, etag: str, body: bytes):
+        self.state = state
+        self.etag = etag
+        self.body = body
+
+
+# serialized response bodies per endpoint (key), built once per bar state
+#   version. the etag leads with the state version and ends with a hash of the
+#   body, so it also changes when compaction rewrites a version or the history
+#   is not the same after a restart
+class VersionedResponseCache:
+
+    def __init__(self, max_entries: int = 256):
+        self._max_entries_ = max_entries
+        self._entries_: dict[Hashable, CachedBody] = {}
+
+    def get(
+        self,
+        key: Hashable,
+        state: CocktailBarState,
+        build: Callable[[CocktailBarState], bytes],
+    ) -> CachedBody:
+        entry = self._entries_.get(key)
+        if entry is not None and entry.state is state:
+            return entry
+        body = build(state)
+        digest = hashlib.blake2b(body, digest_size=8).hexdigest()
+        entry = CachedBody(state, f'"{state.version}-{digest}"', body)
+        # evict the least recently built entry
+        self._entries_.pop(key, None)
+        if len(self._entries_) >= self._max_entries_:
+            del self._entries_[next(iter(self._entries_))]
+        self._entries_[key] = entry
+        return entry
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    # weak comparison, as required for If-None-Match
+    return "*" in candidates or etag in (
+        candidate.removeprefix("W/") for candidate in candidates
+    )
@@ -1,5 +1,7 @@
 import datetime
 import logging
+import time
+from concurrent.futures import Future
 from typing import Protocol, Iterable
 
 from cocktail_24.cocktail.cocktail_api import (
@@ -27,8 +29,14 @@ from cocktail_24.planning.cocktail_planner import (
     IngredientsMissingException,
 )
 from cocktail_24.planning.cocktail_planning import StaticCocktailPlanning
+from cocktail_24.metrics import REGISTRY
 from cocktail_24.pump_interface.pump_interface import PumpStatus
 
+# rate(count) is the management loop rate
+CHECK_UPDATE_SECONDS = REGISTRY.histogram(
+    "cocktail_check_update_seconds", "time of one management update"
+)
+
 
 class CocktailManagementCocktailSystem(Protocol):
 
@@ -74,6 +82,11 @@ class FakeFulfillmentSystem(CocktailManagementCocktailSystem):
         )
 
 
+def _log_commit_failure_(durable: Future) -> None:
+    if durable.exception() is not None:
+        logging.error(f"commit of management events failed: {durable.exception()}")
+
+
 class CocktailManagement:
 
     def __init__(
@@ -135,13 +148,18 @@ class CocktailManagement:
             )
             for event in events
         ]
-        self._persistence_.persist_events(timed_events)
+        durable = self._persistence_.persist_events(timed_events)
+        # the state is updated right away. with a write behind persistence only
+        #   the commit is left, which must not hold up the robot loop
+        if durable is not None:
+            durable.add_done_callback(_log_commit_failure_)
 
     def abort(self):
         if self._active_order_ is not None:
             self._persist_([OrderAbortedEvent(self._active_order_.order_id)])
 
     def check_update(self):
+        started = time.perf_counter()
         # TODO: this read might contain stale data (if persistence is async)
         bar_state = self._persistence_.get_current_state()
         new_system_state = self._system_.get_state()
@@ -174,5 +192,6 @@ class CocktailManagement:
                     self._active_order_ = next_order
                 except IngredientsMissingException as e:
                     logging.warning(f"order cannot be handled {e}")
+        CHECK_UPDATE_SECONDS.observe(time.perf_counter() - started)
 
         # self._old_system_state_ = new_system_state
@@ -15,6 +15,25 @@ from cocktail_24.cocktail_system import (
     CocktailRobotSendResponse,
     CocktailRobotSendEffect,
 )
+from cocktail_24.metrics import REGISTRY
+
+# the pump board expects a steady stream of messages (watchdog bit)
+PUMP_MESSAGE_INTERVAL_SECONDS = REGISTRY.histogram(
+    "cocktail_pump_message_interval_seconds", "time between pump messages"
+)
+
+
+class _PumpCadence_:
+    __slots__ = ("_last_sent_",)
+
+    def __init__(self):
+        self._last_sent_: float | None = None
+
+    def sent(self) -> None:
+        now = time.perf_counter()
+        if self._last_sent_ is not None:
+            PUMP_MESSAGE_INTERVAL_SECONDS.observe(now - self._last_sent_)
+        self._last_sent_ = now
 
 
 def run_command_gen_sync(robo_socket, G):
@@ -38,6 +57,7 @@ def cocktail_runtime[
     pump_serial: serial.Serial,
     cocktail_gen: Generator[CocktailSystemEffect, Any, T],
 ):
+    pump_cadence = _PumpCadence_()
     try:
         to_handle = next(cocktail_gen)
         while True:
@@ -46,6 +66,7 @@ def cocktail_runtime[
                     to_handle = cocktail_gen.send(GetTimeResponse(time=time.time()))
                 case PumpSendEffect(to_send=to_send):
                     pump_serial.write(to_send)
+                    pump_cadence.sent()
                     to_handle = cocktail_gen.send(PumpSendResponse())
                 case CocktailRobotSendEffect(to_send=to_send):
                     if to_send is not None:
@@ -80,6 +101,7 @@ async def async_cocktail_runtime(cocktail_gen):
         reader, writer = await open_serial_connection(
             url="/dev/ttyUSB0", baudrate=115200
         )
+    pump_cadence = _PumpCadence_()
     try:
         # print("FEED")
         to_handle = next(cocktail_gen)
@@ -90,6 +112,7 @@ async def async_cocktail_runtime(cocktail_gen):
                     to_handle = cocktail_gen.send(GetTimeResponse(time=time.time()))
                 case PumpSendEffect(to_send=to_send):
                     writer.write(to_send)
+                    pump_cadence.sent()
                     to_handle = cocktail_gen.send(PumpSendResponse())
                 case CocktailRobotSendEffect(to_send=to_send):
                     if to_send is not None:
@@ -0,0 +1,272 @@
+import abc
+import bisect
+import math
+import threading
+from typing import Callable
+
+# seconds, from tens of microseconds (state updates) to seconds (planning, io)
+LATENCY_BUCKETS_IN_S = (
+    1e-5,
+    2.5e-5,
+    5e-5,
+    1e-4,
+    2.5e-4,
+    5e-4,
+    1e-3,
+    2.5e-3,
+    5e-3,
+    1e-2,
+    2.5e-2,
+    5e-2,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+def _format_value_(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
+
+
+def _format_labels_(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    escaped = (
+        value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in values
+    )
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+    return "{" + pairs + "}"
+
+
+# the children hold the values of one label combination. every update takes an
+#   uncontended lock (well below a microsecond), so samples from the runtime
+#   loop, the persistence threads and the api never get lost
+class _CounterChild_:
+    __slots__ = ("_lock_", "value")
+
+    def __init__(self):
+        self._lock_ = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock_:
+            self.value += amount
+
+
+class _GaugeChild_:
+    __slots__ = ("_lock_", "value", "function")
+
+    def __init__(self):
+        self._lock_ = threading.Lock()
+        self.value = 0.0
+        # if set, the value is read from it when scraped
+        self.function: Callable[[], float] | None = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock_:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.inc(-amount)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self.function = function
+
+    def get(self) -> float:
+        return self.function() if self.function is not None else self.value
+
+
+class _HistogramChild_:
+    __slots__ = ("_lock_", "_bounds_", "counts", "sum")
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self._lock_ = threading.Lock()
+        self._bounds_ = bounds
+        # per bucket (not cumulative), the last one is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        # buckets are upper bounds (le), inclusive
+        i = bisect.bisect_left(self._bounds_, value)
+        with self._lock_:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class _Metric_(abc.ABC):
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._lock_ = threading.Lock()
+        self._children_: dict[tuple[str, ...], object] = {}
+        # the child for metrics without labels, so updates skip the lookup
+        self._unlabeled_ = self.labels() if not labelnames else None
+
+    @abc.abstractmethod
+    def _new_child_(self): ...
+
+    # resolve once and keep the child on hot paths
+    def labels(self, *values) -> object:
+        values = tuple(str(value) for value in values)
+        child = self._children_.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._lock_:
+                child = self._children_.setdefault(values, self._new_child_())
+        return child
+
+    @abc.abstractmethod
+    def _samples_(self) -> list[str]: ...
+
+    def expose(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} {self.kind}",
+            *self._samples_(),
+        ]
+        return "\n".join(lines)
+
+
+class Counter(_Metric_):
+    kind = "counter"
+
+    def _new_child_(self) -> _CounterChild_:
+        return _CounterChild_()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._unlabeled_.inc(amount)
+
+    def _samples_(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels_(self.labelnames, values)} "
+            f"{_format_value_(child.value)}"
+            for values, child in [*self._children_.items()]
+        ]
+
+
+class Gauge(_Metric_):
+    kind = "gauge"
+
+    def _new_child_(self) -> _GaugeChild_:
+        return _GaugeChild_()
+
+    def set(self, value: float) -> None:
+        self._unlabeled_.set(value)
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._unlabeled_.inc(amount)
+
+    def dec(self, amount: float = 1.0) -> None:
+        self._unlabeled_.dec(amount)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._unlabeled_.set_function(function)
+
+    def _samples_(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels_(self.labelnames, values)} "
+            f"{_format_value_(child.get())}"
+            for values, child in [*self._children_.items()]
+        ]
+
+
+class Histogram(_Metric_):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: tuple[str, ...],
+        buckets: tuple[float, ...],
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames)
+
+    def _new_child_(self) -> _HistogramChild_:
+        return _HistogramChild_(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self._unlabeled_.observe(value)
+
+    def _samples_(self) -> list[str]:
+        samples = []
+        bucket_labelnames = (*self.labelnames, "le")
+        for values, child in [*self._children_.items()]:
+            with child._lock_:
+                counts, total = [*child.counts], child.sum
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                labels = _format_labels_(
+                    bucket_labelnames, (*values, _format_value_(bound))
+                )
+                samples.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels_(self.labelnames, values)
+            samples.append(f"{self.name}_sum{labels} {_format_value_(total)}")
+            samples.append(f"{self.name}_count{labels} {cumulative}")
+        return samples
+
+
+# named metrics, exported in the prometheus text format (version 0.0.4).
+#   registering a name again returns the existing metric
+class MetricsRegistry:
+
+    def __init__(self):
+        self._lock_ = threading.Lock()
+        self._metrics_: dict[str, _Metric_] = {}
+
+    def _register_(self, metric_type: type, name: str, *args) -> _Metric_:
+        with self._lock_:
+            metric = self._metrics_.get(name)
+            if metric is None:
+                metric = self._metrics_[name] = metric_type(name, *args)
+            elif type(metric) is not metric_type:
+                raise ValueError(f"{name} is already a {metric.kind}")
+            return metric
+
+    def counter(
+        self, name: str, help_text: str, labelnames: tuple[str, ...] = ()
+    ) -> Counter:
+        return self._register_(Counter, name, help_text, labelnames)
+
+    def gauge(
+        self, name: str, help_text: str, labelnames: tuple[str, ...] = ()
+    ) -> Gauge:
+        return self._register_(Gauge, name, help_text, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS_IN_S,
+    ) -> Histogram:
+        return self._register_(Histogram, name, help_text, labelnames, buckets)
+
+    def expose(self) -> str:
+        with self._lock_:
+            metrics = [*self._metrics_.values()]
+        return "".join(metric.expose() + "\n" for metric in metrics)
+
+
+# the process wide registry served at /metrics
+REGISTRY = MetricsRegistry()
@@ -4,7 +4,11 @@ from collections import defaultdict
 from dataclasses import dataclass
 from typing import Sequence, Protocol, Generator
 
-from cocktail_24.cocktail.cocktail_bookkeeping import SlotStatus
+from cocktail_24.cocktail.cocktail_bookkeeping import (
+    SlotStatus,
+    SlotInventory,
+    SlotLookup,
+)
 from cocktail_24.cocktail.cocktail_recipes import (
     CocktailRecipe,
     CocktailRecipeStep,
@@ -66,7 +70,53 @@ class SimpleRobotMotionPlanner(RobotMotionPlanner):
             yield CocktailRobotMoveTask(to_pos=pos)
 
 
-SlotLookup = dict[str, dict[int, IngredientAmount]]
+# shortest move paths between all pairs of positions, built once per move graph
+#   (a breadth first search towards every target over the reversed edges), so a
+#   move costs O(path length). positions are taken from the edges, a graph with
+#   more positions just needs its own planner. ties between equally short paths
+#   go to the earlier edge
+class PrecomputedRobotMotionPlanner(RobotMotionPlanner):
+
+    def __init__(
+        self,
+        moves: Sequence[tuple[CocktailPosition, CocktailPosition]] = (
+            ALLOWED_COCKTAIL_MOVES
+        ),
+    ):
+        predecessors = defaultdict(list)
+        for from_pos, to_pos in moves:
+            predecessors[to_pos].append(from_pos)
+        # (from, target) -> next position on a shortest path
+        next_hop = {}
+        for target in predecessors:
+            frontier = [target]
+            reached = {target}
+            while frontier:
+                next_frontier = []
+                for pos in frontier:
+                    for pred in predecessors.get(pos, ()):
+                        if pred not in reached:
+                            reached.add(pred)
+                            next_hop[(pred, target)] = pos
+                            next_frontier.append(pred)
+                frontier = next_frontier
+        self._paths_: dict[tuple, tuple[CocktailRobotMoveTask, ...]] = {}
+        for (from_pos, target), pos in next_hop.items():
+            path = [pos]
+            while pos != target:
+                pos = next_hop[(pos, target)]
+                path.append(pos)
+            self._paths_[(from_pos, target)] = tuple(
+                CocktailRobotMoveTask(to_pos=pos) for pos in path
+            )
+
+    def gen_plan_move(self, from_pos: CocktailPosition, to_pos: CocktailPosition):
+        if from_pos == to_pos:
+            return
+        path = self._paths_.get((from_pos, to_pos))
+        if path is None:
+            raise ValueError(f"no moves from {from_pos} to {to_pos}")
+        yield from path
 
 
 @dataclass(frozen=True)
@@ -89,7 +139,9 @@ class SlotAmounts:
         return SlotAmounts(slots_lookup=resulting_amounts)
 
     @staticmethod
-    def from_slots(slots: Sequence[SlotStatus]) -> "SlotAmounts":
+    def from_slots(slots: Sequence[SlotStatus] | SlotInventory) -> "SlotAmounts":
+        if isinstance(slots, SlotInventory):
+            return SlotAmounts(slots_lookup=slots.station_amounts())
         res: defaultdict[str, dict[int, IngredientAmount]] = defaultdict(dict)
         for slot in slots:
             # no duplicates
@@ -157,7 +209,8 @@ class SimpleRobotIngredientPlanner(RobotIngredientPlanner):
             remaining_amount = amount.amount_in_ml
             # prefer pump over zapf if possible
             for station in (pump_station_id, zapf_station_id):
-                for slot_id, ia in available_slot_amounts.slots_lookup[station].items():
+                station_amounts = available_slot_amounts.slots_lookup.get(station, {})
+                for slot_id, ia in station_amounts.items():
                     if (
                         remaining_amount
                         < SimpleRobotIngredientPlanner.minimum_amount_in_ml
@@ -190,7 +243,7 @@ class DefaultRecipeCocktailPlanner(CocktailPlanner):
         recipe: CocktailRecipe,
         motion_planner: RobotMotionPlanner,
         ingredient_planner: RobotIngredientPlanner,
-        slots_status: Sequence[SlotStatus],
+        slots_status: Sequence[SlotStatus] | SlotInventory,
         robot_position: CocktailPosition,
         shaker_empty: bool,
     ):
@@ -1,3 +1,4 @@
+import time
 import uuid
 from collections import defaultdict
 from typing import Protocol, Sequence
@@ -7,6 +8,7 @@ from cocktail_24.cocktail.cocktail_bookkeeping import (
     SlotStatus,
     SlotPath,
     AmountPouredEvent,
+    SlotInventory,
 )
 from cocktail_24.cocktail.cocktail_recipes import CocktailRecipe
 from cocktail_24.cocktail_robo import (
@@ -25,6 +27,11 @@ from cocktail_24.planning.cocktail_planner import (
     RobotMotionPlanner,
     RobotIngredientPlanner,
 )
+from cocktail_24.metrics import REGISTRY
+
+PLAN_SECONDS = REGISTRY.histogram(
+    "cocktail_plan_cocktail_seconds", "time to plan a cocktail"
+)
 
 
 class RecipeCocktailPlannerFactory(Protocol):
@@ -32,7 +39,7 @@ class RecipeCocktailPlannerFactory(Protocol):
     def get_planner(
         self,
         recipe: CocktailRecipe,
-        slots_status: Sequence[SlotStatus],
+        slots_status: Sequence[SlotStatus] | SlotInventory,
         robot_position: CocktailPosition,
         shaker_empty: bool,
     ) -> CocktailPlanner: ...
@@ -53,7 +60,7 @@ class DefaultRecipeCocktailPlannerFactory(RecipeCocktailPlannerFactory):
     def get_planner(
         self,
         recipe: CocktailRecipe,
-        slots_status: Sequence[SlotStatus],
+        slots_status: Sequence[SlotStatus] | SlotInventory,
         robot_position: CocktailPosition,
         shaker_empty: bool,
     ) -> CocktailPlanner:
@@ -73,7 +80,7 @@ class StaticCocktailPlanning(Protocol):
     def plan_cocktail(
         self,
         recipe: CocktailRecipe,
-        slots_status: Sequence[SlotStatus],
+        slots_status: Sequence[SlotStatus] | SlotInventory,
         robot_position: CocktailPosition,
         shaker_empty: bool,
     ) -> CocktailSystemPlan: ...
@@ -94,15 +101,17 @@ class DefaultStaticCocktailPlanning(StaticCocktailPlanning):
     def plan_cocktail(
         self,
         recipe: CocktailRecipe,
-        slots_status: Sequence[SlotStatus],
+        slots_status: Sequence[SlotStatus] | SlotInventory,
         robot_position: CocktailPosition,
         shaker_empty: bool,
     ) -> CocktailSystemPlan:
+        started = time.perf_counter()
         planner = self.planner_factory.get_planner(
             recipe, slots_status, robot_position, shaker_empty
         )
         steps = tuple([*planner.gen_plan_pour_cocktail()])
         plan = CocktailSystemPlan(plan_uuid=uuid.uuid4(), steps=steps)
+        PLAN_SECONDS.observe(time.perf_counter() - started)
         return plan
 
     def get_consequences(
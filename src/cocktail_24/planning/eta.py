@@ -0,0 +1,280 @@
+import logging
+import threading
+import time
+from typing import Callable, Iterable
+
+from pydantic.dataclasses import dataclass
+
+from cocktail_24.cocktail.cocktail_bookkeeping import (
+    CocktailBarState,
+    Order,
+    OrderId,
+    OrderStatus,
+    SlotInventory,
+)
+from cocktail_24.cocktail.cocktail_recipes import CocktailRecipe, RecipeId
+from cocktail_24.cocktail_robo import (
+    CocktailRobotMoveTask,
+    CocktailRobotZapfTask,
+    CocktailRobotShakeTask,
+    CocktailRobotPourTask,
+    CocktailRobotCleanTask,
+    CocktailRobotPumpTask,
+    CocktailPosition,
+)
+from cocktail_24.cocktail_system import CocktailSystemPlan
+from cocktail_24.planning.cocktail_planner import IngredientsMissingException
+from cocktail_24.planning.cocktail_planning import StaticCocktailPlanning
+
+
+# rough robot time per task. pumps run in parallel, so a pump task takes as
+#   long as its longest slot
+@dataclass(frozen=True)
+class TaskCostModel:
+    move_in_s: float = 3.0
+    zapf_in_s: float = 2.5
+    single_shake_in_s: float = 2.0
+    pour_in_s: float = 6.0
+    clean_in_s: float = 15.0
+    pump_overhead_in_s: float = 1.0
+    # for orders that cannot be planned (missing recipe or ingredients)
+    unplannable_in_s: float = 90.0
+
+
+def estimate_task_duration(task, cost_model: TaskCostModel) -> float:
+    match task:
+        case CocktailRobotMoveTask():
+            return cost_model.move_in_s
+        case CocktailRobotZapfTask():
+            return cost_model.zapf_in_s
+        case CocktailRobotShakeTask(num_shakes=num_shakes):
+            return num_shakes * cost_model.single_shake_in_s
+        case CocktailRobotPourTask():
+            return cost_model.pour_in_s
+        case CocktailRobotCleanTask():
+            return cost_model.clean_in_s
+        case CocktailRobotPumpTask(durations_in_s=durations_in_s):
+            return max(durations_in_s, default=0.0) + cost_model.pump_overhead_in_s
+    raise ValueError(f"unknown task {task}")
+
+
+def estimate_plan_duration(
+    plan: CocktailSystemPlan, cost_model: TaskCostModel
+) -> float:
+    return sum(estimate_task_duration(step, cost_model) for step in plan.steps)
+
+
+# fenwick tree of durations over positions. positions are handed out in
+#   enqueue order and never reused, the tree grows by doubling
+class _DurationTree_:
+    __slots__ = ("_sums_",)
+
+    def __init__(self, durations: list[float]):
+        # _sums_[i] covers positions (i - lowbit(i), i], 1 based
+        sums = [0.0, *durations]
+        for i in range(1, len(sums)):
+            parent = i + (i & -i)
+            if parent < len(sums):
+                sums[parent] += sums[i]
+        self._sums_ = sums
+
+    def capacity(self) -> int:
+        return len(self._sums_) - 1
+
+    def add(self, position: int, delta: float) -> None:
+        i = position + 1
+        while i < len(self._sums_):
+            self._sums_[i] += delta
+            i += i & -i
+
+    # sum of the durations at positions <= position
+    def prefix_sum(self, position: int) -> float:
+        i = position + 1
+        total = 0.0
+        while i > 0:
+            total += self._sums_[i]
+            i -= i & -i
+        return total
+
+
+# estimated time until each queued (or executing) order is ready: the rest of
+#   the executing order plus the plan durations of all orders queued up to and
+#   including it. plan durations are cached per recipe and slot layout (planned
+#   from home with an empty shaker). the engine follows order changes
+#   incrementally (enqueue/remove and lookup are O(log n)) and only rebuilds
+#   from the state's queue if it got out of step: on startup, or after a queue
+#   purge (which changes no order, it is noticed by the queue length or by an
+#   order coming back with a new ticket)
+class EtaEngine:
+
+    def __init__(
+        self,
+        planning: StaticCocktailPlanning,
+        get_state: Callable[[], CocktailBarState],
+        cost_model: TaskCostModel = TaskCostModel(),
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._planning_ = planning
+        self._get_state_ = get_state
+        self._cost_model_ = cost_model
+        self._clock_ = clock
+        self._lock_ = threading.RLock()
+        # (recipe_id, slot layout) -> (recipe, duration). the recipe is kept to
+        #   notice recipes created again under the same id
+        self._recipe_durations_: dict[
+            tuple[RecipeId, tuple], tuple[CocktailRecipe, float]
+        ] = {}
+        self._slots_: SlotInventory | None = None
+        self._slot_layout_: tuple = ()
+        # queued order -> (position, duration, ticket in the state's queue)
+        self._queued_: dict[OrderId, tuple[int, float, int | None]] = {}
+        # set when the queue order changed behind the engine's back
+        self._stale_ = False
+        self._tree_ = _DurationTree_([0.0] * 16)
+        self._next_position_ = 0
+        # (order_id, started at (clock), duration)
+        self._executing_: tuple[OrderId, float, float] | None = None
+
+    # which ingredient is in which slot, amounts left out (they change with
+    #   every pour)
+    def _layout_of_(self, slots: SlotInventory) -> tuple:
+        if slots is not self._slots_:
+            self._slots_ = slots
+            self._slot_layout_ = tuple(
+                (status.slot_path, status.ingredient_id) for status in slots
+            )
+        return self._slot_layout_
+
+    def _duration_of_(self, order: Order | None, state: CocktailBarState) -> float:
+        # the queue may hold ids of unknown orders (enqueued before they were
+        #   checked), they are priced like unplannable ones
+        if order is None:
+            return self._cost_model_.unplannable_in_s
+        recipe = state.recipes.get(order.recipe_id)
+        if recipe is None:
+            return self._cost_model_.unplannable_in_s
+        key = (order.recipe_id, self._layout_of_(state.slots))
+        cached = self._recipe_durations_.get(key)
+        if cached is not None and cached[0] is recipe:
+            return cached[1]
+        try:
+            plan = self._planning_.plan_cocktail(
+                recipe,
+                slots_status=state.slots,
+                robot_position=CocktailPosition.home,
+                shaker_empty=True,
+            )
+        except IngredientsMissingException:
+            # not cached, a refill may fix it
+            return self._cost_model_.unplannable_in_s
+        duration = estimate_plan_duration(plan, self._cost_model_)
+        self._recipe_durations_[key] = (recipe, duration)
+        return duration
+
+    def _rebuild_(self, queued: list[tuple[OrderId, float, int | None]]) -> None:
+        capacity = self._tree_.capacity()
+        while capacity < 2 * len(queued):
+            capacity *= 2
+        durations = [duration for _order_id, duration, _ticket in queued]
+        self._tree_ = _DurationTree_(durations + [0.0] * (capacity - len(durations)))
+        self._queued_ = {
+            order_id: (position, duration, ticket)
+            for position, (order_id, duration, ticket) in enumerate(queued)
+        }
+        self._next_position_ = len(queued)
+
+    def _enqueue_(self, order: Order, state: CocktailBarState) -> None:
+        ticket = state.order_queue.ticket(order.order_id)
+        entry = self._queued_.get(order.order_id)
+        if entry is not None:
+            if ticket is not None and ticket != entry[2]:
+                # queued again after a purge, possibly in another order
+                self._stale_ = True
+            return
+        if self._next_position_ == self._tree_.capacity():
+            # renumber the queued orders from 0 (at least half the tree is free
+            #   afterwards, so this is amortized O(1) per enqueue)
+            self._rebuild_(
+                [
+                    (order_id, duration, queued_ticket)
+                    for order_id, (_position, duration, queued_ticket) in sorted(
+                        self._queued_.items(), key=lambda item: item[1][0]
+                    )
+                ]
+            )
+        duration = self._duration_of_(order, state)
+        self._queued_[order.order_id] = (self._next_position_, duration, ticket)
+        self._tree_.add(self._next_position_, duration)
+        self._next_position_ += 1
+
+    def _remove_(self, order_id: OrderId) -> float | None:
+        entry = self._queued_.pop(order_id, None)
+        if entry is None:
+            return None
+        position, duration, _ticket = entry
+        self._tree_.add(position, -duration)
+        return duration
+
+    def _order_changed_(self, order: Order, state: CocktailBarState) -> None:
+        match order.status:
+            case OrderStatus.enqueued:
+                self._enqueue_(order, state)
+            case OrderStatus.executing:
+                duration = self._remove_(order.order_id)
+                if duration is None:
+                    duration = self._duration_of_(order, state)
+                self._executing_ = (order.order_id, self._clock_(), duration)
+            case _:
+                self._remove_(order.order_id)
+                if (
+                    self._executing_ is not None
+                    and self._executing_[0] == order.order_id
+                ):
+                    self._executing_ = None
+
+    # listener for the persistence's order watch (called after the state with
+    #   these changes was published)
+    def orders_changed(self, orders: Iterable[Order]) -> None:
+        state = self._get_state_()
+        with self._lock_:
+            for order in orders:
+                self._order_changed_(order, state)
+
+    def _resync_(self, state: CocktailBarState) -> None:
+        logging.info("eta engine resynced with the order queue")
+        self._rebuild_(
+            [
+                (
+                    order_id,
+                    self._duration_of_(state.orders.get(order_id), state),
+                    state.order_queue.ticket(order_id),
+                )
+                for order_id in state.order_queue
+            ]
+        )
+        self._stale_ = False
+        executing = state.projections["by_status"].order_ids(OrderStatus.executing)
+        if self._executing_ is None or self._executing_[0] not in executing:
+            self._executing_ = None
+            for order_id in executing:
+                # start unknown, assume now
+                duration = self._duration_of_(state.orders.get(order_id), state)
+                self._executing_ = (order_id, self._clock_(), duration)
+                break
+
+    # seconds until order_id is estimated to be ready, None if it is neither
+    #   queued nor executing
+    def estimate(self, order_id: OrderId, state: CocktailBarState) -> float | None:
+        with self._lock_:
+            if self._stale_ or len(self._queued_) != len(state.order_queue):
+                self._resync_(state)
+            remaining_in_s = 0.0
+            if self._executing_ is not None:
+                executing_id, started, duration = self._executing_
+                remaining_in_s = max(duration - (self._clock_() - started), 0.0)
+                if executing_id == order_id:
+                    return remaining_in_s
+            entry = self._queued_.get(order_id)
+            if entry is None:
+                return None
+            return remaining_in_s + self._tree_.prefix_sum(entry[0])
@@ -1,9 +1,19 @@
 import logging
+import time
 from asyncio import Protocol
 from dataclasses import dataclass
 from enum import Enum
 from typing import Generator, Any
 
+from cocktail_24.metrics import REGISTRY
+
+# a request is two round trips (request line, then args or an empty read)
+HOSTCTRL_SECONDS = REGISTRY.histogram(
+    "cocktail_robot_hostctrl_seconds",
+    "round trip time of a HOSTCTRL request",
+    ("command",),
+)
+
 
 @dataclass(frozen=True)
 class RobotRelays:
@@ -160,11 +170,14 @@ class RoboTcpCommands(RoboTcpInterface):
         logging.info(f"hostctrl {command}")
         has_args = args is not None
         arg_len = (len(args) + len(RoboTcpCommands.LINE_TERM)) if has_args else 0
+        # the generator is suspended while the runtime talks to the robot
+        started = time.perf_counter()
         resp = yield f"HOSTCTRL_REQUEST {command} {arg_len}"
         if not resp.startswith("OK"):
             return None
         args_to_yield = args if has_args else None
         resp = yield args_to_yield
+        HOSTCTRL_SECONDS.labels(command).observe(time.perf_counter() - started)
         logging.info(f"done hostctrl {command} {resp}")
         return resp
 
@@ -0,0 +1,80 @@
+import asyncio
+import json
+from typing import Any, AsyncIterator, Callable
+
+
+def encode_sse(event: str, data: Any) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+class _Subscriber_:
+    __slots__ = ("pending", "encoded", "changed")
+
+    def __init__(self):
+        # fields changed since the last delivery, and their encoding if they are
+        #   exactly one published delta (shared by all subscribers)
+        self.pending: dict[str, Any] = {}
+        self.encoded: bytes | None = None
+        self.changed = asyncio.Event()
+
+
+# samples a (json compatible) state at most max_rate_in_hz times per second
+#   while anyone is subscribed, and pushes the changed top level fields as server
+#   sent events. sampling and encoding happen once, independent of the number of
+#   subscribers. subscribers that fall behind get their pending deltas merged
+class StatusBroadcaster:
+
+    def __init__(
+        self, sample: Callable[[], dict[str, Any]], max_rate_in_hz: float = 10.0
+    ):
+        self._sample_ = sample
+        self._interval_in_s_ = 1.0 / max_rate_in_hz
+        self._state_: dict[str, Any] | None = None
+        self._subscribers_: set[_Subscriber_] = set()
+        self._has_subscribers_ = asyncio.Event()
+
+    def _publish_(self, state: dict[str, Any]) -> None:
+        previous = self._state_ or {}
+        delta = {
+            field: value
+            for field, value in state.items()
+            if field not in previous or previous[field] != value
+        }
+        self._state_ = state
+        if not delta:
+            return
+        encoded = encode_sse("delta", delta)
+        for subscriber in self._subscribers_:
+            if subscriber.pending:
+                subscriber.pending = {**subscriber.pending, **delta}
+                subscriber.encoded = None
+            else:
+                subscriber.pending, subscriber.encoded = delta, encoded
+            subscriber.changed.set()
+
+    async def run(self) -> None:
+        while True:
+            await self._has_subscribers_.wait()
+            self._publish_(self._sample_())
+            await asyncio.sleep(self._interval_in_s_)
+
+    # the full state first, then the deltas
+    async def subscribe(self) -> AsyncIterator[bytes]:
+        subscriber = _Subscriber_()
+        if self._state_ is None or not self._subscribers_:
+            # nobody kept the state current
+            self._publish_(self._sample_())
+        self._subscribers_.add(subscriber)
+        self._has_subscribers_.set()
+        try:
+            yield encode_sse("state", self._state_)
+            while True:
+                await subscriber.changed.wait()
+                subscriber.changed.clear()
+                pending, encoded = subscriber.pending, subscriber.encoded
+                subscriber.pending, subscriber.encoded = {}, None
+                yield encoded if encoded is not None else encode_sse("delta", pending)
+        finally:
+            self._subscribers_.discard(subscriber)
+            if not self._subscribers_:
+                self._has_subscribers_.clear()
@@ -20,7 +20,8 @@ from cocktail_24.cocktail_system import (
 from cocktail_24.planning.cocktail_planner import (
     CocktailSystemConfig,
     CocktailPumpStationConfig,
-    SimpleRobotMotionPlanner,
+    PrecomputedRobotMotionPlanner,
+    RobotMotionPlanner,
     SimpleRobotIngredientPlanner,
     SimpleRobotIngredientPlannerConfig,
     CocktailZapfStationConfig,
@@ -64,8 +65,12 @@ def configure_system() -> CocktailSystem:
     return cocktail_system
 
 
-def configure_planning(system_config: CocktailSystemConfig):
-    motion_planner = SimpleRobotMotionPlanner()
+def configure_planning(
+    system_config: CocktailSystemConfig,
+    motion_planner: RobotMotionPlanner | None = None,
+):
+    if motion_planner is None:
+        motion_planner = PrecomputedRobotMotionPlanner()
     ingredient_planner = SimpleRobotIngredientPlanner(
         config=SimpleRobotIngredientPlannerConfig(system_config=system_config)
     )
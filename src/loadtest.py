@@ -0,0 +1,386 @@
+import argparse
+import asyncio
+import contextlib
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Iterator
+
+import httpx
+from pydantic.dataclasses import dataclass
+
+# load test of the api (with api.FAKE_SYSTEM, so orders are "fulfilled" by the
+#   FakeFulfillmentSystem). starts the app under uvicorn on a fresh sqlite file
+#   (or targets --url), sends an open loop mix of requests with poisson arrivals
+#   and reports latency percentiles and throughput per endpoint. the same seed
+#   gives the same schedule and requests:
+#
+#   python src/loadtest.py --rate 100 --duration 30
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# relative frequency of each kind of traffic
+DEFAULT_MIX = {
+    "create_recipe": 1,
+    "place_order": 10,
+    "order_status": 30,
+    "list_orders": 5,
+    "orders_page": 10,
+    "system_status": 10,
+}
+
+
+@dataclass(frozen=True)
+class LoadTestConfig:
+    rate_in_hz: float = 50.0
+    duration_in_s: float = 10.0
+    seed: int = 0
+    # arrivals while this many requests are open are dropped (and counted)
+    max_in_flight: int = 256
+    # few users make the admission control reject orders (per user limit)
+    n_users: int = 1000
+    mix: dict[str, float] | None = None
+
+
+class EndpointStats:
+
+    def __init__(self):
+        self.latencies_in_s: list[float] = []
+        self.status_counts: dict[int, int] = {}
+        self.n_failed = 0
+
+    def record(self, latency_in_s: float, status_code: int | None) -> None:
+        self.latencies_in_s.append(latency_in_s)
+        if status_code is None:
+            self.n_failed += 1
+        else:
+            self.status_counts[status_code] = self.status_counts.get(status_code, 0) + 1
+
+    def percentile(self, p: float) -> float:
+        # nearest rank
+        latencies = sorted(self.latencies_in_s)
+        if not latencies:
+            return math.nan
+        return latencies[max(math.ceil(p / 100 * len(latencies)) - 1, 0)]
+
+
+class LoadTestResult:
+
+    def __init__(self, took_in_s: float, n_dropped: int):
+        self.took_in_s = took_in_s
+        self.n_dropped = n_dropped
+        self.endpoints: dict[str, EndpointStats] = {}
+
+    def stats(self, endpoint: str) -> EndpointStats:
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = EndpointStats()
+        return stats
+
+    def report(self) -> str:
+        lines = [
+            f"{'endpoint':<24} {'n':>6} {'2xx':>6} {'429':>5} {'other':>5} "
+            f"{'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+        ]
+        for endpoint, stats in sorted(self.endpoints.items()):
+            n = len(stats.latencies_in_s)
+            n_ok = sum(
+                count for status, count in stats.status_counts.items() if status < 300
+            )
+            n_rejected = stats.status_counts.get(429, 0)
+            lines.append(
+                f"{endpoint:<24} {n:>6} {n_ok:>6} {n_rejected:>5} "
+                f"{n - n_ok - n_rejected:>5} {n / self.took_in_s:>7.1f} "
+                + " ".join(f"{stats.percentile(p) * 1000:>8.1f}" for p in (50, 95, 99))
+            )
+        lines.append(f"{self.n_dropped} arrivals dropped (max in flight)")
+        return "\n".join(lines)
+
+
+# ids the traffic refers to, all drawn from the seeded rng
+class _Traffic_:
+
+    def __init__(self, rng: random.Random, n_users: int):
+        self.rng = rng
+        self.user_ids = [self.new_id() for _ in range(n_users)]
+        self.recipe_ids: list[str] = []
+        self.order_ids: list[str] = []
+
+    def new_id(self) -> str:
+        return str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
+
+
+Request = Callable[[httpx.AsyncClient], Awaitable[httpx.Response]]
+
+
+# the requests of one arrival, as (endpoint, request, on_success). everything
+#   random is drawn up front, so the sequence does not depend on timing
+def _plan_arrival_(
+    kind: str, traffic: _Traffic_
+) -> list[tuple[str, Request, Callable[[httpx.Response], None] | None]]:
+    rng = traffic.rng
+    match kind:
+        case "create_recipe":
+            recipe_id = traffic.new_id()
+            # no ingredients: the fake system fulfills them without slots
+            recipe = dict(recipe_id=recipe_id, title="load test", steps=[])
+            return [
+                (
+                    "POST /create_recipe",
+                    lambda client: client.post("/create_recipe", json=recipe),
+                    lambda _response: traffic.recipe_ids.append(recipe_id),
+                )
+            ]
+        case "place_order":
+            params = dict(
+                recipe_id=rng.choice(traffic.recipe_ids),
+                user_id=rng.choice(traffic.user_ids),
+            )
+            order_id = []
+
+            def placed(response: httpx.Response):
+                order_id.append(response.json())
+                traffic.order_ids.append(order_id[0])
+
+            return [
+                (
+                    "POST /place_order",
+                    lambda client: client.post("/place_order", params=params),
+                    placed,
+                ),
+                (
+                    "POST /enqueue_order",
+                    lambda client: client.post(
+                        "/enqueue_order", params=dict(order_id=order_id[0])
+                    ),
+                    None,
+                ),
+            ]
+        case "order_status":
+            if not traffic.order_ids:
+                return []
+            order_id = rng.choice(traffic.order_ids)
+            return [
+                (
+                    "GET /order/{id}",
+                    lambda client: client.get(f"/order/{order_id}"),
+                    None,
+                )
+            ]
+        case "list_orders":
+            return [("GET /orders", lambda client: client.get("/orders"), None)]
+        case "orders_page":
+            return [
+                (
+                    "GET /orders/page",
+                    lambda client: client.get(
+                        "/orders/page",
+                        params=dict(status="enqueued", limit=50, embed=True),
+                    ),
+                    None,
+                )
+            ]
+        case "system_status":
+            return [
+                (
+                    "GET /system/status",
+                    lambda client: client.get("/system/status"),
+                    None,
+                )
+            ]
+    raise ValueError(f"unknown traffic {kind}")
+
+
+async def _run_arrival_(
+    client: httpx.AsyncClient,
+    requests: list,
+    scheduled_at: float,
+    result: LoadTestResult,
+) -> None:
+    # latencies count from the scheduled time, so a slow server is not hidden
+    #   by sending later (coordinated omission). follow up requests count from
+    #   the end of the previous one
+    started = scheduled_at
+    for endpoint, request, on_success in requests:
+        try:
+            response = await request(client)
+        except httpx.HTTPError:
+            result.stats(endpoint).record(time.perf_counter() - started, None)
+            return
+        result.stats(endpoint).record(
+            time.perf_counter() - started, response.status_code
+        )
+        if response.status_code != 200:
+            return
+        if on_success is not None:
+            on_success(response)
+        started = time.perf_counter()
+
+
+async def run_load_test(base_url: str, config: LoadTestConfig) -> LoadTestResult:
+    rng = random.Random(config.seed)
+    traffic = _Traffic_(rng, config.n_users)
+    mix = config.mix if config.mix is not None else DEFAULT_MIX
+    kinds, weights = [*mix], [*mix.values()]
+    limits = httpx.Limits(max_connections=config.max_in_flight)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=30.0
+    ) as client:
+        # a few recipes to order from, not measured
+        for _ in range(5):
+            for _endpoint, request, on_success in _plan_arrival_(
+                "create_recipe", traffic
+            ):
+                on_success((await request(client)).raise_for_status())
+
+        n_dropped = 0
+        in_flight: set[asyncio.Task] = set()
+        started = time.perf_counter()
+        result = LoadTestResult(config.duration_in_s, 0)
+        scheduled_at = started
+        while True:
+            scheduled_at += rng.expovariate(config.rate_in_hz)
+            if scheduled_at - started >= config.duration_in_s:
+                break
+            requests = _plan_arrival_(rng.choices(kinds, weights)[0], traffic)
+            await asyncio.sleep(max(scheduled_at - time.perf_counter(), 0.0))
+            if len(in_flight) >= config.max_in_flight:
+                n_dropped += 1
+                continue
+            task = asyncio.create_task(
+                _run_arrival_(client, requests, scheduled_at, result)
+            )
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        await asyncio.gather(*in_flight)
+        result.took_in_s = time.perf_counter() - started
+        result.n_dropped = n_dropped
+        return result
+
+
+def _free_port_() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_until_up_(url: str, timeout_in_s: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout_in_s
+    while True:
+        try:
+            httpx.get(f"{url}/recipes", timeout=1.0).raise_for_status()
+            return
+        except httpx.HTTPError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+# the app under uvicorn on a fresh sqlite file. in_process shares the
+#   interpreter (and the gil) with the load generator, the default runs a
+#   separate server process
+@contextlib.contextmanager
+def serve_app(in_process: bool = False, log_path: str | None = None) -> Iterator[str]:
+    port = _free_port_()
+    url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as tempdir:
+        db_path = os.path.join(tempdir, "loadtest.db")
+        log_path = log_path or os.path.join(tempdir, "server.log")
+        if in_process:
+            import uvicorn
+
+            os.environ["COCKTAIL_DB"] = db_path
+            server = uvicorn.Server(
+                uvicorn.Config("api:app", port=port, log_level="warning")
+            )
+            thread = threading.Thread(target=server.run, daemon=True)
+            thread.start()
+            try:
+                _wait_until_up_(url)
+                yield url
+            finally:
+                server.should_exit = True
+                thread.join()
+            return
+        with open(log_path, "w") as log:
+            server = subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "uvicorn",
+                    "api:app",
+                    "--port",
+                    str(port),
+                    "--log-level",
+                    "warning",
+                ],
+                cwd=SRC_DIR,
+                env={**os.environ, "COCKTAIL_DB": db_path},
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+            try:
+                _wait_until_up_(url)
+                yield url
+            finally:
+                server.terminate()
+                server.wait()
+
+
+def _parse_mix_(text: str) -> dict[str, float]:
+    mix = {}
+    for item in text.split(","):
+        kind, weight = item.split("=")
+        if kind not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown traffic {kind}")
+        mix[kind] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="load test of the api against the fake fulfillment system"
+    )
+    parser.add_argument("--rate", type=float, default=50.0, help="arrivals per s")
+    parser.add_argument("--duration", type=float, default=10.0, help="in s")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-in-flight", type=int, default=256)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument(
+        "--mix",
+        type=_parse_mix_,
+        default=None,
+        help="e.g. place_order=1,order_status=5 (default "
+        + ",".join(f"{kind}={weight}" for kind, weight in DEFAULT_MIX.items())
+        + ")",
+    )
+    parser.add_argument("--url", default=None, help="use a running server")
+    parser.add_argument("--in-process", action="store_true")
+    parser.add_argument("--server-log", default=None)
+    args = parser.parse_args()
+    config = LoadTestConfig(
+        rate_in_hz=args.rate,
+        duration_in_s=args.duration,
+        seed=args.seed,
+        max_in_flight=args.max_in_flight,
+        n_users=args.users,
+        mix=args.mix,
+    )
+    if args.url is not None:
+        server = contextlib.nullcontext(args.url)
+    else:
+        server = serve_app(in_process=args.in_process, log_path=args.server_log)
+    with server as url:
+        result = asyncio.run(run_load_test(url, config))
+    print(result.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import asyncio
+import uuid
+
+import pytest
+
+from cocktail_24.cocktail.admission_control import (
+    AdmissionConfig,
+    QueueFullException,
+    check_admission,
+)
+from cocktail_24.cocktail.async_persistence import (
+    ThreadOffloadedCocktailBarStatePersistence,
+)
+from cocktail_24.cocktail.cocktail_api import (
+    CocktailApi,
+    InMemoryCocktailBarStatePersistence,
+)
+from cocktail_24.cocktail.cocktail_bookkeeping import UserId
+from cocktail_24.cocktail.openai_recipes import get_openai_recipes
+
+
+def test_check_admission():
+    config = AdmissionConfig(
+        max_pending_orders=10,
+        max_open_orders_per_user=2,
+        max_wait_in_s=600,
+        service_time_in_s=100,
+    )
+    check_admission(config, n_pending_orders=4, n_open_orders_of_user=1)
+    check_admission(
+        AdmissionConfig(), n_pending_orders=10000, n_open_orders_of_user=100
+    )
+
+    with pytest.raises(QueueFullException) as e:
+        check_admission(config, n_pending_orders=12)
+    assert e.value.retry_after_in_s == 300
+    with pytest.raises(QueueFullException) as e:
+        check_admission(config, n_pending_orders=0, n_open_orders_of_user=2)
+    assert e.value.retry_after_in_s == 100
+    # the 7th order would wait 700s
+    with pytest.raises(QueueFullException) as e:
+        check_admission(config, n_pending_orders=6)
+    assert e.value.retry_after_in_s == 100
+
+
+def test_cocktail_api_admission():
+    persistence = ThreadOffloadedCocktailBarStatePersistence(
+        InMemoryCocktailBarStatePersistence()
+    )
+    api = CocktailApi(
+        state_persistence=persistence,
+        admission=AdmissionConfig(max_pending_orders=3, max_open_orders_per_user=2),
+    )
+    recipe = get_openai_recipes()[0]
+    user_id = UserId(uuid.uuid4())
+
+    async def scenario():
+        await api.create_recipe(recipe)
+        first = await api.place_order(recipe.recipe_id, user_id=user_id)
+        results = await api.place_orders([recipe.recipe_id] * 2, user_id=user_id)
+        assert results[0].error is None
+        assert results[1].retry_after_in_s is not None
+        with pytest.raises(QueueFullException):
+            await api.place_order(recipe.recipe_id, user_id=user_id)
+
+        # a closed order makes room
+        await api.cancel_order(first)
+        await api.place_order(recipe.recipe_id, user_id=user_id)
+
+        # only queued (or executing) orders count towards the global limits
+        results = await api.place_orders([recipe.recipe_id] * 4, enqueue=True)
+        assert [result.error is None for result in results] == [True, True, True, False]
+        with pytest.raises(QueueFullException):
+            await api.place_order(recipe.recipe_id)
+
+        # the orders left enqueued by a purge are not waited for
+        await api.purge_queue()
+        results = await api.place_orders([recipe.recipe_id] * 3, enqueue=True)
+        assert all(result.error is None for result in results)
+
+    asyncio.run(scenario())
+    persistence.close()
+
+
+def test_cocktail_api_admission_on_enqueue():
+    persistence = ThreadOffloadedCocktailBarStatePersistence(
+        InMemoryCocktailBarStatePersistence()
+    )
+    api = CocktailApi(
+        state_persistence=persistence,
+        admission=AdmissionConfig(max_pending_orders=3, max_open_orders_per_user=2),
+    )
+    recipe = get_openai_recipes()[0]
+
+    async def scenario():
+        await api.create_recipe(recipe)
+        # placing does not make orders pending, without user_id there is no
+        #   per user limit
+        order_ids = [await api.place_order(recipe.recipe_id) for _ in range(6)]
+
+        results = await api.enqueue_orders(order_ids[:4])
+        assert [result.error is None for result in results] == [True, True, True, False]
+        assert results[3].retry_after_in_s == 120.0
+        with pytest.raises(QueueFullException):
+            await api.enqueue_order(order_ids[4])
+
+        # the queue stays bounded
+        state = persistence.get_current_state()
+        assert [*state.order_queue] == order_ids[:3]
+
+        await api.purge_queue()
+        await api.enqueue_order(order_ids[4])
+        assert [*persistence.get_current_state().order_queue] == [order_ids[4]]
+
+    asyncio.run(scenario())
+    persistence.close()
@@ -0,0 +1,394 @@
+import bisect
+import datetime
+import random
+import uuid
+from itertools import islice
+
+import pytest
+
+from cocktail_24.cocktail.persistent_map import PersistentMap
+from cocktail_24.cocktail.persistent_sorted_set import PersistentSortedSet
+from cocktail_24.cocktail.cocktail_bookkeeping import (
+    CocktailBarState,
+    OrderQueue,
+    OrderPlacedEvent,
+    OrderEnqueuedEvent,
+    OrderExecutingEvent,
+    OrderCancelledEvent,
+    OrderStatus,
+    QueuePurgedEvent,
+    SlotInventory,
+    SlotPath,
+    SlotRefilledEvent,
+    SlotStatus,
+    AmountPouredEvent,
+    UserId,
+)
+
+
+def test_order_queue():
+    order_ids = [uuid.uuid4() for _ in range(5)]
+    initial = OrderQueue(order_ids)
+    assert tuple(initial) == tuple(order_ids)
+    assert initial[0] == order_ids[0]
+
+    queue = initial.remove(order_ids[0]).remove(order_ids[2]).remove(uuid.uuid4())
+    queue = queue.append(order_ids[1]).append(order_ids[0])
+    assert [*queue] == [order_ids[1], order_ids[3], order_ids[4], order_ids[0]]
+    assert queue.peek() == order_ids[1]
+    assert queue[-1] == order_ids[0]
+    assert (queue[2], queue[-3]) == (order_ids[4], order_ids[3])
+    with pytest.raises(IndexError):
+        queue[4]
+    assert order_ids[3] in queue and order_ids[2] not in queue
+    # older versions are untouched
+    assert tuple(initial) == tuple(order_ids)
+
+    cleared = queue.clear()
+    assert not cleared
+    assert cleared.peek() is None
+    assert cleared.append(order_ids[2])[0] == order_ids[2]
+    assert len(queue) == 4
+
+
+def test_slot_inventory_keeps_first_refill_order():
+    def status(station_id: str, slot_id: int, amount_in_ml: float) -> SlotStatus:
+        return SlotStatus(
+            slot_path=SlotPath(station_id=station_id, slot_id=slot_id),
+            available_amount_in_ml=amount_in_ml,
+            ingredient_id="gin",
+        )
+
+    now = datetime.datetime.now()
+    refills = [status("zapf", 3, 700.0), status("pump", 1, 700.0)]
+    refills += [status("zapf", i, 700.0) for i in range(40, 0, -2)]
+    state = CocktailBarState.apply_events(
+        [(now, SlotRefilledEvent(new_status=refill)) for refill in refills]
+    )
+    assert [*state.slots] == refills
+
+    # refills and pours update a slot in place
+    state = CocktailBarState.apply_events(
+        [
+            (now, SlotRefilledEvent(new_status=status("pump", 1, 500.0))),
+            (
+                now,
+                AmountPouredEvent(
+                    slot_path=SlotPath(station_id="zapf", slot_id=3), amount_in_ml=50.0
+                ),
+            ),
+        ],
+        state,
+    )
+    expected = [status("zapf", 3, 650.0), status("pump", 1, 500.0), *refills[2:]]
+    assert [*state.slots] == expected
+    assert [*SlotInventory(expected)] == expected
+    assert [*CocktailBarState.load_snapshot(state.json_snapshot()).slots] == expected
+
+
+def test_bar_state_queue_roundtrip():
+    recipe_id = uuid.uuid4()
+    order_ids = [uuid.uuid4() for _ in range(4)]
+    events = [
+        OrderPlacedEvent(
+            order_id=order_id, recipe_id=recipe_id, user_id=UserId(uuid.uuid4())
+        )
+        for order_id in order_ids
+    ]
+    events += [OrderEnqueuedEvent(order_id=order_id) for order_id in order_ids]
+    events += [
+        OrderExecutingEvent(order_id=order_ids[0]),
+        OrderCancelledEvent(order_id=order_ids[2]),
+    ]
+    now = datetime.datetime.now()
+    state = CocktailBarState.apply_events((now, event) for event in events)
+    assert tuple(state.order_queue) == (order_ids[1], order_ids[3])
+
+    reloaded = CocktailBarState.load_snapshot(state.json_snapshot())
+    assert reloaded == state
+    assert reloaded.order_queue[0] == order_ids[1]
+
+    purged = CocktailBarState.apply_events([(now, QueuePurgedEvent())], state)
+    assert not purged.order_queue
+    assert tuple(state.order_queue) == (order_ids[1], order_ids[3])
+    assert (state.version, purged.version) == (len(events), len(events) + 1)
+
+
+def test_persistent_map():
+    keys = [uuid.uuid4() for _ in range(2000)]
+    versions = [PersistentMap()]
+    for i, key in enumerate(keys):
+        versions.append(versions[-1].set(key, i))
+    mutation = versions[-1].mutate()
+    for key in keys[::2]:
+        mutation.delete(key)
+    halved = mutation.finish()
+
+    for n, version in enumerate(versions[::100]):
+        assert dict(version.items()) == {
+            key: i for i, key in enumerate(keys[: n * 100])
+        }
+    assert len(halved) == len(keys) // 2
+    assert keys[0] not in halved and halved[keys[1]] == 1
+    assert versions[-1][keys[0]] == 0
+    assert halved.delete(uuid.uuid4()) is halved
+
+
+# equal hashes, distinct keys
+class _CollidingKey_:
+
+    def __init__(self, name: str, h: int):
+        self.name = name
+        self.h = h
+
+    def __hash__(self) -> int:
+        return self.h
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, _CollidingKey_) and self.name == other.name
+
+    def __repr__(self) -> str:
+        return f"_CollidingKey_({self.name!r})"
+
+
+def test_persistent_map_hash_collisions():
+    colliding = [_CollidingKey_(f"colliding {i}", 42) for i in range(3)]
+    # shares all but the last bits of the hash with the colliding keys
+    neighbour = _CollidingKey_("neighbour", 42 | 1 << 63)
+    initial = PersistentMap({key: i for i, key in enumerate([*colliding, neighbour])})
+    assert len(initial) == 4
+    assert [initial[key] for key in colliding] == [0, 1, 2]
+    assert initial[neighbour] == 3
+    assert initial.get(_CollidingKey_("missing", 42)) is None
+    assert _CollidingKey_("missing", 42) not in initial
+
+    updated = initial.set(colliding[1], 10)
+    assert updated[colliding[1]] == 10 and initial[colliding[1]] == 1
+    assert dict(updated.items()) == {
+        colliding[0]: 0,
+        colliding[1]: 10,
+        colliding[2]: 2,
+        neighbour: 3,
+    }
+
+    # shrinks from a collision of three to a single entry and back
+    shrunk = updated.delete(colliding[0]).delete(colliding[2])
+    assert dict(shrunk.items()) == {colliding[1]: 10, neighbour: 3}
+    assert shrunk.delete(_CollidingKey_("missing", 42)) is shrunk
+    mutation = shrunk.mutate()
+    mutation.set(colliding[0], 20)
+    mutation.delete(colliding[1])
+    regrown = mutation.finish()
+    assert dict(regrown.items()) == {colliding[0]: 20, neighbour: 3}
+    assert len(initial) == 4 and initial[colliding[0]] == 0
+
+
+def test_order_projections():
+    recipe_ids = [uuid.uuid4() for _ in range(2)]
+    user_id = UserId(uuid.uuid4())
+    order_ids = [uuid.uuid4() for _ in range(3)]
+    events = [
+        OrderPlacedEvent(
+            order_id=order_id, recipe_id=recipe_ids[i % 2], user_id=user_id
+        )
+        for i, order_id in enumerate(order_ids)
+    ]
+    events += [
+        OrderEnqueuedEvent(order_id=order_ids[0]),
+        OrderCancelledEvent(order_id=order_ids[1]),
+    ]
+    at = datetime.datetime(2024, 5, 1, 21, 30)
+    state = CocktailBarState.apply_events((at, event) for event in events)
+
+    by_status = state.projections["by_status"]
+    assert [*by_status.order_ids(OrderStatus.enqueued)] == [order_ids[0]]
+    assert by_status.counts() == {
+        OrderStatus.enqueued: 1,
+        OrderStatus.cancelled: 1,
+        OrderStatus.ordered: 1,
+    }
+    assert state.projections["by_user"].count(user_id) == 3
+    assert state.projections["by_recipe"].counts() == {
+        recipe_ids[0]: 2,
+        recipe_ids[1]: 1,
+    }
+    assert state.projections["per_hour"].counts() == {
+        datetime.datetime(2024, 5, 1, 21): 3
+    }
+
+    # archival and snapshots keep the projections consistent with the orders
+    compacted = state.remove_orders([order_ids[1]])
+    assert not compacted.projections["by_status"].count(OrderStatus.cancelled)
+    assert compacted.projections["per_hour"].counts() == {
+        datetime.datetime(2024, 5, 1, 21): 2
+    }
+    assert state.projections["by_status"].count(OrderStatus.cancelled) == 1
+    reloaded = CocktailBarState.load_snapshot(state.json_snapshot())
+    assert reloaded.projections["by_recipe"].counts() == (
+        state.projections["by_recipe"].counts()
+    )
+
+
+def test_order_projections_across_batches():
+    recipe_id = uuid.uuid4()
+    user_ids = [UserId(uuid.uuid4()) for _ in range(3)]
+    order_ids = [uuid.uuid4() for _ in range(60)]
+    events = []
+    for i, order_id in enumerate(order_ids):
+        events += [
+            OrderPlacedEvent(
+                order_id=order_id, recipe_id=recipe_id, user_id=user_ids[i % 3]
+            ),
+            OrderEnqueuedEvent(order_id=order_id),
+        ]
+        if i % 4 == 0:
+            events.append(OrderExecutingEvent(order_id=order_ids[i // 2]))
+        if i % 5 == 0:
+            events.append(OrderCancelledEvent(order_id=order_ids[i // 3]))
+    started = datetime.datetime(2024, 5, 1, 21)
+    timed = [
+        (started + datetime.timedelta(minutes=i), event)
+        for i, event in enumerate(events)
+    ]
+
+    # large batches rebuild the projections, small ones update them
+    expected = CocktailBarState.apply_events(timed)
+    for batch_size in (1, 7, 50):
+        state = None
+        for i in range(0, len(timed), batch_size):
+            state = CocktailBarState.apply_events(timed[i : i + batch_size], state)
+        assert state == expected
+        for name in ("by_status", "by_user", "by_recipe", "per_hour"):
+            assert state.projections[name].counts() == (
+                expected.projections[name].counts()
+            )
+        for status in OrderStatus:
+            assert [
+                *state.projections["timeline_by_status"].orders((status.value,))
+            ] == [*expected.projections["timeline_by_status"].orders((status.value,))]
+        assert [*state.projections["timeline"].orders()] == [
+            (order.time_of_order, order.order_id)
+            for order in sorted(
+                expected.orders.values(), key=lambda order: order.time_of_order
+            )
+        ]
+
+
+def test_persistent_sorted_set():
+    keys = [*range(0, 1000, 3)]
+    initial = PersistentSortedSet(reversed(keys))
+    assert [*initial] == keys and len(initial) == len(keys)
+
+    updated = initial.add(1).discard(0).discard(2).mutate()
+    for key in keys[:200]:
+        updated = updated.discard(key)
+    updated = updated.add(2000).finish()
+    assert [*updated] == [1, *keys[200:], 2000]
+    assert 1 in updated and 3 not in updated
+    # older versions are untouched
+    assert [*initial] == keys
+
+    assert [*initial.range(10, 20)] == [12, 15, 18]
+    assert [*initial.range(10, 20, reverse=True)] == [18, 15, 12]
+    assert [*initial.range(hi=4)] == [0, 3]
+    assert [*initial.range(lo=996)] == [996, 999]
+
+
+# (depth, keys) of a sorted set node, checking the b+ tree invariants
+def _check_sorted_node_(node) -> tuple[int, list]:
+    assert len(node.keys) <= 64
+    if node.children is None:
+        assert node.keys == sorted(node.keys)
+        return 1, [*node.keys]
+    assert node.keys and len(node.keys) == len(node.children)
+    depths, keys = set(), []
+    for i, child in enumerate(node.children):
+        depth, child_keys = _check_sorted_node_(child)
+        # keys[i] bounds the keys below children[i] from below, keys[i + 1] above
+        assert child_keys and child_keys[0] >= node.keys[i]
+        if i + 1 < len(node.keys):
+            assert child_keys[-1] < node.keys[i + 1]
+        depths.add(depth)
+        keys += child_keys
+    assert len(depths) == 1
+    return depths.pop() + 1, keys
+
+
+def test_persistent_sorted_set_splits_and_shrinks():
+    rng = random.Random(0)
+    keys = rng.sample(range(100_000), 10_000)
+    reference = sorted(keys)
+    half = PersistentSortedSet()
+    for key in keys[:5000]:
+        half = half.add(key)
+    mutation = half.mutate()
+    for key in keys[5000:]:
+        mutation.add(key)
+    full = mutation.finish()
+    # leaves and inner nodes split, both copied and in place
+    assert _check_sorted_node_(full._root_) == (3, reference)
+    assert _check_sorted_node_(half._root_)[1] == sorted(keys[:5000])
+
+    for _ in range(100):
+        lo, hi = sorted(rng.sample(range(100_000), 2))
+        expected = reference[
+            bisect.bisect_left(reference, lo) : bisect.bisect_left(reference, hi)
+        ]
+        assert [*full.range(lo, hi)] == expected
+        assert [*full.range(lo, hi, reverse=True)] == expected[::-1]
+
+    # emptied nodes are dropped, a root with a single child is replaced by it
+    trimmed = full
+    for key in reference[:-10]:
+        trimmed = trimmed.discard(key)
+    assert _check_sorted_node_(trimmed._root_) == (1, reference[-10:])
+
+    shrunk = full.mutate()
+    rng.shuffle(keys)
+    for n, key in enumerate(keys, start=1):
+        shrunk.discard(key)
+        if n % 1000 == 0:
+            assert _check_sorted_node_(shrunk._root_)[1] == sorted(keys[n:])
+    shrunk = shrunk.finish()
+    assert len(shrunk) == 0 and [*shrunk] == []
+    assert shrunk.add(5)._root_.keys == [5]
+    assert _check_sorted_node_(full._root_) == (3, reference)
+
+
+def test_order_timeline():
+    order_ids = [uuid.uuid4() for _ in range(5)]
+    start = datetime.datetime(2024, 5, 1, 21)
+    events = [
+        (
+            start + datetime.timedelta(minutes=i),
+            OrderPlacedEvent(
+                order_id=order_id, recipe_id=uuid.uuid4(), user_id=UserId(uuid.uuid4())
+            ),
+        )
+        for i, order_id in enumerate(order_ids)
+    ]
+    events += [
+        (start, OrderEnqueuedEvent(order_id=order_ids[1])),
+        (start, OrderEnqueuedEvent(order_id=order_ids[3])),
+    ]
+    state = CocktailBarState.apply_events(events)
+    timeline = state.projections["timeline"]
+
+    page = [*islice(timeline.orders(), 2)]
+    assert [order_id for _time, order_id in page] == order_ids[:2]
+    rest = [*timeline.orders(after=page[-1])]
+    assert [order_id for _time, order_id in rest] == order_ids[2:]
+    newest_first = [*timeline.orders(after=rest[0], descending=True)]
+    assert [order_id for _time, order_id in newest_first] == order_ids[1::-1]
+
+    in_range = timeline.orders(
+        since=start + datetime.timedelta(minutes=1),
+        until=start + datetime.timedelta(minutes=3),
+    )
+    assert [order_id for _time, order_id in in_range] == order_ids[1:3]
+
+    by_status = state.projections["timeline_by_status"]
+    enqueued = by_status.orders((OrderStatus.enqueued.value,), descending=True)
+    assert [order_id for _time, order_id in enqueued] == [order_ids[3], order_ids[1]]
+    ordered = by_status.orders((OrderStatus.ordered.value,))
+    assert [order_id for _time, order_id in ordered] == order_ids[::2]
@@ -0,0 +1,730 @@
+import asyncio
+import datetime
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import uuid
+
+import pytest
+
+from cocktail_24.cocktail.cocktail_api import (
+    SqliteCocktailBarStatePersistence,
+    EventOccurrence,
+    SnapshotConfig,
+    InMemoryCocktailBarStatePersistence,
+    HistoryUnavailableException,
+    CocktailApi,
+)
+from cocktail_24.cocktail.async_persistence import (
+    ThreadOffloadedCocktailBarStatePersistence,
+)
+from cocktail_24.cocktail.group_commit import (
+    WriteBehindConfig,
+    SqliteGroupCommitWriter,
+)
+from cocktail_24.cocktail.log_persistence import (
+    AppendOnlyLogCocktailBarStatePersistence,
+)
+from cocktail_24.cocktail.cocktail_bookkeeping import (
+    CocktailBarState,
+    OrderPlacedEvent,
+    OrderEnqueuedEvent,
+    RecipeCreatedEvent,
+    UserId,
+    SlotRefilledEvent,
+    SlotStatus,
+    SlotPath,
+    AmountPouredEvent,
+    Station,
+    OrderFulfilledEvent,
+    OrderCancelledEvent,
+    OrderStatus,
+)
+from cocktail_24.cocktail.cocktail_recipes import CocktailRecipe
+from cocktail_24.cocktail.openai_recipes import get_openai_recipes
+from cocktail_24.cocktail_management import FakeFulfillmentSystem
+from configure import configure_management, configure_system_config
+
+
+def gen_bar_events():
+    drinks = get_openai_recipes()
+    for drink in drinks:
+        yield RecipeCreatedEvent(drink, UserId(uuid.uuid4()))
+    for slot_id in range(4):
+        yield SlotRefilledEvent(
+            new_status=SlotStatus(
+                slot_path=SlotPath(station_id=Station.zapf, slot_id=slot_id),
+                available_amount_in_ml=700.0,
+                ingredient_id=f"ingredient_{slot_id}",
+            )
+        )
+    for i in range(50):
+        order_id = uuid.uuid4()
+        yield OrderPlacedEvent(
+            order_id=order_id,
+            recipe_id=drinks[i % len(drinks)].recipe_id,
+            user_id=UserId(uuid.uuid4()),
+        )
+        yield OrderEnqueuedEvent(order_id=order_id)
+        yield AmountPouredEvent(
+            slot_path=SlotPath(station_id=Station.zapf, slot_id=i % 4),
+            amount_in_ml=2.5,
+        )
+
+
+def persist_one_by_one(persistence, events):
+    for event in events:
+        persistence.persist_events(
+            [EventOccurrence(event=event, timestamp=datetime.datetime.now())]
+        )
+
+
+def test_sqlite_snapshot_and_tail_replay():
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "test.db")
+        config = SnapshotConfig(interval_in_events=20, retention=2)
+        persistence = SqliteCocktailBarStatePersistence(filename, config)
+        persist_one_by_one(persistence, gen_bar_events())
+        expected_state = persistence.get_current_state()
+
+        con = sqlite3.connect(filename)
+        offsets = [row[0] for row in con.execute("SELECT event_offset FROM snapshots")]
+        assert len(offsets) == config.retention
+        (n_events,) = con.execute("SELECT count(*) FROM event_log").fetchone()
+        assert max(offsets) > n_events - config.interval_in_events
+
+        reloaded = SqliteCocktailBarStatePersistence(filename, config)
+        assert reloaded.get_current_state() == expected_state
+
+
+def test_sqlite_migrates_pickled_events():
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "test.db")
+        events = [(datetime.datetime.now(), event) for event in gen_bar_events()]
+        con = sqlite3.connect(filename)
+        con.execute("CREATE TABLE events (data BLOB)")
+        con.executemany(
+            "INSERT INTO events VALUES(?)", [[pickle.dumps(ev)] for ev in events]
+        )
+        con.commit()
+
+        persistence = SqliteCocktailBarStatePersistence(filename)
+        expected_state = CocktailBarState.apply_events(events)
+        assert persistence.get_current_state() == expected_state
+        assert not con.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'events'"
+        ).fetchone()
+        (n_events,) = con.execute("SELECT count(*) FROM event_log").fetchone()
+        assert n_events == len(events)
+
+
+def test_sqlite_query_events():
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "test.db")
+        persistence = SqliteCocktailBarStatePersistence(filename)
+        persist_one_by_one(persistence, gen_bar_events())
+        state = persistence.get_current_state()
+        order_id = next(iter(state.orders))
+        started = datetime.datetime.now()
+        persist_one_by_one(persistence, [OrderFulfilledEvent(order_id=order_id)])
+
+        order_events = persistence.query_events(order_id=order_id)
+        assert [type(occ.event) for occ in order_events] == [
+            OrderPlacedEvent,
+            OrderEnqueuedEvent,
+            OrderFulfilledEvent,
+        ]
+
+        slot_path = SlotPath(station_id=Station.zapf, slot_id=1)
+        pours = persistence.query_events(
+            slot_path=slot_path, event_type=AmountPouredEvent
+        )
+        assert len(pours) > 0
+        assert all(occ.event.slot_path == slot_path for occ in pours)
+
+        recent = persistence.query_events(since=started)
+        assert [occ.event for occ in recent] == [OrderFulfilledEvent(order_id)]
+
+
+def test_sqlite_write_behind():
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "test.db")
+        config = SnapshotConfig(interval_in_events=20, retention=2)
+        persistence = SqliteCocktailBarStatePersistence(
+            filename, config, write_behind=WriteBehindConfig()
+        )
+        durable = [
+            persistence.persist_events(
+                [EventOccurrence(event=event, timestamp=datetime.datetime.now())]
+            )
+            for event in gen_bar_events()
+        ]
+        expected_state = persistence.get_current_state()
+        assert len(expected_state.orders) == 50
+        assert durable[-1].result(timeout=10) == len(durable)
+        persistence.close()
+
+        # serialized on the writer thread, as of their event offset
+        last_snapshot = len(durable) // 20 * 20
+        con = sqlite3.connect(filename)
+        assert con.execute(
+            "SELECT event_offset FROM snapshots ORDER BY event_offset"
+        ).fetchall() == [(last_snapshot - 20,), (last_snapshot,)]
+        con.close()
+        reloaded = SqliteCocktailBarStatePersistence(filename, config)
+        assert reloaded.get_current_state() == expected_state
+        assert reloaded.get_state_at(seq=last_snapshot).version == last_snapshot
+
+
+def test_group_commit_writer_builds_rows_on_its_thread():
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "test.db")
+        con = sqlite3.connect(filename)
+        con.execute("CREATE TABLE numbers (n INTEGER)")
+        con.close()
+        writer = SqliteGroupCommitWriter(filename, WriteBehindConfig())
+        called_on = []
+
+        def rows():
+            called_on.append(threading.current_thread().name)
+            return [(2,), (3,)]
+
+        assert (
+            writer.submit([("INSERT INTO numbers VALUES(?)", [(1,)])]).result(10)
+            is None
+        )
+        durable = writer.submit([("INSERT INTO numbers VALUES(?)", rows)], "done")
+        assert durable.result(10) == "done"
+        assert called_on == ["sqlite-group-commit"]
+        writer.close()
+
+        con = sqlite3.connect(filename)
+        assert con.execute("SELECT n FROM numbers").fetchall() == [(1,), (2,), (3,)]
+        con.close()
+
+
+def test_append_only_log_persistence():
+    with tempfile.TemporaryDirectory() as tempdir:
+        persistence = AppendOnlyLogCocktailBarStatePersistence(
+            tempdir, segment_size_in_bytes=1024
+        )
+        persist_one_by_one(persistence, gen_bar_events())
+        expected_state = persistence.get_current_state()
+        persistence.close()
+        segments = sorted(os.listdir(tempdir))
+        assert len(segments) > 1
+
+        # simulate a crash in the middle of an append
+        with open(os.path.join(tempdir, segments[-1]), "ab") as f:
+            f.write(b"\x20\x00\x00\x00\x01")
+
+        reloaded = AppendOnlyLogCocktailBarStatePersistence(
+            tempdir, segment_size_in_bytes=1024
+        )
+        assert reloaded.get_current_state() == expected_state
+        order_id = next(iter(expected_state.orders))
+        persist_one_by_one(reloaded, [OrderFulfilledEvent(order_id=order_id)])
+        expected_state = reloaded.get_current_state()
+        reloaded.close()
+
+        reloaded = AppendOnlyLogCocktailBarStatePersistence(tempdir)
+        assert reloaded.get_current_state() == expected_state
+        reloaded.close()
+
+
+def test_sqlite_compaction_archives_closed_orders():
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "test.db")
+        persistence = SqliteCocktailBarStatePersistence(filename)
+        persist_one_by_one(persistence, gen_bar_events())
+        order_ids = [*persistence.get_current_state().orders]
+        closed = {
+            order_ids[0]: OrderStatus.fulfilled,
+            order_ids[1]: OrderStatus.cancelled,
+        }
+        persist_one_by_one(
+            persistence,
+            [
+                OrderFulfilledEvent(order_id=order_ids[0]),
+                OrderCancelledEvent(order_id=order_ids[1]),
+            ],
+        )
+        closed_orders = {
+            order_id: persistence.get_current_state().orders[order_id]
+            for order_id in closed
+        }
+        later = datetime.datetime.now() + datetime.timedelta(hours=2)
+
+        assert persistence.compact(datetime.timedelta(days=1), now=later) == 0
+        archived = persistence.compact(datetime.timedelta(hours=1), now=later)
+        assert archived == len(closed)
+        state = persistence.get_current_state()
+        assert not any(order_id in state.orders for order_id in closed)
+        assert len(state.orders) == len(order_ids) - len(closed)
+        for order_id, order in closed_orders.items():
+            assert persistence.get_archived_order(order_id) == order
+        assert persistence.get_archived_order(order_ids[2]) is None
+
+        con = sqlite3.connect(filename)
+        assert con.execute("SELECT count(*) FROM event_log").fetchone() == (0,)
+        persist_one_by_one(persistence, [OrderFulfilledEvent(order_id=order_ids[2])])
+        expected_state = persistence.get_current_state()
+
+        reloaded = SqliteCocktailBarStatePersistence(filename)
+        assert reloaded.get_current_state() == expected_state
+        assert reloaded.get_archived_order(order_ids[0]) == closed_orders[order_ids[0]]
+
+
+def test_sqlite_parallel_replay_after_invalid_snapshot():
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "test.db")
+        persistence = SqliteCocktailBarStatePersistence(filename)
+        persist_one_by_one(persistence, gen_bar_events())
+        persistence.snapshot()
+        expected_state = persistence.get_current_state()
+        persistence.close()
+
+        # as if the state schema changed since the snapshot
+        con = sqlite3.connect(filename)
+        con.execute("UPDATE snapshots SET data = '{}'")
+        con.commit()
+
+        reloaded = SqliteCocktailBarStatePersistence(
+            filename, replay_chunk_size=16, replay_workers=3
+        )
+        assert reloaded.get_current_state() == expected_state
+        order_id = next(iter(expected_state.orders))
+        persist_one_by_one(reloaded, [OrderFulfilledEvent(order_id=order_id)])
+        expected_state = reloaded.get_current_state()
+        reloaded.close()
+
+        reloaded = SqliteCocktailBarStatePersistence(filename)
+        assert reloaded.get_current_state() == expected_state
+
+
+def read_all_pages(persistence, page_size, cursor=0):
+    events = []
+    while page := persistence.read_events(cursor, limit=page_size):
+        events += page
+        cursor = page[-1].seq
+    return events
+
+
+def test_change_feed():
+    events = [*gen_bar_events()]
+    with tempfile.TemporaryDirectory() as tempdir:
+        persistences = [
+            InMemoryCocktailBarStatePersistence(),
+            SqliteCocktailBarStatePersistence(os.path.join(tempdir, "test.db")),
+            AppendOnlyLogCocktailBarStatePersistence(
+                os.path.join(tempdir, "log"),
+                segment_size_in_bytes=1024,
+                index_interval_in_events=7,
+            ),
+        ]
+        for persistence in persistences:
+            persist_one_by_one(persistence, events)
+            feed = read_all_pages(persistence, page_size=11)
+            assert [logged.seq for logged in feed] == [*range(1, len(events) + 1)]
+            assert [logged.event for logged in feed] == events
+            assert feed[0].event_type == "RecipeCreatedEvent"
+
+            window = persistence.read_events(40, until_seq=45)
+            assert [logged.seq for logged in window] == [*range(41, 46)]
+            assert persistence.read_events(len(events)) == []
+            # a cursor before the first event reads from the start
+            assert persistence.read_events(-5, limit=3) == feed[:3]
+
+        log_persistence = persistences[-1]
+        log_persistence.close()
+        reloaded = AppendOnlyLogCocktailBarStatePersistence(
+            os.path.join(tempdir, "log"), index_interval_in_events=5
+        )
+        assert read_all_pages(reloaded, page_size=13) == feed
+        reloaded.close()
+
+
+def test_sqlite_reads_while_writing():
+    events = [*gen_bar_events()]
+    with tempfile.TemporaryDirectory() as tempdir:
+        persistence = SqliteCocktailBarStatePersistence(
+            os.path.join(tempdir, "test.db")
+        )
+        done = threading.Event()
+        seen, errors = [], []
+
+        def read():
+            try:
+                while not done.is_set():
+                    feed = persistence.read_events(0)
+                    # only committed events, and never a gap
+                    assert [logged.seq for logged in feed] == [*range(1, len(feed) + 1)]
+                    seen.append(len(feed))
+            except Exception as e:
+                errors.append(e)
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        persist_one_by_one(persistence, events)
+        done.set()
+        for reader in readers:
+            reader.join()
+        assert errors == []
+        assert seen
+
+        # each thread read over its own connection, close() closes all of them
+        reader_cons = [*persistence._reader_cons_]
+        assert len(reader_cons) == len(readers)
+        persistence.close()
+        for con in reader_cons:
+            with pytest.raises(sqlite3.ProgrammingError):
+                con.execute("SELECT 1")
+
+
+def test_sqlite_state_at_seq_and_timestamp():
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "test.db")
+        config = SnapshotConfig(interval_in_events=20, retention=None)
+        persistence = SqliteCocktailBarStatePersistence(filename, config)
+        started = datetime.datetime(2024, 1, 1)
+        snapshots = [persistence.get_current_state().json_snapshot()]
+        for i, event in enumerate(gen_bar_events()):
+            persistence.persist_events(
+                [
+                    EventOccurrence(
+                        event=event, timestamp=started + datetime.timedelta(seconds=i)
+                    )
+                ]
+            )
+            snapshots.append(persistence.get_current_state().json_snapshot())
+
+        for seq in (0, 1, 19, 20, 21, 77, len(snapshots) - 1):
+            assert persistence.get_state_at(seq=seq).json_snapshot() == snapshots[seq]
+        at = started + datetime.timedelta(seconds=41.5)
+        assert persistence.get_state_at(timestamp=at).json_snapshot() == snapshots[42]
+
+        order_id = next(iter(persistence.get_current_state().orders))
+        persist_one_by_one(persistence, [OrderFulfilledEvent(order_id=order_id)])
+        persistence.compact(datetime.timedelta(0))
+        with pytest.raises(HistoryUnavailableException):
+            persistence.get_state_at(seq=10)
+
+
+# persists events right after compact took the state, like the robot loop
+#   does while a compaction runs
+class _PersistsDuringCompaction_(SqliteCocktailBarStatePersistence):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.events_during_compaction = []
+
+    def flush(self) -> None:
+        persist_one_by_one(self, self.events_during_compaction)
+        self.events_during_compaction = []
+        super().flush()
+
+
+def test_sqlite_compaction_while_persisting():
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "test.db")
+        config = SnapshotConfig(interval_in_events=1000)
+        persistence = _PersistsDuringCompaction_(
+            filename, config, write_behind=WriteBehindConfig()
+        )
+        persist_one_by_one(persistence, gen_bar_events())
+        order_ids = [*persistence.get_current_state().orders]
+        persist_one_by_one(persistence, [OrderFulfilledEvent(order_id=order_ids[0])])
+        version = persistence.get_current_state().version
+
+        # enough events to snapshot the state before the archival is swapped in
+        persistence.events_during_compaction = [
+            OrderFulfilledEvent(order_id=order_ids[1]),
+            *(
+                AmountPouredEvent(
+                    slot_path=SlotPath(station_id=Station.zapf, slot_id=1),
+                    amount_in_ml=0.1,
+                )
+                for _ in range(1000)
+            ),
+        ]
+        later = datetime.datetime.now() + datetime.timedelta(hours=2)
+        assert persistence.compact(datetime.timedelta(hours=1), now=later) == 1
+
+        state = persistence.get_current_state()
+        assert state.version == version + 1001
+        assert order_ids[0] not in state.orders
+        assert state.orders[order_ids[1]].status == OrderStatus.fulfilled
+        persistence.close()
+
+        # the snapshot taken during the compaction does not bring it back
+        reloaded = SqliteCocktailBarStatePersistence(filename, config)
+        assert reloaded.get_current_state() == state
+        assert reloaded.get_archived_order(order_ids[0]) is not None
+        reloaded.close()
+
+
+def test_sqlite_compaction_keeps_history():
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "test.db")
+        config = SnapshotConfig(interval_in_events=20, retention=None)
+        persistence = SqliteCocktailBarStatePersistence(filename, config)
+        started = datetime.datetime(2024, 1, 1)
+        events = [*gen_bar_events()]
+        for i, event in enumerate(events):
+            persistence.persist_events(
+                [
+                    EventOccurrence(
+                        event=event, timestamp=started + datetime.timedelta(seconds=i)
+                    )
+                ]
+            )
+        order_ids = [*persistence.get_current_state().orders]
+        # both ordered long ago, but only the first one closed long ago
+        for days, event in (
+            (1, OrderFulfilledEvent(order_id=order_ids[0])),
+            (3, OrderCancelledEvent(order_id=order_ids[1])),
+        ):
+            persistence.persist_events(
+                [
+                    EventOccurrence(
+                        event=event, timestamp=started + datetime.timedelta(days=days)
+                    )
+                ]
+            )
+        fulfilled_seq = len(events) + 1
+        before_compaction = persistence.get_state_at(seq=fulfilled_seq).json_snapshot()
+
+        now = started + datetime.timedelta(days=3, hours=1)
+        archived = persistence.compact(
+            datetime.timedelta(days=1), now=now, history=datetime.timedelta(days=2)
+        )
+        assert archived == 1
+        state = persistence.get_current_state()
+        assert order_ids[0] not in state.orders
+        assert state.orders[order_ids[1]].status == OrderStatus.cancelled
+        assert persistence.get_archived_order(order_ids[0]) is not None
+
+        # the history window still reaches back past the archived order
+        boundary = len(events) // 20 * 20
+        feed = read_all_pages(persistence, page_size=7, cursor=boundary)
+        assert [logged.seq for logged in feed] == [
+            *range(boundary + 1, len(events) + 3)
+        ]
+        assert [logged.event for logged in feed[:-2]] == events[boundary:]
+        assert (
+            persistence.get_state_at(seq=fulfilled_seq).json_snapshot()
+            == before_compaction
+        )
+        assert persistence.get_state_at(seq=boundary + 1).version == boundary + 1
+        with pytest.raises(HistoryUnavailableException):
+            persistence.get_state_at(seq=boundary - 1)
+        # a cursor before the dropped events must not skip them
+        for cursor in (0, boundary - 1):
+            with pytest.raises(HistoryUnavailableException):
+                persistence.read_events(cursor, limit=7)
+
+        reloaded = SqliteCocktailBarStatePersistence(filename, config)
+        assert reloaded.get_current_state() == state
+        assert read_all_pages(reloaded, page_size=7, cursor=boundary) == feed
+
+
+def test_thread_offloaded_cocktail_api():
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "test.db")
+        for write_behind in (None, WriteBehindConfig()):
+            persistence = SqliteCocktailBarStatePersistence(
+                filename, write_behind=write_behind
+            )
+            offloaded = ThreadOffloadedCocktailBarStatePersistence(persistence)
+            api = CocktailApi(state_persistence=offloaded)
+            recipe = get_openai_recipes()[0]
+
+            async def place_orders():
+                if recipe.recipe_id not in persistence.get_current_state().recipes:
+                    await api.create_recipe(recipe)
+                return await asyncio.gather(
+                    *(api.place_order(recipe.recipe_id) for _ in range(20))
+                )
+
+            order_ids = asyncio.run(place_orders())
+            offloaded.close()
+            persistence.close()
+
+            reloaded = SqliteCocktailBarStatePersistence(filename)
+            assert all(
+                order_id in reloaded.get_current_state().orders
+                for order_id in order_ids
+            )
+            reloaded.close()
+
+
+def test_management_does_not_wait_for_commits():
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "test.db")
+        # commits only on close
+        persistence = SqliteCocktailBarStatePersistence(
+            filename, write_behind=WriteBehindConfig(max_delay_in_s=60.0)
+        )
+        management = configure_management(
+            FakeFulfillmentSystem(), configure_system_config(), persistence
+        )
+        recipe = CocktailRecipe(recipe_id=uuid.uuid4(), title="empty", steps=())
+        order_id = uuid.uuid4()
+        persist_one_by_one(
+            persistence,
+            [
+                RecipeCreatedEvent(recipe, UserId(uuid.uuid4())),
+                OrderPlacedEvent(order_id, recipe.recipe_id, UserId(uuid.uuid4())),
+                OrderEnqueuedEvent(order_id),
+            ],
+        )
+
+        management.check_update()
+        state = persistence.get_current_state()
+        assert state.orders[order_id].status == OrderStatus.executing
+        con = sqlite3.connect(filename)
+        count_executing = (
+            "SELECT count(*) FROM event_log WHERE event_type = 'OrderExecutingEvent'"
+        )
+        assert con.execute(count_executing).fetchone() == (0,)
+
+        persistence.close()
+        assert con.execute(count_executing).fetchone() == (1,)
+        reloaded = SqliteCocktailBarStatePersistence(filename)
+        assert reloaded.get_current_state() == state
+        reloaded.close()
+
+
+def test_wait_for_order_status():
+    with tempfile.TemporaryDirectory() as tempdir:
+        persistence = SqliteCocktailBarStatePersistence(
+            os.path.join(tempdir, "test.db")
+        )
+        offloaded = ThreadOffloadedCocktailBarStatePersistence(persistence)
+        api = CocktailApi(state_persistence=offloaded)
+        recipe = get_openai_recipes()[0]
+        watch = offloaded.order_watch
+
+        def failing_listener(orders):
+            raise ValueError("listener failed")
+
+        # fails neither the writes nor the waiters
+        watch.add_listener(failing_listener)
+
+        def wait(order_id, status: OrderStatus, timeout_in_s: float = 5):
+            return watch.wait_for(
+                order_id,
+                lambda order: order.status == status,
+                lambda: offloaded.get_current_state().orders.get(order_id),
+                timeout_in_s,
+            )
+
+        async def scenario():
+            await api.create_recipe(recipe)
+            order_id = await api.place_order(recipe.recipe_id)
+            # already there
+            assert (await wait(order_id, OrderStatus.ordered)).order_id == order_id
+
+            fulfilled = asyncio.ensure_future(wait(order_id, OrderStatus.fulfilled))
+            await api.enqueue_order(order_id)
+            await asyncio.sleep(0.05)
+            assert not fulfilled.done()
+            await offloaded.persist_events(
+                [
+                    EventOccurrence(
+                        timestamp=datetime.datetime.now(),
+                        event=OrderFulfilledEvent(order_id=order_id),
+                    )
+                ]
+            )
+            assert (await fulfilled).status == OrderStatus.fulfilled
+
+            assert await wait(order_id, OrderStatus.cancelled, 0.05) is None
+            assert not watch._waiters_
+
+        asyncio.run(scenario())
+        offloaded.close()
+        persistence.close()
+
+
+def test_batch_requests_persist_once():
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "test.db")
+        persistence = SqliteCocktailBarStatePersistence(filename)
+        offloaded = ThreadOffloadedCocktailBarStatePersistence(persistence)
+        api = CocktailApi(state_persistence=offloaded)
+        recipe = get_openai_recipes()[0]
+
+        # the accepted items of a batch are logged together, with one timestamp
+        def logged_batch(after_seq):
+            logged = persistence.read_events(after_seq)
+            assert len({event.timestamp for event in logged}) == 1
+            return [event.event for event in logged]
+
+        async def scenario():
+            await api.create_recipe(recipe)
+            version = persistence.get_current_state().version
+            placed = await api.place_orders(
+                [recipe.recipe_id, uuid.uuid4(), recipe.recipe_id, recipe.recipe_id]
+            )
+            assert [result.error is None for result in placed] == [
+                True,
+                False,
+                True,
+                True,
+            ]
+            first, second, third = (placed[i].order_id for i in (0, 2, 3))
+            assert [type(event) for event in logged_batch(version)] == [
+                OrderPlacedEvent
+            ] * 3
+            await api.cancel_order(second)
+
+            version = persistence.get_current_state().version
+            enqueued = await api.enqueue_orders([first, second, third, first])
+            assert [result.error for result in enqueued] == [
+                None,
+                f"order {second} is cancelled",
+                None,
+                f"order {first} is already enqueued",
+            ]
+            assert logged_batch(version) == [
+                OrderEnqueuedEvent(order_id=first),
+                OrderEnqueuedEvent(order_id=third),
+            ]
+
+            refills = [
+                SlotStatus(
+                    slot_path=SlotPath(station_id=Station.zapf, slot_id=i),
+                    ingredient_id="gin",
+                    available_amount_in_ml=700.0,
+                )
+                for i in (1, 2, 1)
+            ]
+            version = persistence.get_current_state().version
+            refilled = await api.refill_slots(refills)
+            assert [result.error is None for result in refilled] == [True, True, False]
+            assert logged_batch(version) == [
+                SlotRefilledEvent(new_status=status) for status in refills[:2]
+            ]
+            return first, third
+
+        first, third = asyncio.run(scenario())
+        state = persistence.get_current_state()
+        assert [*state.order_queue] == [first, third]
+        assert [*state.slots] == [
+            SlotStatus(
+                slot_path=SlotPath(station_id=Station.zapf, slot_id=i),
+                ingredient_id="gin",
+                available_amount_in_ml=700.0,
+            )
+            for i in (1, 2)
+        ]
+        offloaded.close()
+        persistence.close()
+
+        reloaded = SqliteCocktailBarStatePersistence(filename)
+        assert reloaded.get_current_state() == state
+        reloaded.close()
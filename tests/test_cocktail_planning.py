@@ -1,9 +1,14 @@
-from cocktail_24.cocktail_robo import CocktailPosition
+from itertools import product
+
+import pytest
+
+from cocktail_24.cocktail_robo import CocktailPosition, ALLOWED_COCKTAIL_MOVES
 from cocktail_24.planning.cocktail_planner import (
     CocktailSystemConfig,
     CocktailZapfStationConfig,
     CocktailPumpStationConfig,
     SimpleRobotMotionPlanner,
+    PrecomputedRobotMotionPlanner,
     SimpleRobotIngredientPlanner,
     SimpleRobotIngredientPlannerConfig,
     SlotAmounts,
@@ -57,3 +62,35 @@ def test_robot_planning():
     for step in steps:
         print(step)
     # print(plan)
+
+
+def test_precomputed_motion_planner():
+    moves = ALLOWED_COCKTAIL_MOVES
+    planners = [SimpleRobotMotionPlanner(), PrecomputedRobotMotionPlanner(moves)]
+    for from_pos, to_pos in product(CocktailPosition, repeat=2):
+        simple, precomputed = (
+            [task.to_pos for task in planner.gen_plan_move(from_pos, to_pos)]
+            for planner in planners
+        )
+        assert len(precomputed) == len(simple)
+        assert all(move in moves for move in zip([from_pos, *precomputed], precomputed))
+        assert precomputed[-1:] in ([], [to_pos])
+
+    # a graph with more positions, not all connected
+    extended = PrecomputedRobotMotionPlanner(
+        [*moves, (CocktailPosition.pump, "door"), ("door", "garage")]
+    )
+    assert [
+        task.to_pos for task in extended.gen_plan_move(CocktailPosition.clean, "garage")
+    ] == [
+        *(
+            task.to_pos
+            for task in planners[1].gen_plan_move(
+                CocktailPosition.clean, CocktailPosition.pump
+            )
+        ),
+        "door",
+        "garage",
+    ]
+    with pytest.raises(ValueError):
+        [*extended.gen_plan_move("garage", CocktailPosition.home)]
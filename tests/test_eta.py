@@ -0,0 +1,225 @@
+import asyncio
+import datetime
+import uuid
+
+import pytest
+
+from cocktail_24.cocktail.async_persistence import (
+    ThreadOffloadedCocktailBarStatePersistence,
+)
+from cocktail_24.cocktail.cocktail_api import (
+    CocktailApi,
+    EventOccurrence,
+    InMemoryCocktailBarStatePersistence,
+    OrderRejectedException,
+)
+from cocktail_24.cocktail.cocktail_bookkeeping import (
+    OrderPlacedEvent,
+    OrderEnqueuedEvent,
+    OrderExecutingEvent,
+    OrderFulfilledEvent,
+    OrderCancelledEvent,
+    QueuePurgedEvent,
+    RecipeCreatedEvent,
+    SlotPath,
+    SlotRefilledEvent,
+    SlotStatus,
+    Station,
+    UserId,
+)
+from cocktail_24.cocktail.cocktail_recipes import CocktailRecipe
+from cocktail_24.cocktail.openai_recipes import get_openai_recipes
+from cocktail_24.cocktail_robo import (
+    CocktailRobotMoveTask,
+    CocktailRobotZapfTask,
+    CocktailRobotShakeTask,
+    CocktailRobotPourTask,
+    CocktailRobotCleanTask,
+    CocktailRobotPumpTask,
+    CocktailPosition,
+)
+from cocktail_24.cocktail_system import CocktailSystemPlan
+from cocktail_24.planning.eta import (
+    EtaEngine,
+    TaskCostModel,
+    estimate_plan_duration,
+)
+
+COST_MODEL = TaskCostModel(
+    move_in_s=1.0,
+    zapf_in_s=2.0,
+    single_shake_in_s=0.5,
+    pour_in_s=3.0,
+    clean_in_s=4.0,
+    pump_overhead_in_s=1.0,
+)
+
+
+def test_estimate_plan_duration():
+    plan = CocktailSystemPlan(
+        plan_uuid=uuid.uuid4(),
+        steps=(
+            CocktailRobotMoveTask(to_pos=CocktailPosition.zapf),
+            CocktailRobotZapfTask(slot=1),
+            CocktailRobotZapfTask(slot=1),
+            CocktailRobotPumpTask(durations_in_s=[2.0, 5.0, 0.0]),
+            CocktailRobotShakeTask(num_shakes=4),
+            CocktailRobotPourTask(),
+            CocktailRobotCleanTask(),
+        ),
+    )
+    assert estimate_plan_duration(plan, COST_MODEL) == 1 + 2 * 2 + 6 + 2 + 3 + 4
+
+
+# a recipe's plan is one move per step of the recipe
+class _MovesPerStepPlanning_:
+
+    def __init__(self):
+        self.n_plans = 0
+
+    def plan_cocktail(self, recipe, slots_status, robot_position, shaker_empty):
+        self.n_plans += 1
+        steps = [CocktailRobotMoveTask(to_pos=CocktailPosition.home)] * len(
+            recipe.steps
+        )
+        return CocktailSystemPlan(plan_uuid=uuid.uuid4(), steps=tuple(steps))
+
+
+def test_eta_engine():
+    persistence = InMemoryCocktailBarStatePersistence()
+    planning = _MovesPerStepPlanning_()
+    now = [0.0]
+    eta = EtaEngine(
+        planning=planning,
+        get_state=persistence.get_current_state,
+        cost_model=COST_MODEL,
+        clock=lambda: now[0],
+    )
+    persistence.order_watch.add_listener(eta.orders_changed)
+
+    def persist(*events):
+        persistence.persist_events(
+            EventOccurrence(timestamp=datetime.datetime.now(), event=event)
+            for event in events
+        )
+
+    def estimates():
+        state = persistence.get_current_state()
+        return [eta.estimate(order_id, state) for order_id in order_ids]
+
+    recipes = get_openai_recipes()[:2]
+    durations = [float(len(recipe.steps)) for recipe in recipes]
+    user_id = UserId(uuid.uuid4())
+    persist(*(RecipeCreatedEvent(recipe, user_id) for recipe in recipes))
+    order_ids = [uuid.uuid4() for _ in range(40)]
+    persist(
+        *(
+            OrderPlacedEvent(order_id, recipes[i % 2].recipe_id, user_id)
+            for i, order_id in enumerate(order_ids)
+        )
+    )
+    assert estimates() == [None] * 40
+
+    # past the initial capacity of the tree
+    persist(*(OrderEnqueuedEvent(order_id) for order_id in order_ids))
+    assert planning.n_plans == 2
+    expected = [sum(durations[j % 2] for j in range(i + 1)) for i in range(40)]
+    assert estimates() == expected
+
+    persist(OrderCancelledEvent(order_ids[3]))
+    assert estimates()[2:5] == [expected[2], None, expected[4] - durations[1]]
+
+    persist(OrderExecutingEvent(order_ids[0]))
+    now[0] += 1.0
+    assert estimates()[:3] == [
+        durations[0] - 1,
+        durations[0] - 1 + durations[1],
+        expected[2] - 1,
+    ]
+
+    persist(OrderFulfilledEvent(order_ids[0]))
+    assert estimates()[:3] == [None, durations[1], expected[2] - durations[0]]
+    assert estimates()[-1] == pytest.approx(expected[-1] - durations[0] - durations[1])
+
+    # many orders through the queue keep positions compact
+    for order_id in order_ids[1:]:
+        persist(OrderExecutingEvent(order_id), OrderFulfilledEvent(order_id))
+        persist(OrderEnqueuedEvent(order_id))
+    assert eta._tree_.capacity() <= 128
+    assert estimates()[:3] == [None, durations[1], durations[1] + durations[0]]
+
+    # a purge changes no order, the engine catches up on the next estimate
+    persist(QueuePurgedEvent())
+    assert estimates() == [None] * 40
+    assert planning.n_plans == 2
+
+    # queued again in another order after a purge, without an estimate between
+    persist(*(OrderEnqueuedEvent(order_id) for order_id in order_ids[1:3]))
+    assert estimates()[1:3] == [durations[1], durations[1] + durations[0]]
+    persist(QueuePurgedEvent())
+    persist(*(OrderEnqueuedEvent(order_id) for order_id in order_ids[2:0:-1]))
+    assert estimates()[1:3] == [durations[0] + durations[1], durations[0]]
+
+    # plan durations are planned again for another slot layout or recipe
+    persist(
+        SlotRefilledEvent(
+            SlotStatus(
+                slot_path=SlotPath(station_id=Station.zapf, slot_id=0),
+                available_amount_in_ml=700.0,
+                ingredient_id="rum",
+            )
+        )
+    )
+    persist(OrderEnqueuedEvent(order_ids[5]))
+    assert planning.n_plans == 3
+    shorter = CocktailRecipe(
+        recipe_id=recipes[0].recipe_id, title="shorter", steps=recipes[0].steps[:1]
+    )
+    persist(RecipeCreatedEvent(shorter, user_id), OrderEnqueuedEvent(order_ids[6]))
+    assert planning.n_plans == 4
+    assert estimates()[6] == durations[0] + durations[1] + durations[1] + 1.0
+
+
+def test_eta_engine_unknown_queued_order():
+    persistence = InMemoryCocktailBarStatePersistence()
+    offloaded = ThreadOffloadedCocktailBarStatePersistence(persistence)
+    api = CocktailApi(state_persistence=offloaded)
+    eta = EtaEngine(
+        planning=_MovesPerStepPlanning_(),
+        get_state=persistence.get_current_state,
+        cost_model=COST_MODEL,
+        clock=lambda: 0.0,
+    )
+    persistence.order_watch.add_listener(eta.orders_changed)
+    recipe = get_openai_recipes()[0]
+    unknown = uuid.uuid4()
+
+    async def scenario():
+        await api.create_recipe(recipe)
+        first = await api.place_order(recipe.recipe_id)
+        second = await api.place_order(recipe.recipe_id)
+        with pytest.raises(OrderRejectedException):
+            await api.enqueue_order(unknown)
+        await api.enqueue_order(first)
+        with pytest.raises(OrderRejectedException):
+            await api.enqueue_order(first)
+        # older logs may still queue unknown ids
+        await offloaded.persist_events(
+            [
+                EventOccurrence(
+                    timestamp=datetime.datetime.now(),
+                    event=OrderEnqueuedEvent(unknown),
+                )
+            ]
+        )
+        await api.enqueue_order(second)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    offloaded.close()
+    state = persistence.get_current_state()
+    assert [*state.order_queue] == [first, unknown, second]
+    duration = float(len(recipe.steps))
+    assert eta.estimate(first, state) == duration
+    assert eta.estimate(unknown, state) == duration + COST_MODEL.unplannable_in_s
+    assert eta.estimate(second, state) == (2 * duration + COST_MODEL.unplannable_in_s)
@@ -0,0 +1,79 @@
+import uuid
+
+import pytest
+
+from cocktail_24.cocktail.cocktail_bookkeeping import (
+    SlotRefilledEvent,
+    SlotStatus,
+    SlotPath,
+    AmountPouredEvent,
+    OrderPlacedEvent,
+    OrderCancelledEvent,
+    OrderAbortedEvent,
+    OrderEnqueuedEvent,
+    OrderDequeuedEvent,
+    OrderFulfilledEvent,
+    OrderExecutingEvent,
+    QueuePurgedEvent,
+    RecipeCreatedEvent,
+    Station,
+    UserId,
+)
+from cocktail_24.cocktail.event_codec import (
+    encode_event,
+    decode_event,
+    EventCodecException,
+    CODEC_VERSION,
+)
+from cocktail_24.cocktail.openai_recipes import get_openai_recipes
+
+
+def all_event_kinds():
+    order_id = uuid.uuid4()
+    yield SlotRefilledEvent(
+        new_status=SlotStatus(
+            slot_path=SlotPath(station_id=Station.pump, slot_id=2),
+            available_amount_in_ml=700.5,
+            ingredient_id="Limettensaft",
+        )
+    )
+    yield SlotRefilledEvent(
+        new_status=SlotStatus(
+            slot_path=SlotPath(station_id="garnish", slot_id=0),
+            available_amount_in_ml=20.0,
+            ingredient_id="mint",
+        )
+    )
+    yield AmountPouredEvent(
+        slot_path=SlotPath(station_id=Station.zapf, slot_id=7), amount_in_ml=30.0
+    )
+    yield OrderPlacedEvent(
+        order_id=order_id, recipe_id=uuid.uuid4(), user_id=UserId(uuid.uuid4())
+    )
+    for event_type in (
+        OrderCancelledEvent,
+        OrderAbortedEvent,
+        OrderEnqueuedEvent,
+        OrderDequeuedEvent,
+        OrderFulfilledEvent,
+        OrderExecutingEvent,
+    ):
+        yield event_type(order_id=order_id)
+    yield QueuePurgedEvent()
+    for recipe in get_openai_recipes():
+        yield RecipeCreatedEvent(recipe=recipe, creator_user_id=UserId(uuid.uuid4()))
+
+
+def test_event_codec_roundtrip():
+    for event in all_event_kinds():
+        encoded = encode_event(event)
+        assert encoded[0] == CODEC_VERSION
+        assert decode_event(encoded) == event
+        assert decode_event(memoryview(b"\0" + encoded)[1:]) == event
+
+
+def test_event_codec_rejects_unknown_version():
+    encoded = bytearray(encode_event(QueuePurgedEvent()))
+    encoded[0] = CODEC_VERSION + 1
+    with pytest.raises(EventCodecException):
+        decode_event(bytes(encoded))
@@ -0,0 +1,47 @@
+import pytest
+
+from cocktail_24.metrics import MetricsRegistry
+
+
+def test_metrics_exposition():
+    registry = MetricsRegistry()
+    events = registry.counter("events_total", "events")
+    queue_length = registry.gauge("queue_length", "queue length")
+    latency = registry.histogram(
+        "latency_seconds", "latency", ("command",), buckets=(0.1, 1.0)
+    )
+    assert registry.counter("events_total", "again") is events
+    with pytest.raises(ValueError):
+        registry.gauge("events_total", "not a gauge")
+    with pytest.raises(ValueError):
+        latency.labels()
+
+    events.inc()
+    events.inc(2)
+    queue = [1, 2, 3]
+    queue_length.set_function(lambda: len(queue))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        latency.labels("SVON").observe(value)
+    latency.labels('say "hi"').observe(0.5)
+    queue.pop()
+
+    assert registry.expose().splitlines() == [
+        "# HELP events_total events",
+        "# TYPE events_total counter",
+        "events_total 3.0",
+        "# HELP queue_length queue length",
+        "# TYPE queue_length gauge",
+        "queue_length 2.0",
+        "# HELP latency_seconds latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{command="SVON",le="0.1"} 2',
+        'latency_seconds_bucket{command="SVON",le="1.0"} 3',
+        'latency_seconds_bucket{command="SVON",le="+Inf"} 4',
+        'latency_seconds_sum{command="SVON"} 3.65',
+        'latency_seconds_count{command="SVON"} 4',
+        'latency_seconds_bucket{command="say \\"hi\\"",le="0.1"} 0',
+        'latency_seconds_bucket{command="say \\"hi\\"",le="1.0"} 1',
+        'latency_seconds_bucket{command="say \\"hi\\"",le="+Inf"} 1',
+        'latency_seconds_sum{command="say \\"hi\\""} 0.5',
+        'latency_seconds_count{command="say \\"hi\\""} 1',
+    ]
@@ -1,26 +1,64 @@
+import asyncio
 import datetime
 import os
+import pickle
 import random
+import resource
+import sqlite3
 import tempfile
 import time
 import uuid
-from itertools import islice
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import islice, product, repeat
+
+import pytest
+from pydantic import TypeAdapter
 
 from cocktail_24.cocktail.cocktail_api import (
     SqliteCocktailBarStatePersistence,
     EventOccurrence,
+    SnapshotConfig,
+    CocktailApi,
+)
+from cocktail_24.cocktail.async_persistence import (
+    ThreadOffloadedCocktailBarStatePersistence,
+)
+from cocktail_24.cocktail.group_commit import WriteBehindConfig
+from cocktail_24.cocktail.log_persistence import (
+    AppendOnlyLogCocktailBarStatePersistence,
 )
 from cocktail_24.cocktail.cocktail_bookkeeping import (
+    CocktailBarState,
+    OrderEnqueuedEvent,
+    OrderExecutingEvent,
+    OrderFulfilledEvent,
     OrderPlacedEvent,
+    OrderStatus,
     RecipeCreatedEvent,
     UserId,
     SlotStatus,
     SlotPath,
+    SlotRefilledEvent,
+    AmountPouredEvent,
 )
 from cocktail_24.cocktail.cocktail_recipes import IngredientAmounts
+from cocktail_24.cocktail.event_codec import encode_event, decode_event
+from cocktail_24.cocktail.response_cache import VersionedResponseCache
 from cocktail_24.cocktail.openai_recipes import get_openai_recipes
 from cocktail_24.cocktail_robo import CocktailPosition
+from cocktail_24.metrics import MetricsRegistry
+from cocktail_24.planning.cocktail_planner import (
+    SlotAmounts,
+    SimpleRobotMotionPlanner,
+    PrecomputedRobotMotionPlanner,
+)
 from configure import configure_system_config, configure_planning
+from loadtest import LoadTestConfig, run_load_test, serve_app
+
+# timings are printed, the assertions only check the results. deselect with
+#   pytest -m "not benchmark"
+pytestmark = pytest.mark.benchmark
 
 
 def gen_dummy_events():
@@ -39,7 +77,6 @@ def gen_dummy_events():
 def test_sqlite_persistence():
     with tempfile.TemporaryDirectory() as tempdir:
         filename = os.path.join(tempdir, "test.db")
-        filename = "/tmp/test.db"
         persistence = SqliteCocktailBarStatePersistence(filename)
 
         events = [
@@ -49,6 +86,398 @@ def test_sqlite_persistence():
         started = time.time()
         persistence.persist_events(events)
         print(f"took {time.time()-started}")
+        state = persistence.get_current_state()
+        persistence.close()
+        assert state.version == len(events)
+        reopened = SqliteCocktailBarStatePersistence(filename)
+        assert reopened.get_current_state() == state
+        reopened.close()
+
+
+def test_sqlite_write_behind_throughput():
+    n_events = 2000
+    events = [*islice(gen_dummy_events(), n_events)]
+    for write_behind in (None, WriteBehindConfig()):
+        for n_writers in (1, 10, 100):
+            with tempfile.TemporaryDirectory() as tempdir:
+                filename = os.path.join(tempdir, "test.db")
+                persistence = SqliteCocktailBarStatePersistence(
+                    filename, write_behind=write_behind
+                )
+
+                def write(writer: int):
+                    for event in events[writer::n_writers]:
+                        persistence.persist_events(
+                            [
+                                EventOccurrence(
+                                    event=event, timestamp=datetime.datetime.now()
+                                )
+                            ]
+                        )
+
+                started = time.time()
+                with ThreadPoolExecutor(max_workers=n_writers) as executor:
+                    [*executor.map(write, range(n_writers))]
+                persistence.flush()
+                took = time.time() - started
+                persistence.close()
+                reopened = SqliteCocktailBarStatePersistence(filename)
+                assert reopened.get_current_state().version == n_events
+                reopened.close()
+            print(f"{write_behind=} {n_writers=}: {n_events / took:.0f} durable ev/s")
+
+
+def test_log_persistence_performance():
+    burst = [
+        EventOccurrence(event=ev, timestamp=datetime.datetime.now())
+        for ev in islice(gen_dummy_events(), 2000)
+    ]
+    history = [
+        EventOccurrence(event=ev, timestamp=datetime.datetime.now())
+        for ev in islice(gen_dummy_events(), 100000)
+    ]
+    with tempfile.TemporaryDirectory() as tempdir:
+        backends = {
+            # no snapshots, so both replay the full log
+            "sqlite": lambda: SqliteCocktailBarStatePersistence(
+                os.path.join(tempdir, "test.db"),
+                snapshot_config=SnapshotConfig(interval_in_events=0),
+            ),
+            "log": lambda: AppendOnlyLogCocktailBarStatePersistence(
+                os.path.join(tempdir, "log")
+            ),
+        }
+        for name, open_backend in backends.items():
+            persistence = open_backend()
+            started = time.time()
+            for occurence in burst:
+                persistence.persist_events([occurence])
+            append_took = time.time() - started
+            persistence.persist_events(history)
+            persistence.close()
+
+            started = time.time()
+            recovered = open_backend()
+            replay_took = time.time() - started
+            assert recovered.get_current_state().version == len(burst) + len(history)
+            recovered.close()
+            print(
+                f"{name}: {len(burst) / append_took:.0f} single appends/s,"
+                f" recovery of {len(burst) + len(history)} events"
+                f" took {replay_took:.1f}s"
+            )
+
+
+# calls the blocking persistence right on the event loop, like the api used to
+class _BlockingAsyncPersistence:
+
+    def __init__(self, persistence):
+        self._persistence_ = persistence
+
+    async def persist_events(self, occurences):
+        self._persistence_.persist_events(occurences)
+
+    def get_current_state(self):
+        return self._persistence_.get_current_state()
+
+
+async def _max_loop_stall_during_(burst) -> float:
+    max_stall = 0.0
+    done = False
+
+    async def heartbeat():
+        nonlocal max_stall
+        while not done:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            max_stall = max(max_stall, time.perf_counter() - started - 0.001)
+
+    beat = asyncio.create_task(heartbeat())
+    await burst()
+    done = True
+    await beat
+    return max_stall
+
+
+def test_event_loop_stall_during_order_burst():
+    recipe = get_openai_recipes()[0]
+    with tempfile.TemporaryDirectory() as tempdir:
+        for offloaded in (False, True):
+            persistence = SqliteCocktailBarStatePersistence(
+                os.path.join(tempdir, f"{offloaded}.db")
+            )
+            async_persistence = (
+                ThreadOffloadedCocktailBarStatePersistence(persistence)
+                if offloaded
+                else _BlockingAsyncPersistence(persistence)
+            )
+            api = CocktailApi(state_persistence=async_persistence)
+
+            async def burst():
+                await api.create_recipe(recipe)
+                for _ in range(10):
+                    await asyncio.gather(
+                        *(api.place_order(recipe.recipe_id) for _ in range(50))
+                    )
+
+            max_stall = asyncio.run(_max_loop_stall_during_(burst))
+            print(f"{offloaded=}: max event loop stall {max_stall * 1000:.1f}ms")
+            assert len(persistence.get_current_state().orders) == 500
+            persistence.close()
+
+
+def test_change_feed_performance():
+    history = [
+        EventOccurrence(event=ev, timestamp=datetime.datetime.now())
+        for ev in islice(gen_dummy_events(), 100000)
+    ]
+    with tempfile.TemporaryDirectory() as tempdir:
+        backends = {
+            "sqlite": SqliteCocktailBarStatePersistence(
+                os.path.join(tempdir, "test.db"),
+                snapshot_config=SnapshotConfig(interval_in_events=0),
+            ),
+            "log": AppendOnlyLogCocktailBarStatePersistence(
+                os.path.join(tempdir, "log")
+            ),
+        }
+        for name, persistence in backends.items():
+            persistence.persist_events(history)
+            # a page should cost the same wherever the cursor is
+            for after_seq in (0, len(history) // 2, len(history) - 100):
+                started = time.time()
+                for _ in range(100):
+                    page = persistence.read_events(after_seq, limit=100)
+                took = time.time() - started
+                assert [logged.seq for logged in page] == [
+                    *range(after_seq + 1, after_seq + 101)
+                ]
+                print(f"{name}: page of 100 after {after_seq} took {took * 10:.2f}ms")
+            persistence.close()
+
+
+def test_time_travel_performance():
+    history = [
+        EventOccurrence(event=ev, timestamp=datetime.datetime.now())
+        for ev in islice(gen_dummy_events(), 20000)
+    ]
+    with tempfile.TemporaryDirectory() as tempdir:
+        persistence = SqliteCocktailBarStatePersistence(
+            os.path.join(tempdir, "test.db"),
+            snapshot_config=SnapshotConfig(interval_in_events=1000, retention=None),
+        )
+        for chunk_start in range(0, len(history), 100):
+            persistence.persist_events(history[chunk_start : chunk_start + 100])
+        rand = random.Random(42)
+        started = time.time()
+        for _ in range(20):
+            seq = rand.randint(1, len(history))
+            assert persistence.get_state_at(seq=seq).version == seq
+        print(f"state at a random seq took {(time.time() - started) / 20:.3f}s")
+        started = time.time()
+        timestamp = history[len(history) // 2].timestamp
+        state = persistence.get_state_at(timestamp=timestamp)
+        print(f"state at a timestamp took {time.time() - started:.3f}s")
+        # the state after the last event at or before timestamp
+        assert history[state.version - 1].timestamp <= timestamp
+        assert (
+            state.version == len(history)
+            or history[state.version].timestamp > timestamp
+        )
+        persistence.close()
+
+
+# a refill and n_events - 1 pours from it, without snapshots. returns the state
+def _write_pour_log_(filename: str, n_events: int) -> CocktailBarState:
+    persistence = SqliteCocktailBarStatePersistence(
+        filename, snapshot_config=SnapshotConfig(interval_in_events=0)
+    )
+    now = datetime.datetime.now()
+    slot_path = SlotPath(station_id="zapf", slot_id=1)
+    refill = SlotRefilledEvent(
+        new_status=SlotStatus(
+            slot_path=slot_path, available_amount_in_ml=1e9, ingredient_id="gin"
+        )
+    )
+    persistence.persist_events([EventOccurrence(event=refill, timestamp=now)])
+    pour = EventOccurrence(
+        event=AmountPouredEvent(slot_path=slot_path, amount_in_ml=1.0), timestamp=now
+    )
+    for n_written in range(1, n_events, 100_000):
+        persistence.persist_events(repeat(pour, min(100_000, n_events - n_written)))
+    state = persistence.get_current_state()
+    persistence.close()
+    return state
+
+
+def _replay_peak_rss_in_mb_(filename: str) -> float:
+    # runs in a fresh process, so that maxrss only covers imports and the replay
+    SqliteCocktailBarStatePersistence(filename).close()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def test_replay_memory_peak():
+    spawn = multiprocessing.get_context("spawn")
+    peaks = {}
+    for n_events in (200_000, 2_000_000):
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename = os.path.join(tempdir, "test.db")
+            _write_pour_log_(filename, n_events)
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as executor:
+                started = time.time()
+                peaks[n_events] = executor.submit(
+                    _replay_peak_rss_in_mb_, filename
+                ).result()
+                print(
+                    f"replayed {n_events} events in {time.time() - started:.1f}s,"
+                    f" peak rss {peaks[n_events]:.1f} MB"
+                )
+    # a materialized log of 2M events would take well over a GB
+    assert peaks[2_000_000] < peaks[200_000] + 32
+
+
+def test_parallel_replay_performance():
+    n_events = 200_000
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "test.db")
+        written = _write_pour_log_(filename, n_events)
+        (slot,) = written.slots
+        assert slot.available_amount_in_ml == 1e9 - (n_events - 1)
+        timings = {}
+        for n_workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+            started = time.time()
+            persistence = SqliteCocktailBarStatePersistence(
+                filename,
+                snapshot_config=SnapshotConfig(interval_in_events=0),
+                replay_workers=n_workers,
+            )
+            timings[n_workers] = time.time() - started
+            assert persistence.get_current_state() == written
+            persistence.close()
+            print(
+                f"{n_workers=} ({os.cpu_count()} cores): full replay of {n_events}"
+                f" took {timings[n_workers]:.2f}s,"
+                f" speedup {timings[1] / timings[n_workers]:.2f}"
+            )
+
+
+def _blob_table_size_(filename: str, blobs: list[bytes]) -> int:
+    con = sqlite3.connect(filename)
+    con.execute("CREATE TABLE events (data BLOB)")
+    con.executemany("INSERT INTO events VALUES(?)", [[blob] for blob in blobs])
+    con.commit()
+    con.close()
+    return os.path.getsize(filename)
+
+
+def test_event_codec_performance():
+    # the same payload for both: the timestamp lives in its own column
+    events = [*islice(gen_dummy_events(), 100000)]
+
+    started = time.time()
+    pickled = [pickle.dumps(event) for event in events]
+    pickle_encode = time.time() - started
+    started = time.time()
+    for blob in pickled:
+        pickle.loads(blob)
+    pickle_decode = time.time() - started
+
+    started = time.time()
+    encoded = [encode_event(event) for event in events]
+    codec_encode = time.time() - started
+    started = time.time()
+    for blob in encoded:
+        decode_event(blob)
+    codec_decode = time.time() - started
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        pickle_size = _blob_table_size_(os.path.join(tempdir, "pickle.db"), pickled)
+        codec_size = _blob_table_size_(os.path.join(tempdir, "codec.db"), encoded)
+
+    n = len(events)
+    print(
+        f"pickle: encode {n / pickle_encode:.0f} ev/s,"
+        f" decode {n / pickle_decode:.0f} ev/s,"
+        f" {sum(map(len, pickled))} bytes, db {pickle_size} bytes"
+    )
+    print(
+        f"codec:  encode {n / codec_encode:.0f} ev/s,"
+        f" decode {n / codec_decode:.0f} ev/s,"
+        f" {sum(map(len, encoded))} bytes, db {codec_size} bytes"
+    )
+    assert codec_size < pickle_size
+
+
+def test_pour_replay_performance():
+    now = datetime.datetime.now()
+    rand = random.Random(42)
+    for n_slots in (10, 100, 400):
+        slot_paths = [
+            SlotPath(station_id=station_id, slot_id=slot_id)
+            for station_id in ("zapf", "pump", "spare")
+            for slot_id in range(n_slots // 3 + 1)
+        ][:n_slots]
+        refills = [
+            (
+                now,
+                SlotRefilledEvent(
+                    new_status=SlotStatus(
+                        slot_path=slot_path,
+                        available_amount_in_ml=1e9,
+                        ingredient_id="gin",
+                    )
+                ),
+            )
+            for slot_path in slot_paths
+        ]
+        pours = [
+            (
+                now,
+                AmountPouredEvent(slot_path=rand.choice(slot_paths), amount_in_ml=1.0),
+            )
+            for _ in range(50000)
+        ]
+        started = time.time()
+        state = CocktailBarState.apply_events(refills + pours)
+        took = time.time() - started
+        assert sum(status.available_amount_in_ml for status in state.slots) == (
+            n_slots * 1e9 - len(pours)
+        )
+        started = time.time()
+        for _ in range(1000):
+            SlotAmounts.from_slots(state.slots)
+        lookup_took = time.time() - started
+        print(
+            f"{n_slots=}: replay of {len(pours)} pours took {took:.2f}s,"
+            f" slot lookup for planning took {lookup_took:.3f}ms"
+        )
+
+
+def test_order_queue_performance():
+    now = datetime.datetime.now()
+    recipe_id = uuid.uuid4()
+    order_ids = [uuid.uuid4() for _ in range(10000)]
+    # party rush: everything is queued before the robot catches up
+    events = [
+        (
+            now,
+            OrderPlacedEvent(
+                order_id=order_id, recipe_id=recipe_id, user_id=UserId(uuid.uuid4())
+            ),
+        )
+        for order_id in order_ids
+    ]
+    events += [(now, OrderEnqueuedEvent(order_id=order_id)) for order_id in order_ids]
+    for order_id in order_ids:
+        events += [
+            (now, OrderExecutingEvent(order_id=order_id)),
+            (now, OrderFulfilledEvent(order_id=order_id)),
+        ]
+    started = time.time()
+    state = CocktailBarState.apply_events(events)
+    took = time.time() - started
+    assert not state.order_queue
+    print(f"{len(order_ids)} enqueue/execute cycles took {took:.2f}s")
 
 
 def test_planner_performance():
@@ -68,12 +497,153 @@ def test_planner_performance():
         for amount in amounts.amounts
     ]
 
-    planning = configure_planning(system_config=configure_system_config())
+    # the planners must agree on every plan and move
+    plans, moves = [], []
+    for motion_planner in (
+        SimpleRobotMotionPlanner(),
+        PrecomputedRobotMotionPlanner(),
+    ):
+        planning = configure_planning(
+            system_config=configure_system_config(), motion_planner=motion_planner
+        )
+        started = time.time()
+        for drink in drinks:
+            for _ in range(1000):
+                plan = planning.plan_cocktail(
+                    drink,
+                    slots,
+                    robot_position=CocktailPosition.pump,
+                    shaker_empty=True,
+                )
+            plans.append(plan.steps)
+        print(f"{type(motion_planner).__name__}: planning took {time.time()-started}")
 
-    for drink in drinks:
         started = time.time()
         for _ in range(1000):
-            plan = planning.plan_cocktail(
-                drink, slots, robot_position=CocktailPosition.pump, shaker_empty=True
-            )
-        print(f"took {time.time()-started}")
+            for from_pos, to_pos in product(CocktailPosition, repeat=2):
+                for _move in motion_planner.gen_plan_move(from_pos, to_pos):
+                    pass
+        print(
+            f"{type(motion_planner).__name__}: 1000x all pairs of moves took"
+            f" {time.time()-started}"
+        )
+        moves.append(
+            [
+                [*motion_planner.gen_plan_move(from_pos, to_pos)]
+                for from_pos, to_pos in product(CocktailPosition, repeat=2)
+            ]
+        )
+    assert plans[: len(drinks)] == plans[len(drinks) :]
+    assert moves[0] == moves[1]
+
+
+def test_response_cache_performance():
+    now = datetime.datetime.now()
+    state = CocktailBarState.apply_events(
+        (
+            now,
+            OrderPlacedEvent(
+                order_id=uuid.uuid4(),
+                recipe_id=uuid.uuid4(),
+                user_id=UserId(uuid.uuid4()),
+            ),
+        )
+        for _ in range(10000)
+    )
+    adapter = TypeAdapter(list[uuid.UUID])
+    cache = VersionedResponseCache()
+    n_polls = 100
+    bodies, n_builds = {}, 0
+
+    def build(cs: CocktailBarState) -> bytes:
+        nonlocal n_builds
+        n_builds += 1
+        return adapter.dump_json([*cs.orders])
+
+    for cached in (False, True):
+        started = time.time()
+        for _ in range(n_polls):
+            if cached:
+                bodies[cached] = cache.get("orders", state, build).body
+            else:
+                bodies[cached] = build(state)
+        took = time.time() - started
+        print(f"{cached=}: {n_polls / took:.0f} polls/s of 10000 orders")
+    # built once for the cached polls, with the same body
+    assert n_builds == n_polls + 1
+    assert bodies[True] == bodies[False]
+
+
+def test_order_page_performance():
+    start = datetime.datetime(2024, 5, 1)
+    order_ids = [uuid.uuid4() for _ in range(50000)]
+    events = [
+        (
+            start + datetime.timedelta(seconds=i),
+            OrderPlacedEvent(
+                order_id=order_id,
+                recipe_id=uuid.uuid4(),
+                user_id=UserId(uuid.uuid4()),
+            ),
+        )
+        for i, order_id in enumerate(order_ids)
+    ]
+    # a few open orders between lots of closed ones
+    events += [
+        (start, OrderFulfilledEvent(order_id=order_id))
+        for i, order_id in enumerate(order_ids)
+        if i % 1000
+    ]
+    state = CocktailBarState.apply_events(events)
+
+    started = time.time()
+    scanned = sorted(
+        (order.time_of_order, order.order_id)
+        for order in state.orders.values()
+        if order.status == OrderStatus.ordered
+    )[:20]
+    took_scan = time.time() - started
+
+    started = time.time()
+    page = [
+        *islice(
+            state.projections["timeline_by_status"].orders(
+                (OrderStatus.ordered.value,)
+            ),
+            20,
+        )
+    ]
+    took_index = time.time() - started
+    assert page == scanned
+    print(f"page of open orders: scan {took_scan:.4f}s, index {took_index:.6f}s")
+
+
+def test_metrics_overhead():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("took_seconds", "took").labels()
+    counter = registry.counter("events_total", "events")
+    n_samples = 200000
+    started = time.perf_counter()
+    for _ in range(n_samples):
+        histogram.observe(time.perf_counter() - started)
+        counter.inc()
+    took = time.perf_counter() - started
+    print(f"{took / n_samples * 1e6:.2f}us per timed observation and increment")
+    assert took / n_samples < 20e-6
+    # no sample got lost
+    exposed = registry.expose().splitlines()
+    assert f"took_seconds_count {n_samples}" in exposed
+    assert f"events_total {float(n_samples)!r}" in exposed
+
+
+def test_api_load():
+    with serve_app() as url:
+        result = asyncio.run(
+            run_load_test(url, LoadTestConfig(rate_in_hz=20, duration_in_s=3))
+        )
+    print(result.report())
+    for endpoint, stats in result.endpoints.items():
+        assert stats.n_failed == 0, endpoint
+        assert all(
+            status < 300 or status == 429 for status in stats.status_counts
+        ), endpoint
@@ -0,0 +1,52 @@
+import datetime
+import uuid
+
+from cocktail_24.cocktail.cocktail_bookkeeping import (
+    CocktailBarState,
+    OrderPlacedEvent,
+    UserId,
+)
+from cocktail_24.cocktail.response_cache import VersionedResponseCache, etag_matches
+
+
+def test_versioned_response_cache():
+    now = datetime.datetime.now()
+    order_ids = [uuid.uuid4() for _ in range(2)]
+    state = CocktailBarState.apply_events(
+        (
+            now,
+            OrderPlacedEvent(
+                order_id=order_id, recipe_id=uuid.uuid4(), user_id=UserId(uuid.uuid4())
+            ),
+        )
+        for order_id in order_ids
+    )
+    n_builds = 0
+
+    def build(cs: CocktailBarState) -> bytes:
+        nonlocal n_builds
+        n_builds += 1
+        return str(sorted(map(str, cs.orders))).encode()
+
+    cache = VersionedResponseCache(max_entries=2)
+    cached = cache.get("orders", state, build)
+    assert cache.get("orders", state, build) is cached
+    assert n_builds == 1
+    assert cached.etag.startswith('"2-')
+
+    # compaction keeps the version, but must not serve the old body
+    compacted = state.remove_orders(order_ids[:1])
+    recached = cache.get("orders", compacted, build)
+    assert n_builds == 2
+    assert recached.etag != cached.etag
+
+    cache.get("a", state, build)
+    cache.get("b", state, build)
+    cache.get("orders", compacted, build)
+    assert n_builds == 5
+
+    assert etag_matches(cached.etag, cached.etag)
+    assert etag_matches(f'"other", W/{cached.etag}', cached.etag)
+    assert etag_matches("*", cached.etag)
+    assert not etag_matches(recached.etag, cached.etag)
+    assert not etag_matches(None, cached.etag)
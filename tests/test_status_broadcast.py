@@ -0,0 +1,54 @@
+import asyncio
+import json
+
+from cocktail_24.status_broadcast import StatusBroadcaster
+
+
+def parse_sse(message: bytes) -> tuple[str, dict]:
+    event, data = message.decode().strip().split("\n")
+    return event.removeprefix("event: "), json.loads(data.removeprefix("data: "))
+
+
+def test_status_broadcaster():
+    state = {"status": "idle", "pump_status": 1}
+    n_samples = 0
+
+    def sample():
+        nonlocal n_samples
+        n_samples += 1
+        return dict(state)
+
+    async def scenario():
+        broadcaster = StatusBroadcaster(sample, max_rate_in_hz=100)
+        runner = asyncio.create_task(broadcaster.run())
+        fast, slow = broadcaster.subscribe(), broadcaster.subscribe()
+        assert parse_sse(await anext(fast)) == ("state", state)
+        assert parse_sse(await anext(slow)) == ("state", state)
+
+        state["status"] = "executing"
+        assert parse_sse(await anext(fast)) == ("delta", {"status": "executing"})
+        state["pump_status"] = 2
+        assert parse_sse(await anext(fast)) == ("delta", {"pump_status": 2})
+        # the slow subscriber gets both changes at once
+        assert parse_sse(await anext(slow)) == (
+            "delta",
+            {"status": "executing", "pump_status": 2},
+        )
+
+        # unchanged samples are not pushed
+        next_delta = asyncio.ensure_future(anext(fast))
+        await asyncio.sleep(0.1)
+        assert not next_delta.done()
+        # a disconnect cancels the subscription
+        next_delta.cancel()
+        await asyncio.gather(next_delta, return_exceptions=True)
+        await slow.aclose()
+
+        # nobody listens: no sampling
+        await asyncio.sleep(0.02)
+        n_idle = n_samples
+        await asyncio.sleep(0.1)
+        assert n_samples == n_idle
+        runner.cancel()
+
+    asyncio.run(scenario())